@@ -10,32 +10,46 @@ Author: odai - Gold Nightmare School
 import logging
 import asyncio
 import base64
+import hashlib
 import io
 import json
+import math
+import random
+import re
+import unicodedata
 import aiohttp
 import secrets
 import string
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, date, timezone
-from collections import defaultdict
-from typing import Optional, Dict, List, Tuple, Any
-from dataclasses import dataclass, field
-from enum import Enum
+from collections import defaultdict, OrderedDict, deque
+from typing import Optional, Dict, List, Tuple, Any, Callable, Awaitable
+from dataclasses import dataclass, field, replace
+from enum import Enum, IntEnum
 import os
 from dotenv import load_dotenv
 import pytz
-from functools import wraps
+from functools import wraps, partial
+from contextlib import asynccontextmanager
 import pickle
 import aiofiles
 import asyncpg
+import httpx
 from urllib.parse import urlparse
 
 # Telegram imports
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, Chat
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    CallbackQueryHandler, filters, ContextTypes
+    CallbackQueryHandler, filters, ContextTypes, BaseRateLimiter,
+    TypeHandler, ApplicationHandlerStop
 )
-from telegram.constants import ChatAction, ParseMode
+from telegram.constants import ChatAction, ChatType, ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
 
 # AI and Image Processing
 import anthropic
@@ -45,13 +59,19 @@ import numpy as np
 # Optional Technical Analysis (graceful fallback if not installed)
 try:
     import talib
-    import yfinance as yf
     from scipy import stats
     ADVANCED_ANALYSIS_AVAILABLE = True
 except ImportError:
     ADVANCED_ANALYSIS_AVAILABLE = False
     print("⚠️ Advanced analysis libraries not found. Basic analysis will be used.")
 
+# Optional secondary price source
+try:
+    import yfinance as yf
+    YFINANCE_AVAILABLE = True
+except ImportError:
+    YFINANCE_AVAILABLE = False
+
 # Load environment variables
 load_dotenv()
 
@@ -59,6 +79,12 @@ load_dotenv()
 class PerformanceConfig:
     # تحسينات الأداء المُصلحة
     CLAUDE_TIMEOUT = 30  # تقليل timeout
+    CLAUDE_MAX_CONNECTIONS = 200      # اتصالات HTTP المتزامنة لعميل Claude
+    CLAUDE_MAX_KEEPALIVE = 40         # اتصالات محفوظة للإعادة
+    CLAUDE_KEEPALIVE_EXPIRY = 30      # ثواني قبل إغلاق الاتصال الخامل
+    CLAUDE_STREAM_TIMEOUT = 120       # مهلة التحليل المتدفق الكامل
+    CLAUDE_MAX_CONCURRENCY = int(os.getenv("CLAUDE_MAX_CONCURRENCY", "20"))  # سقف طلبات Claude المتزامنة
+    CLAUDE_QUEUE_LIMIT = int(os.getenv("CLAUDE_QUEUE_LIMIT", "200"))         # أقصى عدد في الانتظار
     DATABASE_TIMEOUT = 5   # تقليل database timeout
     HTTP_TIMEOUT = 10      # timeout HTTP
     CACHE_TTL = 300        # 5 دقائق cache
@@ -150,33 +176,102 @@ class Config:
     TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
     WEBHOOK_URL = os.getenv("WEBHOOK_URL")
     MASTER_USER_ID = int(os.getenv("MASTER_USER_ID", "590918137"))
+    TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "28"))      # رسالة/ثانية لكل البوت
+    TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))           # رسالة/ثانية للمحادثة الخاصة
+    TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", "20")) / 60   # 20 رسالة/دقيقة للمجموعات
+    TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+    TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+    BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # أقل من الحد العام لترك مجال للردود
+    BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+    BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "100"))
+    BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", "120"))
+    BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", "5"))  # حفظ التقدم وتجديد الحجز
+    
+    # Analysis Job Queue
+    ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", str(PerformanceConfig.CLAUDE_MAX_CONCURRENCY)))
+    ANALYSIS_JOB_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_JOB_MAX_ATTEMPTS", "3"))
+    ANALYSIS_JOB_RETRY_DELAY = float(os.getenv("ANALYSIS_JOB_RETRY_DELAY", "10"))  # يتضاعف مع كل محاولة
+    # مهمة 'running' لم يُجدد الـ lease الخاص بها خلال هذه المدة تُعاد للطابور - يُجدد كل ثلث المدة أثناء التنفيذ
+    ANALYSIS_JOB_LEASE = int(os.getenv("ANALYSIS_JOB_LEASE", "600"))
+    ANALYSIS_JOB_POLL_INTERVAL = float(os.getenv("ANALYSIS_JOB_POLL_INTERVAL", "2"))
     
     # Claude Configuration
     CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
     CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "claude-3-5-sonnet-20241022")
     CLAUDE_MAX_TOKENS = 8000
     CLAUDE_TEMPERATURE = float(os.getenv("CLAUDE_TEMPERATURE", "0.3"))
+    CLAUDE_CLIENT_MODE = os.getenv("CLAUDE_CLIENT_MODE", "async")  # async | thread
+    CLAUDE_STREAMING = os.getenv("CLAUDE_STREAMING", "true").lower() == "true"
+    STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
     
     # Gold API Configuration
     GOLD_API_TOKEN = os.getenv("GOLD_API_TOKEN")
     GOLD_API_URL = "https://www.goldapi.io/api/XAU/USD"
+    PRICE_SOURCES = os.getenv("PRICE_SOURCES", "goldapi,yfinance")  # بالترتيب: الأساسي ثم مصادر التحوط
+    YFINANCE_SYMBOLS = [s.strip() for s in os.getenv("YFINANCE_SYMBOLS", "XAUUSD=X,GC=F").split(",") if s.strip()]
+    PRICE_HEDGE_DELAY_MS = int(os.getenv("PRICE_HEDGE_DELAY_MS", "800"))  # بدء المصدر التالي إذا لم يرد الحالي
+    PRICE_MAX_JUMP_PCT = float(os.getenv("PRICE_MAX_JUMP_PCT", "2.0"))  # قفزة أكبر تحتاج تأكيد مصدر آخر
+    PRICE_SOURCE_TOLERANCE_PCT = float(os.getenv("PRICE_SOURCE_TOLERANCE_PCT", "1.5"))  # فرق مقبول بين المصادر (العقود الآجلة أعلى من الفوري)
+    PRICE_BREAKER_FAILURES = int(os.getenv("PRICE_BREAKER_FAILURES", "3"))
+    PRICE_BREAKER_RESET = float(os.getenv("PRICE_BREAKER_RESET", "120"))
     
     # Rate Limiting
     RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "30"))
     RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))
+    RATE_LIMIT_SWEEP_INTERVAL = int(os.getenv("RATE_LIMIT_SWEEP_INTERVAL", "300"))
+    
+    # Shared State (multi-replica)
+    SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")  # memory | postgres
+    SHARED_STATE_SYNC_INTERVAL = float(os.getenv("SHARED_STATE_SYNC_INTERVAL", "1"))
+    SHARED_STATE_CACHE_TTL = float(os.getenv("SHARED_STATE_CACHE_TTL", "5"))
+    
+    # Update De-duplication
+    UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "600"))
+    UPDATE_DEDUP_MAX_ENTRIES = int(os.getenv("UPDATE_DEDUP_MAX_ENTRIES", "20000"))
+    IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "48"))
     
     # Cache Configuration
     PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", "60"))
+    PRICE_REFRESH_INTERVAL = float(os.getenv("PRICE_REFRESH_INTERVAL", str(PRICE_CACHE_TTL)))  # تحديث السعر في الخلفية
+    PRICE_STALE_AFTER = float(os.getenv("PRICE_STALE_AFTER", "300"))   # بعدها يُعلَّم السعر كمتأخر
+    PRICE_MAX_BACKOFF = float(os.getenv("PRICE_MAX_BACKOFF", "600"))   # أقصى انتظار بين المحاولات عند الأخطاء
     ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "300"))
+    ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "500"))
+    ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+    IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "200"))
+    IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+    CHART_DEDUP_WINDOW = int(os.getenv("CHART_DEDUP_WINDOW", "900"))
+    CHART_DEDUP_MAX_DISTANCE = int(os.getenv("CHART_DEDUP_MAX_DISTANCE", "0"))  # 0 = البصمة نفسها فقط، الحد الأقصى 2
+    CACHE_SWEEP_INTERVAL = int(os.getenv("CACHE_SWEEP_INTERVAL", "60"))
     
     # Image Processing
     MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", "10485760"))
     MAX_IMAGE_DIMENSION = int(os.getenv("MAX_IMAGE_DIMENSION", "1568"))
     IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+    IMAGE_MAX_PENDING = int(os.getenv("IMAGE_MAX_PENDING", str(IMAGE_WORKERS * 2)))
+    IMAGE_QUEUE_TIMEOUT = float(os.getenv("IMAGE_QUEUE_TIMEOUT", "5"))
     CHART_ANALYSIS_ENABLED = True
     
+    # Price History
+    TICK_STORE_CAPACITY = int(os.getenv("TICK_STORE_CAPACITY", "100000"))  # ~70 يوم بتحديث كل دقيقة
+    TICK_STORE_PATH = os.getenv("TICK_STORE_PATH", "price_ticks.npy")     # فارغ = في الذاكرة فقط
+    TICK_SNAPSHOT_INTERVAL = float(os.getenv("TICK_SNAPSHOT_INTERVAL", "60"))
+    CANDLE_HISTORY = int(os.getenv("CANDLE_HISTORY", "500"))                # شموع مغلقة محفوظة لكل إطار
+    CANDLE_BACKFILL_DAYS = int(os.getenv("CANDLE_BACKFILL_DAYS", "30"))     # تاريخ M5 من yfinance (حد ياهو 60 يوم)
+    CANDLE_GAP_THRESHOLD = float(os.getenv("CANDLE_GAP_THRESHOLD", "900"))  # انقطاع أطول يعيد البناء من التاريخ
+    CANDLE_REBUILD_COOLDOWN = float(os.getenv("CANDLE_REBUILD_COOLDOWN", "600"))
+    CANDLE_PROMPT_BARS = int(os.getenv("CANDLE_PROMPT_BARS", "6"))          # شموع كل إطار في prompt التحليل
+    
     # Database
     DATABASE_URL = os.getenv("DATABASE_URL")
+    DATABASE_MODE = os.getenv("DATABASE_MODE", "pool")  # pool | direct
+    DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+    DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", str(PerformanceConfig.CONNECTION_POOL_SIZE)))
+    DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+    USER_WRITE_BEHIND = os.getenv("USER_WRITE_BEHIND", "true").lower() == "true"
+    USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+    USER_FLUSH_BATCH_SIZE = int(os.getenv("USER_FLUSH_BATCH_SIZE", "200"))
     
     # Timezone
     TIMEZONE = pytz.timezone(os.getenv("TIMEZONE", "Asia/Amman"))
@@ -233,6 +328,7 @@ class GoldPrice:
     high_24h: float = 0.0
     low_24h: float = 0.0
     source: str = "goldapi"
+    stale: bool = False     # آخر سعر معروف بعد فشل التحديث لمدة PRICE_STALE_AFTER
 
 @dataclass
 class Analysis:
@@ -268,12 +364,70 @@ class AnalysisType(Enum):
     REVERSAL = "REVERSAL"
     NIGHTMARE = "NIGHTMARE"
 
-# ==================== ULTRA SIMPLE Database Manager - No Pool Issues ====================
+class AnalysisPriority(IntEnum):
+    """أولوية طلبات Claude - الرقم الأصغر يُخدم أولاً"""
+    ADMIN = 0
+    PREMIUM = 1     # التحليل الشامل المدفوع (5 نقاط)
+    STANDARD = 2
+
+# أقصى مدة انتظار في الطابور قبل إسقاط الطلب (ثواني)
+ANALYSIS_PRIORITY_DEADLINES = {
+    AnalysisPriority.ADMIN: 120,
+    AnalysisPriority.PREMIUM: 90,
+    AnalysisPriority.STANDARD: 45,
+}
+
+def analysis_priority(user_id: int, analysis_type: AnalysisType) -> AnalysisPriority:
+    """تحديد أولوية الطلب حسب المستخدم ونوع التحليل"""
+    if user_id == Config.MASTER_USER_ID:
+        return AnalysisPriority.ADMIN
+    if analysis_type == AnalysisType.NIGHTMARE:
+        return AnalysisPriority.PREMIUM
+    return AnalysisPriority.STANDARD
+
+@dataclass
+class AnalysisCachePolicy:
+    price_band: float   # إعادة استخدام التحليل ضمن ± هذا المبلغ بالدولار
+    time_bucket: int    # مدة صلاحية الدلو الزمني بالثواني
+
+def _load_analysis_cache_policies() -> Dict[AnalysisType, AnalysisCachePolicy]:
+    """سياسات الـ cache لكل نوع تحليل - قابلة للتعديل عبر ANALYSIS_CACHE_POLICY_<TYPE>=band:seconds"""
+    defaults = {
+        AnalysisType.QUICK: (0.5, 60),
+        AnalysisType.SCALPING: (0.5, 60),
+        AnalysisType.DETAILED: (2.0, 300),
+        AnalysisType.NEWS: (3.0, 600),
+        AnalysisType.FORECAST: (3.0, 600),
+        AnalysisType.SWING: (5.0, 900),
+        AnalysisType.REVERSAL: (2.0, 300),
+        AnalysisType.NIGHTMARE: (1.0, 300),
+    }
+    policies = {}
+    for analysis_type, (band, seconds) in defaults.items():
+        override = os.getenv(f"ANALYSIS_CACHE_POLICY_{analysis_type.value}")
+        if override:
+            try:
+                band_str, seconds_str = override.split(":")
+                band, seconds = float(band_str), int(seconds_str)
+            except ValueError:
+                print(f"⚠️ Invalid cache policy for {analysis_type.value}: {override}")
+        policies[analysis_type] = AnalysisCachePolicy(price_band=band, time_bucket=seconds)
+    return policies
+
+ANALYSIS_CACHE_POLICIES = _load_analysis_cache_policies()
+
+class DuplicateRequest(Exception):
+    """طلب مدفوع سبق تنفيذه بنفس مفتاح الـ idempotency (إعادة إرسال من تيليجرام)"""
+
+# ==================== ULTRA SIMPLE Database Manager - Pool + Direct Fallback ====================
 class UltraSimpleDatabaseManager:
     def __init__(self):
         self.database_url = Config.DATABASE_URL
         self.connection_retries = 3
         self.connection_delay = 1
+        self.mode = Config.DATABASE_MODE
+        self.pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
     
     async def get_connection(self):
         """الحصول على اتصال مباشر - بدون pool"""
@@ -288,19 +442,122 @@ class UltraSimpleDatabaseManager:
                 else:
                     raise
     
-    async def initialize(self):
-        """تهيئة قاعدة البيانات - بسيطة ومباشرة"""
+    async def get_pool(self) -> asyncpg.Pool:
+        """جلب الـ pool أو إنشاؤه من جديد إذا أُغلق"""
+        if self.pool is not None and not self.pool.is_closing():
+            return self.pool
+        
+        async with self._pool_lock:
+            if self.pool is not None and not self.pool.is_closing():
+                return self.pool
+            
+            for attempt in range(self.connection_retries):
+                try:
+                    self.pool = await asyncpg.create_pool(
+                        self.database_url,
+                        min_size=Config.DB_POOL_MIN_SIZE,
+                        max_size=Config.DB_POOL_MAX_SIZE,
+                        max_inactive_connection_lifetime=Config.DB_POOL_MAX_IDLE,
+                        timeout=PerformanceConfig.DATABASE_TIMEOUT
+                    )
+                    return self.pool
+                except Exception as e:
+                    logger.warning(f"Database pool creation attempt {attempt + 1} failed: {e}")
+                    if attempt < self.connection_retries - 1:
+                        await asyncio.sleep(self.connection_delay)
+                    else:
+                        raise
+    
+    async def _acquire_healthy(self) -> Tuple[asyncpg.Pool, Any]:
+        """حجز اتصال من الـ pool بعد التأكد من أنه حي"""
+        last_error = None
+        
+        for attempt in range(self.connection_retries):
+            pool = await self.get_pool()
+            try:
+                conn = await pool.acquire(timeout=PerformanceConfig.DATABASE_TIMEOUT)
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Database pool acquire attempt {attempt + 1} failed: {e}")
+                await self._handle_failover(pool)
+                continue
+            
+            try:
+                await conn.fetchval("SELECT 1", timeout=PerformanceConfig.DATABASE_TIMEOUT)
+                return pool, conn
+            except Exception as e:
+                # اتصال ميت (إعادة تشغيل السيرفر أو failover) - نتخلص منه ونعيد المحاولة
+                last_error = e
+                logger.warning(f"Dropping dead pooled connection: {e}")
+                conn.terminate()
+                await pool.release(conn)
+                await self._handle_failover(pool)
+        
+        raise last_error
+    
+    async def _handle_failover(self, pool: asyncpg.Pool):
+        """إعادة تدوير كل اتصالات الـ pool بعد فشل الاتصال"""
         try:
+            await pool.expire_connections()
+        except Exception as e:
+            logger.warning(f"Failed to expire pooled connections: {e}")
+        if self.connection_delay:
+            await asyncio.sleep(self.connection_delay)
+    
+    @asynccontextmanager
+    async def connection(self):
+        """الحصول على اتصال - من الـ pool أو مباشر حسب الوضع"""
+        if self.mode != "pool":
             conn = await self.get_connection()
             try:
-                await self.create_tables(conn)
-                print(f"تم الاتصال بـ PostgreSQL بنجاح - بدون pool")
+                yield conn
             finally:
                 await conn.close()
+            return
+        
+        pool, conn = await self._acquire_healthy()
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+    
+    async def initialize(self):
+        """تهيئة قاعدة البيانات - pool مع الرجوع للاتصال المباشر"""
+        if self.mode == "pool":
+            try:
+                await self.get_pool()
+            except Exception as e:
+                logger.warning(f"Database pool unavailable, falling back to direct connections: {e}")
+                self.mode = "direct"
+        
+        try:
+            async with self.connection() as conn:
+                await self.create_tables(conn)
+                print(f"تم الاتصال بـ PostgreSQL بنجاح - وضع {self.mode}")
         except Exception as e:
             print(f"خطأ في الاتصال بقاعدة البيانات: {e}")
             raise
     
+    def get_pool_status(self) -> Dict[str, Any]:
+        """حالة الاتصال الحالية"""
+        if self.mode != "pool" or self.pool is None:
+            return {'mode': self.mode, 'size': 0, 'idle': 0, 'max_size': 0}
+        return {
+            'mode': self.mode,
+            'size': self.pool.get_size(),
+            'idle': self.pool.get_idle_size(),
+            'max_size': Config.DB_POOL_MAX_SIZE
+        }
+    
+    async def close(self):
+        """إغلاق الـ pool"""
+        if self.pool is not None and not self.pool.is_closing():
+            try:
+                await asyncio.wait_for(self.pool.close(), timeout=PerformanceConfig.DATABASE_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Database pool close error: {e}")
+                self.pool.terminate()
+    
     async def create_tables(self, conn):
         """إنشاء الجداول - مباشرة"""
         await conn.execute("""
@@ -353,23 +610,173 @@ class UltraSimpleDatabaseManager:
             )
         """)
         
+        # حالة مشتركة بين نسخ البوت - حد المعدل لا يحتاج WAL، الحظر والجلسات دائمة
+        await conn.execute("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_state (
+                user_id BIGINT PRIMARY KEY,
+                arrival DOUBLE PRECISION NOT NULL,
+                updated_at DOUBLE PRECISION NOT NULL
+            )
+        """)
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS security_state (
+                user_id BIGINT PRIMARY KEY,
+                blocked BOOLEAN DEFAULT FALSE,
+                failed_attempts INTEGER DEFAULT 0,
+                license_key TEXT,
+                session_started TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        
         # إنشاء الفهارس
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_license_key ON users(license_key)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_license_keys_user_id ON license_keys(user_id)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_analyses_user_id ON analyses(user_id)")
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id SERIAL PRIMARY KEY,
+                message TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                created_by BIGINT NOT NULL,
+                last_user_id BIGINT DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                owner TEXT,
+                lease_until TIMESTAMP,
+                started_at TIMESTAMP DEFAULT NOW(),
+                finished_at TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        # جداول أُنشئت قبل إضافة الحجز
+        await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS owner TEXT")
+        await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP")
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                source TEXT NOT NULL,
+                analysis_type TEXT NOT NULL,
+                label TEXT,
+                prompt TEXT NOT NULL,
+                image_file_id TEXT,
+                license_key TEXT,
+                points INTEGER DEFAULT 0,
+                priority INTEGER DEFAULT 2,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                available_at TIMESTAMP DEFAULT NOW(),
+                locked_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT NOW(),
+                finished_at TIMESTAMP
+            )
+        """)
+        
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limit_state_updated ON rate_limit_state(updated_at)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_security_state_updated ON security_state(updated_at)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at)")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_analysis_jobs_ready
+            ON analysis_jobs(priority, available_at) WHERE status = 'queued'
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_analysis_jobs_running
+            ON analysis_jobs(locked_at) WHERE status = 'running'
+        """)
         
         print(f"تم إنشاء/التحقق من الجداول - مباشرة")
     
     async def save_user(self, user: User):
-        """حفظ/تحديث بيانات المستخدم - مباشر"""
+        """حفظ/تحديث بيانات المستخدم"""
         try:
-            conn = await self.get_connection()
-            try:
+            async with self.connection() as conn:
+                await self._upsert_user(conn, user)
+        except Exception as e:
+            logger.error(f"Error saving user {user.user_id}: {e}")
+    
+    @staticmethod
+    async def _upsert_user(conn, user: User):
+        await conn.execute("""
+            INSERT INTO users (user_id, username, first_name, is_activated, activation_date, 
+                             last_activity, total_requests, total_analyses, subscription_tier, 
+                             settings, license_key, daily_requests_used, last_request_date, updated_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, NOW())
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name,
+                is_activated = EXCLUDED.is_activated,
+                activation_date = EXCLUDED.activation_date,
+                last_activity = EXCLUDED.last_activity,
+                total_requests = EXCLUDED.total_requests,
+                total_analyses = EXCLUDED.total_analyses,
+                subscription_tier = EXCLUDED.subscription_tier,
+                settings = EXCLUDED.settings,
+                license_key = EXCLUDED.license_key,
+                daily_requests_used = EXCLUDED.daily_requests_used,
+                last_request_date = EXCLUDED.last_request_date,
+                updated_at = NOW()
+        """, user.user_id, user.username, user.first_name, user.is_activated, 
+             user.activation_date, user.last_activity, user.total_requests, 
+             user.total_analyses, user.subscription_tier, json.dumps(user.settings),
+             user.license_key, user.daily_requests_used, user.last_request_date)
+    
+    async def save_users_batch(self, users: List[User]):
+        """حفظ دفعة مستخدمين بعملية واحدة - COPY لجدول مؤقت ثم upsert"""
+        if not users:
+            return
+        
+        records = [
+            (user.user_id, user.username, user.first_name, user.is_activated,
+             user.activation_date, user.last_activity, user.total_requests,
+             user.total_analyses, user.subscription_tier, json.dumps(user.settings),
+             user.license_key, user.daily_requests_used, user.last_request_date)
+            for user in users
+        ]
+        
+        async with self.connection() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    CREATE TEMP TABLE users_flush (
+                        user_id BIGINT,
+                        username TEXT,
+                        first_name TEXT,
+                        is_activated BOOLEAN,
+                        activation_date TIMESTAMP,
+                        last_activity TIMESTAMP,
+                        total_requests INTEGER,
+                        total_analyses INTEGER,
+                        subscription_tier TEXT,
+                        settings JSONB,
+                        license_key TEXT,
+                        daily_requests_used INTEGER,
+                        last_request_date DATE
+                    ) ON COMMIT DROP
+                """)
+                await conn.copy_records_to_table('users_flush', records=records)
                 await conn.execute("""
                     INSERT INTO users (user_id, username, first_name, is_activated, activation_date, 
                                      last_activity, total_requests, total_analyses, subscription_tier, 
                                      settings, license_key, daily_requests_used, last_request_date, updated_at)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, NOW())
+                    SELECT user_id, username, first_name, is_activated, activation_date,
+                           last_activity, total_requests, total_analyses, subscription_tier,
+                           settings, license_key, daily_requests_used, last_request_date, NOW()
+                    FROM users_flush
                     ON CONFLICT (user_id) DO UPDATE SET
                         username = EXCLUDED.username,
                         first_name = EXCLUDED.first_name,
@@ -384,20 +791,12 @@ class UltraSimpleDatabaseManager:
                         daily_requests_used = EXCLUDED.daily_requests_used,
                         last_request_date = EXCLUDED.last_request_date,
                         updated_at = NOW()
-                """, user.user_id, user.username, user.first_name, user.is_activated, 
-                     user.activation_date, user.last_activity, user.total_requests, 
-                     user.total_analyses, user.subscription_tier, json.dumps(user.settings),
-                     user.license_key, user.daily_requests_used, user.last_request_date)
-            finally:
-                await conn.close()
-        except Exception as e:
-            logger.error(f"Error saving user {user.user_id}: {e}")
+                """)
     
     async def get_user(self, user_id: int) -> Optional[User]:
-        """جلب بيانات المستخدم - مباشر"""
+        """جلب بيانات المستخدم"""
         try:
-            conn = await self.get_connection()
-            try:
+            async with self.connection() as conn:
                 row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
                 if row:
                     return User(
@@ -415,17 +814,14 @@ class UltraSimpleDatabaseManager:
                         daily_requests_used=row['daily_requests_used'],
                         last_request_date=row['last_request_date']
                     )
-            finally:
-                await conn.close()
         except Exception as e:
             logger.error(f"Error getting user {user_id}: {e}")
         return None
     
     async def get_all_users(self) -> List[User]:
-        """جلب جميع المستخدمين - مباشر"""
+        """جلب جميع المستخدمين"""
         try:
-            conn = await self.get_connection()
-            try:
+            async with self.connection() as conn:
                 rows = await conn.fetch("SELECT * FROM users")
                 users = []
                 for row in rows:
@@ -445,17 +841,14 @@ class UltraSimpleDatabaseManager:
                         last_request_date=row['last_request_date']
                     ))
                 return users
-            finally:
-                await conn.close()
         except Exception as e:
             logger.error(f"Error getting all users: {e}")
             return []
     
     async def save_license_key(self, license_key: LicenseKey):
-        """حفظ/تحديث مفتاح التفعيل - مباشر"""
+        """حفظ/تحديث مفتاح التفعيل"""
         try:
-            conn = await self.get_connection()
-            try:
+            async with self.connection() as conn:
                 await conn.execute("""
                     INSERT INTO license_keys (key, created_date, total_limit, used_total, 
                                             is_active, user_id, username, notes, updated_at)
@@ -471,16 +864,13 @@ class UltraSimpleDatabaseManager:
                 """, license_key.key, license_key.created_date, license_key.total_limit,
                      license_key.used_total, license_key.is_active, license_key.user_id,
                      license_key.username, license_key.notes)
-            finally:
-                await conn.close()
         except Exception as e:
             logger.error(f"Error saving license key: {e}")
     
     async def get_license_key(self, key: str) -> Optional[LicenseKey]:
-        """جلب مفتاح تفعيل - مباشر"""
+        """جلب مفتاح تفعيل"""
         try:
-            conn = await self.get_connection()
-            try:
+            async with self.connection() as conn:
                 row = await conn.fetchrow("SELECT * FROM license_keys WHERE key = $1", key)
                 if row:
                     return LicenseKey(
@@ -493,17 +883,107 @@ class UltraSimpleDatabaseManager:
                         username=row['username'],
                         notes=row['notes'] or ''
                     )
-            finally:
-                await conn.close()
         except Exception as e:
             logger.error(f"Error getting license key: {e}")
         return None
     
+    async def deduct_license_points(self, key: str, user_id: int, username: Optional[str],
+                                    points: int) -> Optional[LicenseKey]:
+        """خصم نقاط المفتاح ذرياً داخل SQL - يرجع الصف المحدث أو None إذا رُفض الخصم"""
+        async with self.connection() as conn:
+            row = await conn.fetchrow("""
+                UPDATE license_keys SET
+                    used_total = used_total + $3,
+                    user_id = COALESCE(user_id, $2),
+                    username = CASE WHEN user_id IS NULL THEN $4 ELSE username END,
+                    updated_at = NOW()
+                WHERE key = $1
+                  AND is_active
+                  AND used_total + $3 <= total_limit
+                  AND (user_id IS NULL OR user_id = $2)
+                RETURNING *
+            """, key, user_id, points, username)
+        return self._row_to_license_key(row) if row else None
+    
+    async def charge_request(self, key: str, user: User, points: int,
+                             idempotency_key: Optional[str] = None) -> Optional[LicenseKey]:
+        """خصم النقاط وحفظ نشاط المستخدم في transaction واحدة - None إذا رُفض الخصم
+        
+        يرفع DuplicateRequest إذا سبق حجز idempotency_key
+        """
+        async with self.connection() as conn:
+            async with conn.transaction():
+                if idempotency_key and not await self._claim_idempotency_key(conn, idempotency_key, user.user_id):
+                    raise DuplicateRequest(idempotency_key)
+                
+                row = await conn.fetchrow("""
+                    UPDATE license_keys SET
+                        used_total = used_total + $3,
+                        user_id = COALESCE(user_id, $2),
+                        username = CASE WHEN user_id IS NULL THEN $4 ELSE username END,
+                        updated_at = NOW()
+                    WHERE key = $1
+                      AND is_active
+                      AND used_total + $3 <= total_limit
+                      AND (user_id IS NULL OR user_id = $2)
+                    RETURNING *
+                """, key, user.user_id, points, user.username)
+                if row is None:
+                    return None
+                await self._upsert_user(conn, user)
+        return self._row_to_license_key(row)
+    
+    @staticmethod
+    async def _claim_idempotency_key(conn, idempotency_key: str, user_id: int) -> bool:
+        claimed = await conn.fetchval("""
+            INSERT INTO idempotency_keys (key, user_id) VALUES ($1, $2)
+            ON CONFLICT (key) DO NOTHING
+            RETURNING key
+        """, idempotency_key, user_id)
+        return claimed is not None
+    
+    async def claim_idempotency_key(self, idempotency_key: str, user_id: int) -> bool:
+        """حجز مفتاح طلب بدون خصم - False إذا سبق تنفيذه"""
+        async with self.connection() as conn:
+            return await self._claim_idempotency_key(conn, idempotency_key, user_id)
+    
+    async def purge_idempotency_keys(self, older_than_hours: int) -> int:
+        async with self.connection() as conn:
+            result = await conn.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < NOW() - make_interval(hours => $1)",
+                older_than_hours
+            )
+        return int(result.split()[-1])
+    
+    async def refund_license_points(self, key: str, points: int) -> Optional[LicenseKey]:
+        """إرجاع نقاط طلب فشل"""
+        async with self.connection() as conn:
+            row = await conn.fetchrow("""
+                UPDATE license_keys SET
+                    used_total = GREATEST(used_total - $2, 0),
+                    updated_at = NOW()
+                WHERE key = $1
+                RETURNING *
+            """, key, points)
+        return self._row_to_license_key(row) if row else None
+    
+    @staticmethod
+    def _row_to_license_key(row) -> LicenseKey:
+        return LicenseKey(
+            key=row['key'],
+            created_date=row['created_date'],
+            total_limit=row['total_limit'],
+            used_total=row['used_total'],
+            is_active=row['is_active'],
+            user_id=row['user_id'],
+            username=row['username'],
+            notes=row['notes'] or ''
+        )
+    
     async def get_all_license_keys(self) -> Dict[str, LicenseKey]:
-        """جلب جميع مفاتيح التفعيل - مباشر"""
+        """جلب جميع مفاتيح التفعيل"""
         try:
-            conn = await self.get_connection()
-            try:
+            async with self.connection() as conn:
                 rows = await conn.fetch("SELECT * FROM license_keys")
                 keys = {}
                 for row in rows:
@@ -518,17 +998,14 @@ class UltraSimpleDatabaseManager:
                         notes=row['notes'] or ''
                     )
                 return keys
-            finally:
-                await conn.close()
         except Exception as e:
             logger.error(f"Error getting all license keys: {e}")
             return {}
     
     async def save_analysis(self, analysis: Analysis):
-        """حفظ تحليل - مباشر"""
+        """حفظ تحليل"""
         try:
-            conn = await self.get_connection()
-            try:
+            async with self.connection() as conn:
                 await conn.execute("""
                     INSERT INTO analyses (id, user_id, timestamp, analysis_type, prompt, result, 
                                         gold_price, image_data, indicators)
@@ -537,10 +1014,173 @@ class UltraSimpleDatabaseManager:
                 """, analysis.id, analysis.user_id, analysis.timestamp, analysis.analysis_type,
                      analysis.prompt, analysis.result, analysis.gold_price, analysis.image_data,
                      json.dumps(analysis.indicators))
-            finally:
-                await conn.close()
         except Exception as e:
             logger.error(f"Error saving analysis: {e}")
+    
+    async def create_broadcast(self, message: str, created_by: int,
+                               owner: str, lease_seconds: int) -> Dict[str, Any]:
+        """تسجيل بث جديد مع عدد المستلمين الحالي - محجوز للنسخة التي أنشأته"""
+        async with self.connection() as conn:
+            row = await conn.fetchrow("""
+                INSERT INTO broadcasts (message, created_by, total, owner, lease_until)
+                VALUES ($1, $2, (SELECT COUNT(*) FROM users), $3, NOW() + make_interval(secs => $4))
+                RETURNING *
+            """, message, created_by, owner, float(lease_seconds))
+        return dict(row)
+    
+    async def claim_broadcasts(self, owner: str, lease_seconds: int) -> List[Dict[str, Any]]:
+        """حجز البث غير المكتمل الذي لا تملكه نسخة حية - SKIP LOCKED يمنع استئنافه مرتين"""
+        async with self.connection() as conn:
+            rows = await conn.fetch("""
+                UPDATE broadcasts SET owner = $1, lease_until = NOW() + make_interval(secs => $2)
+                WHERE id IN (
+                    SELECT id FROM broadcasts
+                    WHERE status = 'running' AND (lease_until IS NULL OR lease_until < NOW())
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+            """, owner, float(lease_seconds))
+        return [dict(row) for row in rows]
+    
+    async def release_broadcasts(self, owner: str) -> int:
+        """فك حجز البث عند الإيقاف - نسخة أخرى تستأنفه فوراً بدل انتظار انتهاء الـ lease"""
+        async with self.connection() as conn:
+            result = await conn.execute("""
+                UPDATE broadcasts SET owner = NULL, lease_until = NULL
+                WHERE owner = $1 AND status = 'running'
+            """, owner)
+        return int(result.split()[-1])
+    
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int) -> List[int]:
+        """صفحة المستلمين التالية بمؤشر keyset على المفتاح الأساسي - بدون OFFSET"""
+        async with self.connection() as conn:
+            rows = await conn.fetch("""
+                SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2
+            """, after_user_id, limit)
+        return [row['user_id'] for row in rows]
+    
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int,
+                                      sent: int, failed: int, blocked: int,
+                                      owner: str, lease_seconds: int,
+                                      status: str = 'running') -> bool:
+        """حفظ تقدم البث بعد كل صفحة وتجديد الحجز - الاستئناف يبدأ من last_user_id
+        
+        False إذا لم تعد هذه النسخة مالكة البث (انتهى الحجز واستأنفته نسخة أخرى)
+        """
+        async with self.connection() as conn:
+            result = await conn.execute("""
+                UPDATE broadcasts SET
+                    last_user_id = $2, sent = $3, failed = $4, blocked = $5, status = $6,
+                    finished_at = CASE WHEN $6 = 'running' THEN NULL ELSE NOW() END,
+                    lease_until = CASE WHEN $6 = 'running' THEN NOW() + make_interval(secs => $8) ELSE NULL END,
+                    updated_at = NOW()
+                WHERE id = $1 AND owner = $7
+            """, broadcast_id, last_user_id, sent, failed, blocked, status, owner, float(lease_seconds))
+        return result.split()[-1] != '0'
+    
+    async def get_broadcasts(self, status: Optional[str] = None, limit: int = 5) -> List[Dict[str, Any]]:
+        async with self.connection() as conn:
+            if status:
+                rows = await conn.fetch(
+                    "SELECT * FROM broadcasts WHERE status = $1 ORDER BY id DESC LIMIT $2", status, limit
+                )
+            else:
+                rows = await conn.fetch("SELECT * FROM broadcasts ORDER BY id DESC LIMIT $1", limit)
+        return [dict(row) for row in rows]
+
+    async def enqueue_analysis_job(self, job: Dict[str, Any]) -> int:
+        """حفظ مهمة تحليل في الطابور - ترجع رقم المهمة"""
+        async with self.connection() as conn:
+            return await conn.fetchval("""
+                INSERT INTO analysis_jobs (user_id, chat_id, message_id, source, analysis_type, label,
+                                           prompt, image_file_id, license_key, points, priority)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+                RETURNING id
+            """, job['user_id'], job['chat_id'], job['message_id'], job['source'], job['analysis_type'],
+                 job.get('label'), job['prompt'], job.get('image_file_id'), job.get('license_key'),
+                 job.get('points', 0), job.get('priority', int(AnalysisPriority.STANDARD)))
+    
+    async def claim_analysis_job(self) -> Optional[Dict[str, Any]]:
+        """حجز أعلى مهمة جاهزة - SKIP LOCKED يمنع تعارض العمال والنسخ المتعددة"""
+        async with self.connection() as conn:
+            row = await conn.fetchrow("""
+                UPDATE analysis_jobs SET
+                    status = 'running', attempts = attempts + 1, locked_at = NOW()
+                WHERE id = (
+                    SELECT id FROM analysis_jobs
+                    WHERE status = 'queued' AND available_at <= NOW()
+                    ORDER BY priority, available_at, id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING *
+            """)
+        return dict(row) if row else None
+    
+    async def touch_analysis_job(self, job_id: int) -> bool:
+        """تجديد الـ lease لمهمة جارية - False إذا لم تعد المهمة محجوزة"""
+        async with self.connection() as conn:
+            result = await conn.execute("""
+                UPDATE analysis_jobs SET locked_at = NOW()
+                WHERE id = $1 AND status = 'running'
+            """, job_id)
+        return result.split()[-1] != '0'
+    
+    async def finish_analysis_job(self, job_id: int, status: str, error: Optional[str] = None) -> bool:
+        """إنهاء المهمة: 'done' بعد التسليم أو 'dead' بعد استنفاد المحاولات
+        
+        شرط 'running' يمنع عاملاً انتهى الـ lease الخاص به من الكتابة فوق نتيجة عامل آخر
+        """
+        async with self.connection() as conn:
+            result = await conn.execute("""
+                UPDATE analysis_jobs SET status = $2, last_error = COALESCE($3, last_error),
+                    locked_at = NULL, finished_at = NOW()
+                WHERE id = $1 AND status = 'running'
+            """, job_id, status, error)
+        return result.split()[-1] != '0'
+    
+    async def retry_analysis_job(self, job_id: int, delay: float, error: str) -> bool:
+        async with self.connection() as conn:
+            result = await conn.execute("""
+                UPDATE analysis_jobs SET status = 'queued', last_error = $3, locked_at = NULL,
+                    available_at = NOW() + make_interval(secs => $2)
+                WHERE id = $1 AND status = 'running'
+            """, job_id, delay, error)
+        return result.split()[-1] != '0'
+    
+    async def requeue_analysis_jobs(self, job_ids: List[int]) -> int:
+        """إرجاع مهام قُطعت بإيقاف البوت - لا تُحتسب كمحاولة"""
+        if not job_ids:
+            return 0
+        async with self.connection() as conn:
+            result = await conn.execute("""
+                UPDATE analysis_jobs SET status = 'queued', attempts = GREATEST(attempts - 1, 0),
+                    locked_at = NULL, available_at = NOW()
+                WHERE id = ANY($1::bigint[]) AND status = 'running'
+            """, job_ids)
+        return int(result.split()[-1])
+    
+    async def recover_analysis_jobs(self, lease_seconds: int, exclude_ids: Optional[List[int]] = None) -> int:
+        """إعادة المهام العالقة في 'running' بعد توقف مفاجئ لنسخة البوت التي حجزتها
+        
+        exclude_ids: مهام تنفذها هذه النسخة حالياً - لا تُستعاد حتى لو تأخر تجديد الـ lease
+        """
+        async with self.connection() as conn:
+            result = await conn.execute("""
+                UPDATE analysis_jobs SET status = 'queued', locked_at = NULL, available_at = NOW()
+                WHERE status = 'running' AND locked_at < NOW() - make_interval(secs => $1)
+                  AND NOT (id = ANY($2::bigint[]))
+            """, float(lease_seconds), exclude_ids or [])
+        return int(result.split()[-1])
+    
+    async def get_analysis_job_counts(self) -> Dict[str, int]:
+        async with self.connection() as conn:
+            rows = await conn.fetch("""
+                SELECT status, COUNT(*) AS count FROM analysis_jobs
+                WHERE status IN ('queued', 'running', 'dead')
+                GROUP BY status
+            """)
+        return {row['status']: row['count'] for row in rows}
 
 # ==================== Ultra Simple License Manager ====================
 class UltraSimpleLicenseManager:
@@ -619,7 +1259,7 @@ class UltraSimpleLicenseManager:
         return True, f"مفتاح صالح"
     
     async def use_key(self, key: str, user_id: int, username: str = None, request_type: str = "analysis", points_to_deduct: int = 1) -> Tuple[bool, str]:
-        """استخدام المفتاح مع إمكانية خصم نقاط متعددة - مباشر"""
+        """استخدام المفتاح مع إمكانية خصم نقاط متعددة - خصم ذري في قاعدة البيانات"""
         is_valid, message = await self.validate_key(key, user_id)
         
         if not is_valid:
@@ -629,49 +1269,110 @@ class UltraSimpleLicenseManager:
         
         # فحص إذا كانت النقاط المتبقية كافية
         if key_data["used"] + points_to_deduct > key_data["limit"]:
-            remaining = key_data["limit"] - key_data["used"]
-            return False, f"نقاط غير كافية للتحليل الشامل\nتحتاج {points_to_deduct} نقاط ولديك {remaining} فقط\nللحصول على مفتاح جديد: @Odai_xau"
-        
-        # ربط المستخدم بالمفتاح إذا لم يكن مربوطاً
-        if not key_data["user_id"]:
-            key_data["user_id"] = user_id
-            key_data["username"] = username
-        
-        # خصم النقاط المطلوبة
-        key_data["used"] += points_to_deduct
-        
-        # حفظ التحديث - مباشر
-        license_key = LicenseKey(
-            key=key,
-            created_date=datetime.now(),
-            total_limit=key_data["limit"],
-            used_total=key_data["used"],
-            is_active=key_data["active"],
-            user_id=key_data["user_id"],
-            username=key_data["username"],
-            notes="مفتاح ثابت مُحدث"
-        )
+            return False, self._insufficient_points_message(key_data, points_to_deduct)
+        
+        # خصم النقاط بعملية UPDATE ... RETURNING واحدة - آمن مع عدة عمليات متزامنة
+        try:
+            updated_key = await self.database.deduct_license_points(key, user_id, username, points_to_deduct)
+        except Exception as e:
+            logger.error(f"Error deducting points from key: {e}")
+            return False, "خطأ مؤقت في استخدام المفتاح، حاول مرة أخرى"
+        
+        if updated_key is None:
+            # تغيرت حالة المفتاح من طلب/عامل آخر - تحديث النسخة المحلية وإرجاع السبب الفعلي
+            await self.refresh_key(key)
+            is_valid, message = await self.validate_key(key, user_id)
+            if not is_valid:
+                return False, message
+            return False, self._insufficient_points_message(self.license_keys[key], points_to_deduct)
+        
+        self._mirror_key(updated_key)
+        return True, self._usage_message(self.license_keys[key], points_to_deduct)
+    
+    async def check_quota(self, key: str, user_id: int, points: int) -> Tuple[bool, str]:
+        """فحص المفتاح والنقاط من النسخة المحلية - القاعدة تُسأل فقط قبل رفض بنقاط غير كافية"""
+        is_valid, message = await self.validate_key(key, user_id)
+        if not is_valid:
+            return False, message
+        if self.license_keys[key]["used"] + points > self.license_keys[key]["limit"]:
+            # النسخة المحلية قد تكون قديمة (استرداد تم في نسخة أخرى من البوت)
+            try:
+                await self.refresh_key(key)
+            except Exception as e:
+                logger.warning(f"Error refreshing key before quota rejection: {e}")
+            if self.license_keys[key]["used"] + points > self.license_keys[key]["limit"]:
+                return False, self._insufficient_points_message(self.license_keys[key], points)
+        return True, message
+    
+    async def charge(self, key: str, user: User, points: int,
+                     idempotency_key: Optional[str] = None) -> Tuple[bool, str]:
+        """خصم النقاط مع حفظ نشاط المستخدم في نفس الـ transaction"""
+        try:
+            updated_key = await self.database.charge_request(key, user, points, idempotency_key)
+        except DuplicateRequest:
+            raise
+        except Exception as e:
+            logger.error(f"Error charging key: {e}")
+            return False, "خطأ مؤقت في استخدام المفتاح، حاول مرة أخرى"
         
-        await self.database.save_license_key(license_key)
+        if updated_key is None:
+            await self.refresh_key(key)
+            ok, message = await self.check_quota(key, user.user_id, points)
+            return False, message if not ok else self._insufficient_points_message(self.license_keys[key], points)
         
+        self._mirror_key(updated_key)
+        return True, self._usage_message(self.license_keys[key], points)
+    
+    async def refund(self, key: str, points: int) -> bool:
+        """إرجاع النقاط بعد فشل التحليل"""
+        try:
+            updated_key = await self.database.refund_license_points(key, points)
+        except Exception as e:
+            logger.error(f"Error refunding {points} points to key: {e}")
+            return False
+        if updated_key:
+            self._mirror_key(updated_key)
+        return updated_key is not None
+    
+    def _usage_message(self, key_data: Dict, points_to_deduct: int) -> str:
         remaining = key_data["limit"] - key_data["used"]
         
         if points_to_deduct > 1:
             # رسالة خاصة للتحليل الشامل
             if remaining == 0:
-                return True, f"تم خصم {points_to_deduct} نقاط للتحليل الشامل المتقدم\nانتهت صلاحية المفتاح!\nللحصول على مفتاح جديد: @Odai_xau"
+                return f"تم خصم {points_to_deduct} نقاط للتحليل الشامل المتقدم\nانتهت صلاحية المفتاح!\nللحصول على مفتاح جديد: @Odai_xau"
             elif remaining <= 5:
-                return True, f"تم خصم {points_to_deduct} نقاط للتحليل الشامل المتقدم\nتبقى {remaining} نقاط فقط!"
+                return f"تم خصم {points_to_deduct} نقاط للتحليل الشامل المتقدم\nتبقى {remaining} نقاط فقط!"
             else:
-                return True, f"تم خصم {points_to_deduct} نقاط للتحليل الشامل المتقدم\nالنقاط المتبقية: {remaining} من {key_data['limit']}"
+                return f"تم خصم {points_to_deduct} نقاط للتحليل الشامل المتقدم\nالنقاط المتبقية: {remaining} من {key_data['limit']}"
         else:
             # رسالة عادية للتحليلات الأخرى
             if remaining == 0:
-                return True, f"تم استخدام المفتاح بنجاح\nهذا آخر سؤال! انتهت صلاحية المفتاح\nللحصول على مفتاح جديد: @Odai_xau"
+                return f"تم استخدام المفتاح بنجاح\nهذا آخر سؤال! انتهت صلاحية المفتاح\nللحصول على مفتاح جديد: @Odai_xau"
             elif remaining <= 5:
-                return True, f"تم استخدام المفتاح بنجاح\nتبقى {remaining} أسئلة فقط!"
+                return f"تم استخدام المفتاح بنجاح\nتبقى {remaining} أسئلة فقط!"
             else:
-                return True, f"تم استخدام المفتاح بنجاح\nالأسئلة المتبقية: {remaining} من {key_data['limit']}"
+                return f"تم استخدام المفتاح بنجاح\nالأسئلة المتبقية: {remaining} من {key_data['limit']}"
+    
+    def _insufficient_points_message(self, key_data: Dict, points_to_deduct: int) -> str:
+        remaining = key_data["limit"] - key_data["used"]
+        return f"نقاط غير كافية للتحليل الشامل\nتحتاج {points_to_deduct} نقاط ولديك {remaining} فقط\nللحصول على مفتاح جديد: @Odai_xau"
+    
+    def _mirror_key(self, license_key: LicenseKey):
+        """تحديث النسخة المحلية من صف قاعدة البيانات"""
+        self.license_keys[license_key.key] = {
+            "limit": license_key.total_limit,
+            "used": license_key.used_total,
+            "active": license_key.is_active,
+            "user_id": license_key.user_id,
+            "username": license_key.username
+        }
+    
+    async def refresh_key(self, key: str):
+        """إعادة تحميل مفتاح واحد من قاعدة البيانات"""
+        license_key = await self.database.get_license_key(key)
+        if license_key:
+            self._mirror_key(license_key)
     
     async def get_key_info(self, key: str) -> Optional[Dict]:
         """الحصول على معلومات المفتاح"""
@@ -713,10 +1414,107 @@ class UltraSimpleLicenseManager:
             'avg_usage_per_key': total_usage / total_keys if total_keys > 0 else 0
         }
 
+# ==================== User Write-Behind Queue ====================
+class UserWriteBehindQueue:
+    """تجميع تحديثات المستخدمين في الذاكرة وحفظها دفعة واحدة"""
+    
+    FINAL_FLUSH_ATTEMPTS = 3
+    
+    def __init__(self, database_manager: UltraSimpleDatabaseManager,
+                 flush_interval: float = Config.USER_FLUSH_INTERVAL,
+                 max_batch: int = Config.USER_FLUSH_BATCH_SIZE):
+        self.database = database_manager
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.dirty: Dict[int, User] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.flushes = 0
+        self.flushed_users = 0
+        self.coalesced_writes = 0
+    
+    def mark_dirty(self, user: User):
+        """تعليم المستخدم للحفظ في الدفعة القادمة"""
+        if user.user_id in self.dirty:
+            self.coalesced_writes += 1
+        self.dirty[user.user_id] = user
+        
+        if len(self.dirty) >= self.max_batch and self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def start(self):
+        """تشغيل مهمة الحفظ الدوري"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    async def flush(self) -> bool:
+        """حفظ كل المستخدمين المعلّمين بعملية واحدة - False إذا بقيت الدفعة معلّقة"""
+        async with self._flush_lock:
+            if not self.dirty:
+                return True
+            
+            batch, self.dirty = self.dirty, {}
+            saved = False
+            try:
+                await self.database.save_users_batch(list(batch.values()))
+                saved = True
+                self.flushes += 1
+                self.flushed_users += len(batch)
+            except Exception as e:
+                logger.error(f"Error flushing {len(batch)} users: {e}")
+            finally:
+                if not saved:
+                    # إرجاعهم للدفعة القادمة دون الكتابة فوق تحديث أحدث - حتى عند الإلغاء
+                    for user_id, user in batch.items():
+                        self.dirty.setdefault(user_id, user)
+            return saved
+    
+    async def stop(self):
+        """إيقاف المهمة بعد إكمال الحفظ الجاري ثم حفظ نهائي مع إعادة المحاولة"""
+        if self._task is not None:
+            # بدون cancel - دفعة قيد الحفظ تكتمل بدل أن تُقطع
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        
+        for attempt in range(self.FINAL_FLUSH_ATTEMPTS):
+            if await self.flush():
+                return
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        
+        # الدفعة فشلت كاملة - الحفظ فرداً يعزل المستخدم الذي يسبب الخطأ
+        pending, self.dirty = self.dirty, {}
+        logger.warning(f"Final batch flush failed, saving {len(pending)} users one by one")
+        for user in pending.values():
+            await self.database.save_user(user)
+    
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            'pending': len(self.dirty),
+            'flushes': self.flushes,
+            'flushed_users': self.flushed_users,
+            'coalesced_writes': self.coalesced_writes
+        }
+
 # ==================== Ultra Simple Database Manager ====================
 class UltraSimpleDBManager:
-    def __init__(self, database_manager: UltraSimpleDatabaseManager):
+    def __init__(self, database_manager: UltraSimpleDatabaseManager,
+                 write_behind: Optional[UserWriteBehindQueue] = None):
         self.database = database_manager
+        self.write_behind = write_behind
         self.users: Dict[int, User] = {}
         self.analyses: List[Analysis] = []
         
@@ -730,10 +1528,13 @@ class UltraSimpleDBManager:
             print(f"خطأ في تحميل المستخدمين: {e}")
             self.users = {}
     
-    async def add_user(self, user: User):
-        """إضافة/تحديث مستخدم - مباشر"""
+    async def add_user(self, user: User, immediate: bool = False):
+        """إضافة/تحديث مستخدم - مؤجل عبر write-behind ما لم يُطلب الحفظ الفوري"""
         self.users[user.user_id] = user
-        await self.database.save_user(user)
+        if self.write_behind is not None and not immediate:
+            self.write_behind.mark_dirty(user)
+        else:
+            await self.database.save_user(user)
     
     async def get_user(self, user_id: int) -> Optional[User]:
         """جلب مستخدم - مباشر"""
@@ -770,140 +1571,1407 @@ class UltraSimpleDBManager:
                 'total_analyses': 0, 'recent_analyses': 0
             }
 
+# ==================== Bounded TTL + LRU Cache ====================
+class BoundedTTLCache:
+    """تخزين مؤقت محدود بعدد العناصر والحجم - LRU مع انتهاء صلاحية"""
+    
+    def __init__(self, name: str, max_entries: int, max_bytes: int, default_ttl: float,
+                 sweep_interval: float = Config.CACHE_SWEEP_INTERVAL):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.sweep_interval = sweep_interval
+        # key -> (value, expires_at, size_bytes)
+        self._data: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        self.current_bytes = 0
+        self._sweeper: Optional[asyncio.Task] = None
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @staticmethod
+    def _sizeof(key: str, value: Any) -> int:
+        if isinstance(value, str):
+            size = len(value.encode('utf-8'))
+        elif isinstance(value, (bytes, bytearray)):
+            size = len(value)
+        else:
+            size = sys.getsizeof(value)
+        return size + len(key)
+    
+    def _remove(self, key: str):
+        _, _, size = self._data.pop(key)
+        self.current_bytes -= size
+    
+    def get(self, key: str) -> Optional[Any]:
+        """جلب قيمة مع تحديث ترتيب الاستخدام"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        value, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """حفظ قيمة مع إخراج الأقدم استخداماً عند تجاوز الحدود"""
+        size = self._sizeof(key, value)
+        if size > self.max_bytes:
+            return
+        
+        if key in self._data:
+            self._remove(key)
+        
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.default_ttl)
+        self._data[key] = (value, expires_at, size)
+        self.current_bytes += size
+        
+        while len(self._data) > self.max_entries or self.current_bytes > self.max_bytes:
+            _, (_, _, old_size) = self._data.popitem(last=False)
+            self.current_bytes -= old_size
+            self.evictions += 1
+    
+    def keys(self) -> List[str]:
+        return list(self._data.keys())
+    
+    def sweep(self) -> int:
+        """حذف كل العناصر المنتهية"""
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at, _) in self._data.items() if expires_at <= now]
+        for key in expired:
+            self._remove(key)
+        self.expirations += len(expired)
+        return len(expired)
+    
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Cache sweep error ({self.name}): {e}")
+    
+    async def start(self):
+        """تشغيل المنظف الخلفي"""
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+    
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'bytes': self.current_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': (self.hits / lookups * 100) if lookups else 0.0
+        }
+
 # ==================== Fixed Cache System ====================
 class FixedCacheManager:
     def __init__(self):
-        self.price_cache: Optional[Tuple[GoldPrice, datetime]] = None
-        self.analysis_cache: Dict[str, Tuple[str, datetime]] = {}
-        self.image_cache: Dict[str, Tuple[str, datetime]] = {}
+        self.price_cache: Optional[Tuple[GoldPrice, float]] = None
+        self.analysis_cache = BoundedTTLCache(
+            "analysis", Config.ANALYSIS_CACHE_MAX_ENTRIES,
+            Config.ANALYSIS_CACHE_MAX_BYTES, Config.ANALYSIS_CACHE_TTL
+        )
+        self.image_cache = BoundedTTLCache(
+            "image", Config.IMAGE_CACHE_MAX_ENTRIES,
+            Config.IMAGE_CACHE_MAX_BYTES, Config.CHART_DEDUP_WINDOW
+        )
     
     def get_price(self) -> Optional[GoldPrice]:
         """جلب السعر من التخزين المؤقت"""
         if self.price_cache:
-            price, timestamp = self.price_cache
-            if datetime.now() - timestamp < timedelta(seconds=Config.PRICE_CACHE_TTL):
+            price, stored_at = self.price_cache
+            if time.monotonic() - stored_at < Config.PRICE_CACHE_TTL:
                 return price
         return None
     
     def set_price(self, price: GoldPrice):
         """حفظ السعر في التخزين المؤقت"""
-        self.price_cache = (price, datetime.now())
+        self.price_cache = (price, time.monotonic())
     
     def get_analysis(self, key: str) -> Optional[str]:
         """جلب التحليل من cache"""
-        if key in self.analysis_cache:
-            result, timestamp = self.analysis_cache[key]
-            if datetime.now() - timestamp < timedelta(seconds=Config.ANALYSIS_CACHE_TTL):
-                return result
-            else:
-                del self.analysis_cache[key]
-        return None
+        return self.analysis_cache.get(key)
     
-    def set_analysis(self, key: str, result: str):
+    def set_analysis(self, key: str, result: str, ttl: Optional[float] = None):
         """حفظ التحليل في cache"""
-        self.analysis_cache[key] = (result, datetime.now())
-
-# ==================== Fixed Gold Price Manager ====================
-class FixedGoldPriceManager:
-    def __init__(self, cache_manager: FixedCacheManager):
-        self.cache = cache_manager
-        self.session: Optional[aiohttp.ClientSession] = None
+        self.analysis_cache.set(key, result, ttl)
     
-    async def get_session(self) -> aiohttp.ClientSession:
+    async def start(self):
+        await self.analysis_cache.start()
+        await self.image_cache.start()
+    
+    async def stop(self):
+        await self.analysis_cache.stop()
+        await self.image_cache.stop()
+
+# ==================== Analysis Cache Keys ====================
+# تطبيع النص العربي/اللاتيني حتى تتطابق الصيغ المتقاربة لنفس السؤال
+_ARABIC_DIACRITICS_RE = re.compile(r'[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED]')
+_ARABIC_CHAR_MAP = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    'ـ': None,  # tatweel
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9'
+})
+# علامات الترقيم - مع الإبقاء على الفاصلة العشرية بين رقمين
+_PUNCTUATION_RE = re.compile(r'(?!(?<=\d)\.(?=\d))[^\w\s]')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_prompt_text(text: str) -> str:
+    """تطبيع نص الطلب: الحركات، التطويل، أشكال الألف والياء، المسافات وحالة الأحرف"""
+    if not text:
+        return ""
+    
+    text = unicodedata.normalize('NFKC', text)
+    text = _ARABIC_DIACRITICS_RE.sub('', text)
+    text = text.translate(_ARABIC_CHAR_MAP)
+    text = _PUNCTUATION_RE.sub(' ', text.casefold())
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+def analysis_cache_bucket(price: float, analysis_type: AnalysisType) -> Tuple[str, float]:
+    """دلو السعر والوقت لنوع التحليل - يرجع (الدلو، مدة الصلاحية المتبقية)"""
+    policy = ANALYSIS_CACHE_POLICIES.get(analysis_type)
+    if policy is None or policy.time_bucket <= 0:
+        return f"{price:.2f}", Config.ANALYSIS_CACHE_TTL
+    
+    now = time.time()
+    time_slot = int(now // policy.time_bucket)
+    remaining_ttl = policy.time_bucket - (now % policy.time_bucket)
+    
+    if policy.price_band > 0:
+        price_slot = f"{round(price / (policy.price_band * 2))}x{policy.price_band:g}"
+    else:
+        price_slot = f"{price:.2f}"
+    
+    return f"{price_slot}@{time_slot}", remaining_ttl
+
+def build_analysis_cache_key(prompt: str, analysis_type: AnalysisType, price_bucket: str) -> str:
+    """مفتاح ثابت بين العمليات وإعادة التشغيل - لا يعتمد على hash() العشوائي"""
+    material = "|".join((
+        Config.CLAUDE_MODEL,
+        analysis_type.value,
+        price_bucket,
+        normalize_prompt_text(prompt)
+    ))
+    digest = hashlib.blake2b(material.encode('utf-8'), digest_size=16).hexdigest()
+    return f"analysis:{analysis_type.value}:{digest}"
+
+# أكثر من بتين يطابق شارتات بشموع أخيرة مختلفة
+CHART_DEDUP_DISTANCE_LIMIT = 2
+
+class ChartDedupIndex:
+    """فهرس بصمات الشارتات - نفس الشارت بنفس نية التعليق ونفس دلو السعر يعيد التحليل المخزن"""
+    
+    def __init__(self, cache: BoundedTTLCache,
+                 max_distance: int = Config.CHART_DEDUP_MAX_DISTANCE,
+                 window: float = Config.CHART_DEDUP_WINDOW):
+        self.cache = cache
+        self.max_distance = min(max(max_distance, 0), CHART_DEDUP_DISTANCE_LIMIT)
+        self.window = window
+        
+        self.lookups = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+    
+    @staticmethod
+    def intent_prefix(caption: str, analysis_type: AnalysisType, price_bucket: str) -> str:
+        """دلو السعر جزء من المفتاح - نفس سياسة cache التحليل النصي"""
+        material = "|".join((Config.CLAUDE_MODEL, analysis_type.value, price_bucket, normalize_prompt_text(caption)))
+        digest = hashlib.blake2b(material.encode('utf-8'), digest_size=8).hexdigest()
+        return f"chart:{analysis_type.value}:{digest}:"
+    
+    def resolve_key(self, fingerprint: int, caption: str, analysis_type: AnalysisType, price_bucket: str) -> str:
+        """مفتاح أقرب شارت مخزن ضمن مسافة Hamming المسموحة، أو مفتاح جديد لهذه البصمة"""
+        prefix = self.intent_prefix(caption, analysis_type, price_bucket)
+        best_key = f"{prefix}{fingerprint:016x}"
+        if self.max_distance == 0:
+            return best_key
+        best_distance = self.max_distance + 1
+        
+        for key in self.cache.keys():
+            if not key.startswith(prefix):
+                continue
+            distance = (int(key[len(prefix):], 16) ^ fingerprint).bit_count()
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+                if distance == 0:
+                    break
+        return best_key
+    
+    def get(self, fingerprint: int, caption: str, analysis_type: AnalysisType,
+            price_bucket: str) -> Tuple[str, Optional[str]]:
+        """يرجع (مفتاح الـ cache، التحليل المخزن أو None)"""
+        self.lookups += 1
+        key = self.resolve_key(fingerprint, caption, analysis_type, price_bucket)
+        result = self.cache.get(key)
+        if result is not None:
+            if key.endswith(f"{fingerprint:016x}"):
+                self.exact_hits += 1
+            else:
+                self.near_hits += 1
+        return key, result
+    
+    def get_stats(self) -> Dict[str, Any]:
+        hits = self.exact_hits + self.near_hits
+        return {
+            'entries': len(self.cache),
+            'lookups': self.lookups,
+            'exact_hits': self.exact_hits,
+            'near_hits': self.near_hits,
+            'hit_rate': (hits / self.lookups * 100) if self.lookups else 0.0
+        }
+
+# ==================== Price Tick Store ====================
+# معرفات ثابتة للمصادر - تُحفظ في الملف فلا يتغير ترتيبها
+TICK_SOURCES = ("unknown", "goldapi", "yfinance")
+
+TICK_DTYPE = np.dtype([
+    ('ts', 'f8'),       # epoch بالثواني
+    ('price', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('source', 'u1'),
+])
+
+class PriceTickStore:
+    """سجل أسعار بحجم ثابت على مصفوفة numpy - إضافة O(1) ونوافذ بدون نسخ
+    
+    كل tick يُكتب مرتين (i و i+capacity) فتكون آخر n قيمة دائماً شريحة متصلة.
+    المصفوفة نفسها memmap على القرص فيبقى السجل بعد إعادة التشغيل بدون استعلام.
+    """
+    
+    def __init__(self, capacity: int = Config.TICK_STORE_CAPACITY,
+                 path: Optional[str] = Config.TICK_STORE_PATH,
+                 snapshot_interval: float = Config.TICK_SNAPSHOT_INTERVAL):
+        self.capacity = capacity
+        self.path = path or None
+        self.snapshot_interval = snapshot_interval
+        self.buffer = self._open()
+        self._snapshot_task: Optional[asyncio.Task] = None
+        
+        # استعادة الموضع من الطوابع الزمنية - الإضافات تصاعدية دائماً
+        timestamps = self.buffer['ts'][:capacity]
+        self.size = int(np.count_nonzero(timestamps))
+        self.end = int(np.argmax(timestamps)) + 1 if self.size else 0
+        self.last_ts = float(timestamps.max()) if self.size else 0.0
+        self.dropped = 0
+    
+    def _open(self) -> np.ndarray:
+        shape = (2 * self.capacity,)
+        if self.path is None:
+            return np.zeros(shape, dtype=TICK_DTYPE)
+        
+        if os.path.exists(self.path):
+            try:
+                buffer = np.lib.format.open_memmap(self.path, mode='r+')
+                if buffer.dtype == TICK_DTYPE and buffer.shape == shape:
+                    logger.info(f"Loaded price tick store from {self.path}")
+                    return buffer
+                logger.warning(f"Tick store {self.path} has a different layout - starting a new one")
+            except Exception as e:
+                logger.warning(f"Cannot open tick store {self.path}: {e} - starting a new one")
+        
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        return np.lib.format.open_memmap(self.path, mode='w+', dtype=TICK_DTYPE, shape=shape)
+    
+    def append(self, ts: float, price: float, high: float, low: float, source: str = "unknown") -> bool:
+        """إضافة tick - يُتجاهل إذا لم يكن أحدث من آخر tick (نفس السعر المخزن مثلاً)"""
+        if ts <= self.last_ts:
+            self.dropped += 1
+            return False
+        
+        source_name = source.split(":", 1)[0]
+        source_id = TICK_SOURCES.index(source_name) if source_name in TICK_SOURCES else 0
+        row = (ts, price, high or price, low or price, source_id)
+        
+        position = self.end % self.capacity
+        self.buffer[position] = row
+        self.buffer[position + self.capacity] = row
+        self.end = position + 1
+        self.size = min(self.size + 1, self.capacity)
+        self.last_ts = ts
+        return True
+    
+    def append_price(self, price: GoldPrice) -> bool:
+        return self.append(price.timestamp.timestamp(), price.price, price.high_24h, price.low_24h, price.source)
+    
+    def latest(self, count: Optional[int] = None) -> np.ndarray:
+        """آخر count قيمة بالترتيب الزمني - view على نفس الذاكرة"""
+        count = self.size if count is None else min(count, self.size)
+        stop = self.end + self.capacity
+        return self.buffer[stop - count:stop]
+    
+    def window(self, since: float, until: Optional[float] = None) -> np.ndarray:
+        """الـ ticks بين طابعين زمنيين (epoch) - بحث ثنائي على view بدون نسخ"""
+        ticks = self.latest()
+        timestamps = ticks['ts']
+        start = int(np.searchsorted(timestamps, since, side='left'))
+        stop = len(ticks) if until is None else int(np.searchsorted(timestamps, until, side='right'))
+        return ticks[start:stop]
+    
+    def __len__(self) -> int:
+        return self.size
+    
+    def snapshot(self):
+        """دفع الصفحات المعدلة للقرص"""
+        if isinstance(self.buffer, np.memmap):
+            self.buffer.flush()
+    
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await asyncio.to_thread(self.snapshot)
+            except Exception as e:
+                logger.warning(f"Tick store snapshot failed: {e}")
+    
+    async def start(self):
+        if self.path is not None:
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+    
+    async def close(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            try:
+                await self._snapshot_task
+            except asyncio.CancelledError:
+                pass
+        self.snapshot()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        ticks = self.latest()
+        return {
+            'size': self.size,
+            'capacity': self.capacity,
+            'span_hours': (ticks['ts'][-1] - ticks['ts'][0]) / 3600 if self.size > 1 else 0.0,
+            'persistent': self.path is not None,
+            'dropped': self.dropped
+        }
+
+# ==================== Candle Aggregator ====================
+CANDLE_TIMEFRAMES = {'M5': 300, 'M15': 900, 'H1': 3600, 'H4': 14400, 'D1': 86400}
+
+CANDLE_DTYPE = np.dtype([
+    ('ts', 'f8'),       # بداية الشمعة (epoch)
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('ticks', 'u4'),    # 0 = شمعة من التاريخ المستورد
+])
+
+class CandleSeries:
+    """شموع إطار واحد: الجارية كقيم عادية والمغلقة في حلقة numpy مزدوجة الكتابة"""
+    
+    __slots__ = ('name', 'seconds', 'capacity', 'bars', 'size', 'end',
+                 'start', 'open', 'high', 'low', 'close', 'ticks')
+    
+    def __init__(self, name: str, seconds: int, capacity: int):
+        self.name = name
+        self.seconds = seconds
+        self.capacity = capacity
+        self.bars = np.zeros(2 * capacity, dtype=CANDLE_DTYPE)
+        self.size = 0
+        self.end = 0
+        self.start: Optional[float] = None
+        self.open = self.high = self.low = self.close = 0.0
+        self.ticks = 0
+    
+    def update(self, bucket: float, open_: float, high: float, low: float, close: float, ticks: int) -> bool:
+        """دمج سعر أو شمعة أصغر في الشمعة الجارية - True إذا أُغلقت شمعة"""
+        if self.start is not None and bucket < self.start:
+            return False
+        
+        if self.start is not None and bucket == self.start:
+            self.high = max(self.high, high)
+            self.low = min(self.low, low)
+            self.close = close
+            self.ticks += ticks
+            return False
+        
+        closed = self.start is not None
+        if closed:
+            row = (self.start, self.open, self.high, self.low, self.close, self.ticks)
+            position = self.end % self.capacity
+            self.bars[position] = row
+            self.bars[position + self.capacity] = row
+            self.end = position + 1
+            self.size = min(self.size + 1, self.capacity)
+        
+        self.start = bucket
+        self.open, self.high, self.low, self.close = open_, high, low, close
+        self.ticks = ticks
+        return closed
+    
+    def closed(self, count: Optional[int] = None) -> np.ndarray:
+        """آخر count شمعة مغلقة بالترتيب الزمني - view بدون نسخ"""
+        count = self.size if count is None else min(count, self.size)
+        stop = self.end + self.capacity
+        return self.bars[stop - count:stop]
+    
+    def current(self) -> Optional[Tuple[float, float, float, float, float, int]]:
+        if self.start is None:
+            return None
+        return (self.start, self.open, self.high, self.low, self.close, self.ticks)
+
+class CandleAggregator:
+    """شموع M5/M15/H1/H4/D1 تُحدَّث تدريجياً من كل سعر - حدود الشموع حسب Config.TIMEZONE"""
+    
+    def __init__(self, tick_store: Optional[PriceTickStore] = None,
+                 timezone=Config.TIMEZONE,
+                 capacity: int = Config.CANDLE_HISTORY,
+                 gap_threshold: float = Config.CANDLE_GAP_THRESHOLD,
+                 rebuild_cooldown: float = Config.CANDLE_REBUILD_COOLDOWN):
+        self.tick_store = tick_store
+        self.timezone = timezone
+        self.capacity = capacity
+        self.gap_threshold = gap_threshold
+        self.rebuild_cooldown = rebuild_cooldown
+        
+        self.series = self._new_series()
+        # [بداية اليوم المحلي، بداية اليوم التالي] - تُحسب مرة لكل يوم وليس لكل سعر
+        self._bounds = [0.0, 0.0]
+        self.last_ts = 0.0
+        # يزيد مع كل إغلاق شمعة - مفتاح نص الـ prompt المخزن
+        self.version = 0
+        self._prompt_cache: Tuple[int, int, str] = (-1, 0, "")
+        
+        self._rebuild_task: Optional[asyncio.Task] = None
+        self.last_rebuild = 0.0
+        self.rebuilds = 0
+        self.gaps = 0
+        self.backfilled_bars = 0
+    
+    def _new_series(self) -> Dict[str, CandleSeries]:
+        return {name: CandleSeries(name, seconds, self.capacity) for name, seconds in CANDLE_TIMEFRAMES.items()}
+    
+    def _day_bounds(self, ts: float) -> Tuple[float, float]:
+        """منتصف الليل المحلي لليوم والذي يليه - يراعي التوقيت الصيفي"""
+        local = datetime.fromtimestamp(ts, self.timezone)
+        midnight = datetime(local.year, local.month, local.day)
+        return (
+            self.timezone.localize(midnight).timestamp(),
+            self.timezone.localize(midnight + timedelta(days=1)).timestamp()
+        )
+    
+    def _apply(self, series: Dict[str, CandleSeries], bounds: List[float], ts: float,
+               open_: float, high: float, low: float, close: float, ticks: int) -> bool:
+        if not bounds[0] <= ts < bounds[1]:
+            bounds[0], bounds[1] = self._day_bounds(ts)
+        
+        offset = ts - bounds[0]
+        closed = False
+        for candles in series.values():
+            if candles.seconds >= 86400:
+                bucket = bounds[0]
+            else:
+                bucket = bounds[0] + (offset // candles.seconds) * candles.seconds
+            closed |= candles.update(bucket, open_, high, low, close, ticks)
+        return closed
+    
+    def update(self, ts: float, price: float):
+        """سعر حي جديد - O(1) لكل إطار"""
+        if ts <= self.last_ts:
+            return
+        if self.last_ts and ts - self.last_ts > self.gap_threshold:
+            # انقطاع في تدفق الأسعار - نعيد البناء من التاريخ لملء الشموع الناقصة
+            self.gaps += 1
+            self._schedule_rebuild()
+        
+        self.last_ts = ts
+        if self._apply(self.series, self._bounds, ts, price, price, price, price, 1):
+            self.version += 1
+    
+    def _schedule_rebuild(self):
+        if self._rebuild_task is not None and not self._rebuild_task.done():
+            return
+        if time.monotonic() - self.last_rebuild < self.rebuild_cooldown:
+            return
+        self._rebuild_task = asyncio.create_task(self.rebuild())
+    
+    async def rebuild(self):
+        """بناء كل الأطر من تاريخ M5 في yfinance ثم ticks السجل المحلي بعده، واستبدال الحالة دفعة واحدة"""
+        self.last_rebuild = time.monotonic()
+        history = None
+        if YFINANCE_AVAILABLE:
+            try:
+                history = await asyncio.wait_for(asyncio.to_thread(self._fetch_history), timeout=30)
+            except Exception as e:
+                logger.warning(f"Candle history backfill failed: {e}")
+        
+        ticks = self.tick_store.latest().copy() if self.tick_store is not None else None
+        series, bounds, last_ts, backfilled = await asyncio.to_thread(self._build, history, ticks)
+        
+        # الأسعار التي وصلت أثناء البناء موجودة في السجل
+        if self.tick_store is not None:
+            late = self.tick_store.window(last_ts)
+            for ts, price in zip(late['ts'].tolist(), late['price'].tolist()):
+                if ts > last_ts:
+                    self._apply(series, bounds, ts, price, price, price, price, 1)
+                    last_ts = ts
+        
+        self.series, self._bounds = series, bounds
+        self.last_ts = max(last_ts, self.last_ts)
+        self.version += 1
+        self.rebuilds += 1
+        self.backfilled_bars = backfilled
+        logger.info(f"Candles rebuilt: {backfilled} history bars, {self.series['M5'].size} closed M5 bars")
+    
+    def _build(self, history: Optional[List[Tuple[float, float, float, float, float]]],
+               ticks: Optional[np.ndarray]):
+        series = self._new_series()
+        bounds = [0.0, 0.0]
+        last_ts = 0.0
+        
+        for start, open_, high, low, close in history or ():
+            self._apply(series, bounds, start, open_, high, low, close, 0)
+            last_ts = start
+        
+        if ticks is not None and len(ticks):
+            newer = ticks[ticks['ts'] > last_ts]
+            for ts, price in zip(newer['ts'].tolist(), newer['price'].tolist()):
+                self._apply(series, bounds, ts, price, price, price, price, 1)
+                last_ts = ts
+        
+        return series, bounds, last_ts, len(history or ())
+    
+    @staticmethod
+    def _fetch_history() -> Optional[List[Tuple[float, float, float, float, float]]]:
+        """شموع M5 من yfinance - الفوري أولاً حتى لا تختلط أسعار العقود الآجلة بالفوري"""
+        for symbol in Config.YFINANCE_SYMBOLS:
+            try:
+                frame = yf.Ticker(symbol).history(period=f"{Config.CANDLE_BACKFILL_DAYS}d", interval="5m")
+            except Exception as e:
+                logger.debug(f"yfinance history {symbol} error: {e}")
+                continue
+            if frame is None or frame.empty:
+                continue
+            
+            frame = frame.dropna(subset=['Open', 'High', 'Low', 'Close'])
+            return [
+                (moment.timestamp(), float(row.Open), float(row.High), float(row.Low), float(row.Close))
+                for moment, row in zip(frame.index, frame.itertuples(index=False))
+            ]
+        return None
+    
+    def bars(self, timeframe: str, count: Optional[int] = None, include_current: bool = False) -> np.ndarray:
+        """الشموع المغلقة كـ view بدون نسخ، أو نسخة تضم الشمعة الجارية في آخرها"""
+        candles = self.series[timeframe]
+        closed = candles.closed(count)
+        current = candles.current()
+        if not include_current or current is None:
+            return closed
+        if count is not None and len(closed) >= count:
+            closed = closed[1:]
+        return np.concatenate([closed, np.array([current], dtype=CANDLE_DTYPE)])
+    
+    def prompt_block(self, count: int = Config.CANDLE_PROMPT_BARS) -> str:
+        """آخر الشموع المغلقة لكل إطار كنص مختصر للـ prompt - يُبنى مرة لكل إغلاق شمعة"""
+        version, cached_count, text = self._prompt_cache
+        if version == self.version and cached_count == count:
+            return text
+        
+        time_formats = {'M5': '%H:%M', 'M15': '%H:%M', 'H1': '%m-%d %H:%M', 'H4': '%m-%d %H:%M', 'D1': '%Y-%m-%d'}
+        lines = []
+        for name, candles in self.series.items():
+            bars = candles.closed(count)
+            if not len(bars):
+                continue
+            cells = " | ".join(
+                f"{datetime.fromtimestamp(start, self.timezone).strftime(time_formats[name])} "
+                f"{open_:.2f}/{high:.2f}/{low:.2f}/{close:.2f}"
+                for start, open_, high, low, close in zip(
+                    bars['ts'].tolist(), bars['open'].tolist(), bars['high'].tolist(),
+                    bars['low'].tolist(), bars['close'].tolist()
+                )
+            )
+            lines.append(f"{name}: {cells}")
+        
+        text = ""
+        if lines:
+            text = (f"الشموع الحقيقية المغلقة (الأقدم أولاً، O/H/L/C، توقيت {self.timezone.zone}):\n"
+                    + "\n".join(lines))
+        self._prompt_cache = (self.version, count, text)
+        return text
+    
+    async def start(self):
+        """البناء الأول في الخلفية - الأسعار الحية تُحدّث الحالة الحالية حتى يكتمل"""
+        self._rebuild_task = asyncio.create_task(self.rebuild())
+    
+    async def close(self):
+        if self._rebuild_task is not None and not self._rebuild_task.done():
+            self._rebuild_task.cancel()
+            try:
+                await self._rebuild_task
+            except asyncio.CancelledError:
+                pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'bars': {name: candles.size for name, candles in self.series.items()},
+            'rebuilds': self.rebuilds,
+            'gaps': self.gaps,
+            'backfilled_bars': self.backfilled_bars
+        }
+
+# ==================== Gold Price Sources ====================
+class CircuitBreaker:
+    """قاطع لكل مصدر: يتوقف عن طلبه بعد أخطاء متتالية ثم يجرب طلباً واحداً بعد المهلة"""
+    
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+    
+    def __init__(self, failure_threshold: int = Config.PRICE_BREAKER_FAILURES,
+                 reset_timeout: float = Config.PRICE_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+    
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            # طلب تجريبي واحد - نجاحه يغلق القاطع وفشله يعيد فتحه
+            self.state = self.HALF_OPEN
+            return True
+        return False
+    
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+    
+    def cancel_probe(self):
+        """أُلغي الطلب التجريبي قبل اكتماله - يُسمح بتجربة أخرى فوراً"""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+class PriceSource:
+    """مصدر سعر واحد مع قاطعه وإحصائياته - الفئات الفرعية تنفذ _fetch فقط"""
+    
+    name = "base"
+    
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.requests = 0
+        self.failures = 0
+        self.bad_data = 0
+        self.wins = 0
+        self.total_latency = 0.0
+    
+    async def fetch(self) -> Optional[GoldPrice]:
+        """جلب مع قياس الزمن - الأخطاء تُسجل على القاطع ولا تُرفع"""
+        self.requests += 1
+        started = time.monotonic()
+        try:
+            price = await asyncio.wait_for(self._fetch(), timeout=PerformanceConfig.HTTP_TIMEOUT)
+        except asyncio.CancelledError:
+            # مصدر آخر فاز بالسباق
+            self.breaker.cancel_probe()
+            raise
+        except asyncio.TimeoutError:
+            logger.warning(f"Price source {self.name} timed out")
+            price = None
+        except Exception as e:
+            logger.warning(f"Price source {self.name} error: {e}")
+            price = None
+        finally:
+            self.total_latency += time.monotonic() - started
+        
+        if price is None:
+            self.failures += 1
+            self.breaker.record_failure()
+        return price
+    
+    def reject(self, reason: str):
+        """بيانات غير منطقية - تُعامل كفشل للمصدر"""
+        self.bad_data += 1
+        self.breaker.record_failure()
+        logger.warning(f"Rejected price from {self.name}: {reason}")
+    
+    async def _fetch(self) -> Optional[GoldPrice]:
+        raise NotImplementedError
+    
+    async def close(self):
+        pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'state': self.breaker.state,
+            'requests': self.requests,
+            'failures': self.failures,
+            'bad_data': self.bad_data,
+            'wins': self.wins,
+            'avg_ms': self.total_latency / self.requests * 1000 if self.requests else 0.0
+        }
+
+class GoldApiSource(PriceSource):
+    name = "goldapi"
+    
+    def __init__(self):
+        super().__init__()
+        self.session: Optional[aiohttp.ClientSession] = None
+    
+    async def get_session(self) -> aiohttp.ClientSession:
         """جلب جلسة HTTP - مُصلح"""
         if self.session is None or self.session.closed:
             timeout = aiohttp.ClientTimeout(total=PerformanceConfig.HTTP_TIMEOUT)
             self.session = aiohttp.ClientSession(timeout=timeout)
         return self.session
     
-    async def get_gold_price(self) -> Optional[GoldPrice]:
-        """جلب سعر الذهب - مُصلح"""
-        cached_price = self.cache.get_price()
-        if cached_price:
-            return cached_price
+    async def _fetch(self) -> Optional[GoldPrice]:
+        """جلب السعر من GoldAPI - مُصلح"""
+        session = await self.get_session()
+        headers = {
+            "x-access-token": Config.GOLD_API_TOKEN,
+            "Content-Type": "application/json"
+        }
+        
+        async with session.get(Config.GOLD_API_URL, headers=headers) as response:
+            if response.status != 200:
+                logger.error(f"GoldAPI returned status {response.status}")
+                return None
+            
+            data = await response.json()
+            price = data.get("price")
+            if not price:
+                return None
+            
+            if price > 10000:
+                price = price / 100
+            
+            return GoldPrice(
+                price=round(price, 2),
+                timestamp=datetime.now(),
+                change_24h=data.get("change", 0),
+                change_percentage=data.get("change_p", 0),
+                high_24h=data.get("high_price", price),
+                low_24h=data.get("low_price", price),
+                source=self.name
+            )
+    
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+class YahooFinanceSource(PriceSource):
+    """yfinance متزامنة - تعمل في thread حتى لا توقف الـ event loop"""
+    
+    name = "yfinance"
+    
+    def __init__(self, symbols: List[str]):
+        super().__init__()
+        self.symbols = symbols
+    
+    async def _fetch(self) -> Optional[GoldPrice]:
+        return await asyncio.to_thread(self._fetch_sync)
+    
+    def _fetch_sync(self) -> Optional[GoldPrice]:
+        for symbol in self.symbols:
+            try:
+                info = yf.Ticker(symbol).fast_info
+                price = info.last_price
+                previous_close = info.previous_close
+            except Exception as e:
+                logger.debug(f"yfinance {symbol} error: {e}")
+                continue
+            if not price or not math.isfinite(price):
+                continue
+            
+            change = price - previous_close if previous_close else 0.0
+            return GoldPrice(
+                price=round(price, 2),
+                timestamp=datetime.now(),
+                change_24h=round(change, 2),
+                change_percentage=round(change / previous_close * 100, 2) if previous_close else 0.0,
+                high_24h=round(info.day_high or price, 2),
+                low_24h=round(info.day_low or price, 2),
+                source=f"{self.name}:{symbol}"
+            )
+        return None
+
+def create_price_sources() -> List[PriceSource]:
+    """المصادر المفعلة بترتيب PRICE_SOURCES - الأول هو الأساسي والبقية للتحوط"""
+    sources = []
+    for name in (item.strip().lower() for item in Config.PRICE_SOURCES.split(",")):
+        if name == "goldapi":
+            if Config.GOLD_API_TOKEN:
+                sources.append(GoldApiSource())
+            else:
+                logger.warning("GOLD_API_TOKEN not set - goldapi price source disabled")
+        elif name == "yfinance":
+            if YFINANCE_AVAILABLE:
+                sources.append(YahooFinanceSource(Config.YFINANCE_SYMBOLS))
+            else:
+                logger.warning("yfinance not installed - yfinance price source disabled")
+        elif name:
+            logger.warning(f"Unknown price source: {name}")
+    return sources
+
+# ==================== Fixed Gold Price Manager ====================
+class FixedGoldPriceManager:
+    """سعر الذهب يُحدَّث في الخلفية - الطلبات تقرأ آخر سعر صالح فوراً دون انتظار الشبكة"""
+    
+    # حدود منطقية لسعر الأونصة بالدولار - خارجها بيانات تالفة
+    PLAUSIBLE_RANGE = (500.0, 20000.0)
+    
+    def __init__(self, cache_manager: FixedCacheManager,
+                 sources: Optional[List[PriceSource]] = None,
+                 tick_store: Optional[PriceTickStore] = None,
+                 candles: Optional[CandleAggregator] = None,
+                 refresh_interval: float = Config.PRICE_REFRESH_INTERVAL,
+                 stale_after: float = Config.PRICE_STALE_AFTER,
+                 max_backoff: float = Config.PRICE_MAX_BACKOFF):
+        self.cache = cache_manager
+        self.sources = sources if sources is not None else create_price_sources()
+        self.tick_store = tick_store
+        self.candles = candles
+        self.hedge_delay = Config.PRICE_HEDGE_DELAY_MS / 1000
+        self.max_jump = Config.PRICE_MAX_JUMP_PCT
+        self.tolerance = Config.PRICE_SOURCE_TOLERANCE_PCT
+        self.refresh_interval = refresh_interval
+        self.stale_after = stale_after
+        self.max_backoff = max_backoff
         
+        self.current: Optional[GoldPrice] = None
+        self.fetched_at = 0.0
+        self.last_attempt = 0.0
+        self.next_delay = refresh_interval
+        self.consecutive_failures = 0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Task] = None
+        
+        self.fetches = 0
+        self.fetch_errors = 0
+        self.stale_served = 0
+        self.hedges = 0
+        self.bad_data = 0
+    
+    async def start(self):
+        """جلب أول سعر قبل استقبال الطلبات ثم التحديث الدوري في الخلفية"""
+        await self.refresh()
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+    
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.next_delay)
+            await self.refresh()
+    
+    async def refresh(self) -> bool:
+        """جلب واحد مشترك - أي طلبات متزامنة تنتظر نفس الجلب"""
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self._inflight)
+    
+    async def _refresh(self) -> bool:
+        self.last_attempt = time.monotonic()
+        self.fetches += 1
         try:
-            price = await self._fetch_from_goldapi()
-            if price:
-                self.cache.set_price(price)
-                return price
+            price = await self._fetch_hedged()
         except Exception as e:
-            logger.warning(f"Gold API error: {e}")
-        
-        # استخدام سعر افتراضي
-        fallback_price = GoldPrice(
-            price=2650.0,
-            timestamp=datetime.now(),
-            change_24h=2.5,
-            change_percentage=0.1,
-            high_24h=2655.0,
-            low_24h=2645.0,
-            source="fallback"
-        )
-        self.cache.set_price(fallback_price)
-        return fallback_price
+            logger.warning(f"Gold price fetch error: {e}")
+            price = None
+        
+        if price:
+            self.current = price
+            self.fetched_at = time.monotonic()
+            self.cache.set_price(price)
+            if self.tick_store is not None:
+                self.tick_store.append_price(price)
+            if self.candles is not None:
+                self.candles.update(price.timestamp.timestamp(), price.price)
+            self.consecutive_failures = 0
+            self.next_delay = self.refresh_interval
+            return True
+        
+        # تباطؤ أسي مع عشوائية حتى لا تضغط النسخ المتعددة على المصدر معاً
+        self.fetch_errors += 1
+        self.consecutive_failures += 1
+        backoff = min(self.max_backoff, self.refresh_interval * 2 ** self.consecutive_failures)
+        self.next_delay = backoff * random.uniform(0.8, 1.2)
+        logger.warning(f"Gold price refresh failed ({self.consecutive_failures} in a row), next try in {self.next_delay:.0f}s")
+        return False
     
-    async def _fetch_from_goldapi(self) -> Optional[GoldPrice]:
-        """جلب السعر من GoldAPI - مُصلح"""
-        try:
-            session = await self.get_session()
-            headers = {
-                "x-access-token": Config.GOLD_API_TOKEN,
-                "Content-Type": "application/json"
-            }
+    def get_age(self) -> Optional[float]:
+        """عمر آخر سعر صالح بالثواني"""
+        if self.current is None:
+            return None
+        return time.monotonic() - self.fetched_at
+    
+    async def get_gold_price(self) -> Optional[GoldPrice]:
+        """آخر سعر معروف فوراً - يُعلَّم كمتأخر بعد PRICE_STALE_AFTER"""
+        now = time.monotonic()
+        
+        if self.current is None:
+            # لا يوجد سعر بعد (فشل الجلب عند التشغيل) - ننتظر جلباً مشتركاً بحد أقصى مرة كل فترة تحديث
+            if now - self.last_attempt >= self.refresh_interval or (self._inflight and not self._inflight.done()):
+                await self.refresh()
+        
+        if self.current is not None:
+            age = now - self.fetched_at
+            if age <= self.stale_after:
+                return self.current
             
-            async with session.get(Config.GOLD_API_URL, headers=headers) as response:
-                if response.status != 200:
-                    logger.error(f"GoldAPI returned status {response.status}")
-                    return None
-                
-                data = await response.json()
-                price = data.get("price")
-                if not price:
-                    return None
-                
-                if price > 10000:
-                    price = price / 100
-                
-                return GoldPrice(
-                    price=round(price, 2),
-                    timestamp=datetime.now(),
-                    change_24h=data.get("change", 0),
-                    change_percentage=data.get("change_p", 0),
-                    high_24h=data.get("high_price", price),
-                    low_24h=data.get("low_price", price),
-                    source="goldapi"
+            # stale-while-revalidate: نعيد القديم ونطلب تحديثاً في الخلفية إذا لم يُحاول مؤخراً
+            self.stale_served += 1
+            if now - self.last_attempt >= self.refresh_interval:
+                asyncio.create_task(self.refresh())
+            return replace(self.current, stale=True)
+        
+        # لا سعر حقيقي - لا نخترع سعراً يفسد التحليل والـ cache
+        return None
+    
+    async def _fetch_hedged(self) -> Optional[GoldPrice]:
+        """المصدر الأول، ثم التالي إذا تأخر أكثر من PRICE_HEDGE_DELAY_MS أو فشل - أول سعر سليم يفوز"""
+        queue = deque(self.sources)
+        age = self.get_age()
+        reference = self.current if age is not None and age <= self.stale_after else None
+        pending: Dict[asyncio.Task, PriceSource] = {}
+        suspects: List[Tuple[PriceSource, GoldPrice]] = []
+        
+        def launch() -> bool:
+            # القاطع يُسأل عند البدء فقط - حتى لا يُحجز طلب تجريبي لمصدر لن يُطلب
+            while queue:
+                source = queue.popleft()
+                if source.breaker.allow():
+                    pending[asyncio.create_task(source.fetch())] = source
+                    return True
+            return False
+        
+        if not launch():
+            return None
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, timeout=self.hedge_delay if queue else None,
+                    return_when=asyncio.FIRST_COMPLETED
                 )
+                if not done:
+                    # المصدر بطيء - نبدأ التالي بالتوازي دون إلغاء الأول
+                    if launch():
+                        self.hedges += 1
+                    continue
                 
-        except Exception as e:
-            logger.error(f"GoldAPI error: {e}")
+                for task in done:
+                    source = pending.pop(task)
+                    price = task.result()
+                    if price is not None:
+                        problem = self._check_price(price)
+                        if problem:
+                            source.reject(problem)
+                        elif reference is None or self._deviation(price.price, reference.price) <= self.max_jump:
+                            return self._accept(source, price, suspects)
+                        elif any(self._deviation(price.price, other.price) <= self.tolerance for _, other in suspects):
+                            # قفزة حقيقية أكدها مصدر آخر
+                            return self._accept(source, price, suspects)
+                        else:
+                            suspects.append((source, price))
+                    launch()
+            
+            for source, price in suspects:
+                source.reject(f"{price.price} jumps more than {self.max_jump}% from {reference.price} without confirmation")
+            if suspects:
+                self.bad_data += 1
             return None
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+    
+    def _accept(self, source: PriceSource, price: GoldPrice,
+                suspects: List[Tuple[PriceSource, GoldPrice]]) -> GoldPrice:
+        source.wins += 1
+        source.breaker.record_success()
+        for other_source, other in suspects:
+            if other_source is not source and self._deviation(other.price, price.price) > self.tolerance:
+                other_source.reject(f"{other.price} disagrees with {source.name} {price.price}")
+                self.bad_data += 1
+        return price
+    
+    def _check_price(self, price: GoldPrice) -> Optional[str]:
+        """فحص منطقية السعر نفسه - يرجع سبب الرفض أو None"""
+        low, high = self.PLAUSIBLE_RANGE
+        if not math.isfinite(price.price) or not low <= price.price <= high:
+            return f"price {price.price} outside plausible range"
+        if price.high_24h and price.low_24h and price.low_24h > price.high_24h:
+            return f"low {price.low_24h} above high {price.high_24h}"
+        return None
+    
+    @staticmethod
+    def _deviation(price: float, reference: float) -> float:
+        return abs(price - reference) / reference * 100
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'age': self.get_age(),
+            'source': self.current.source if self.current else None,
+            'fetches': self.fetches,
+            'errors': self.fetch_errors,
+            'consecutive_failures': self.consecutive_failures,
+            'next_refresh': self.next_delay,
+            'stale_served': self.stale_served,
+            'hedges': self.hedges,
+            'bad_data': self.bad_data,
+            'sources': {source.name: source.get_stats() for source in self.sources}
+        }
     
     async def close(self):
-        """إغلاق الجلسة"""
-        if self.session and not self.session.closed:
-            await self.session.close()
+        """إيقاف التحديث الدوري وإغلاق جلسات المصادر"""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+        for source in self.sources:
+            await source.close()
+
+# ==================== Claude Request Scheduler ====================
+class SchedulerRejected(Exception):
+    """رُفض الطلب من المجدول بسبب الحمل الزائد أو تجاوز المهلة"""
+
+@dataclass
+class _SchedulerWaiter:
+    future: asyncio.Future
+    user_id: int
+    priority: AnalysisPriority
+    enqueued_at: float
+    deadline: float
+
+class ClaudeRequestScheduler:
+    """جدولة طلبات Claude بسقف تزامن وأولويات مع عدالة بين المستخدمين"""
+    
+    def __init__(self, max_concurrency: int = PerformanceConfig.CLAUDE_MAX_CONCURRENCY,
+                 max_queue: int = PerformanceConfig.CLAUDE_QUEUE_LIMIT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        # لكل أولوية: user_id -> طلبات المستخدم بالترتيب (دوري بين المستخدمين)
+        self._queues: Dict[AnalysisPriority, "OrderedDict[int, deque]"] = {
+            priority: OrderedDict() for priority in AnalysisPriority
+        }
+        
+        self.admitted = 0
+        self.shed = 0
+        self.expired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    @asynccontextmanager
+    async def slot(self, priority: AnalysisPriority, user_id: int):
+        """حجز مكان لطلب Claude وتحريره بعد الانتهاء"""
+        await self.acquire(priority, user_id)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    async def acquire(self, priority: AnalysisPriority, user_id: int):
+        now = time.monotonic()
+        
+        if self.active < self.max_concurrency and self.queued == 0:
+            self.active += 1
+            self._record_admission(0.0)
+            return
+        
+        if self.queued >= self.max_queue and not self._shed_lower_than(priority):
+            self.shed += 1
+            raise SchedulerRejected("queue full")
+        
+        waiter = _SchedulerWaiter(
+            future=asyncio.get_running_loop().create_future(),
+            user_id=user_id,
+            priority=priority,
+            enqueued_at=now,
+            deadline=now + ANALYSIS_PRIORITY_DEADLINES[priority]
+        )
+        self._queues[priority].setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        
+        try:
+            await asyncio.wait_for(waiter.future, timeout=waiter.deadline - now)
+        except asyncio.TimeoutError:
+            self._discard(waiter)
+            self.expired += 1
+            raise SchedulerRejected("deadline exceeded")
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # حصل على مكان لحظة الإلغاء - نحرره للطلب التالي
+                self.release()
+            else:
+                self._discard(waiter)
+            raise
+    
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+    
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.active < self.max_concurrency:
+            waiter = self._pop_next()
+            if waiter is None:
+                return
+            if waiter.future.done():
+                continue
+            if waiter.deadline <= now:
+                self.expired += 1
+                waiter.future.set_exception(SchedulerRejected("deadline exceeded"))
+                continue
+            
+            self.active += 1
+            self._record_admission(now - waiter.enqueued_at)
+            waiter.future.set_result(True)
+    
+    def _pop_next(self) -> Optional[_SchedulerWaiter]:
+        """أعلى أولوية أولاً، وداخل الأولوية الواحدة دور لكل مستخدم"""
+        for priority in AnalysisPriority:
+            queue = self._queues[priority]
+            if not queue:
+                continue
+            user_id, user_queue = queue.popitem(last=False)
+            waiter = user_queue.popleft()
+            if user_queue:
+                queue[user_id] = user_queue
+            self.queued -= 1
+            return waiter
+        return None
+    
+    def _discard(self, waiter: _SchedulerWaiter):
+        queue = self._queues[waiter.priority]
+        user_queue = queue.get(waiter.user_id)
+        if user_queue is not None and waiter in user_queue:
+            user_queue.remove(waiter)
+            self.queued -= 1
+            if not user_queue:
+                del queue[waiter.user_id]
+    
+    def _shed_lower_than(self, priority: AnalysisPriority) -> bool:
+        """إسقاط أحدث طلب من أدنى أولوية أقل من المطلوبة لإفساح المجال"""
+        for lower in sorted(AnalysisPriority, reverse=True):
+            if lower <= priority:
+                return False
+            queue = self._queues[lower]
+            if not queue:
+                continue
+            user_id = next(reversed(queue))
+            victim = queue[user_id][-1]
+            self._discard(victim)
+            self.shed += 1
+            if not victim.future.done():
+                victim.future.set_exception(SchedulerRejected("shed for higher priority"))
+            return True
+        return False
+    
+    def _record_admission(self, wait: float):
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'queued_by_priority': {
+                priority.name: sum(len(q) for q in self._queues[priority].values())
+                for priority in AnalysisPriority
+            },
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'expired': self.expired,
+            'avg_wait': self.total_wait / self.admitted if self.admitted else 0.0,
+            'max_wait': self.max_wait
+        }
 
 # ==================== Fixed Claude AI Manager ====================
+class AnalysisFailure(str):
+    """نص بديل يُعرض للمستخدم عند فشل Claude - يُميز عن التحليل الحقيقي لاسترداد النقاط"""
+
 class FixedClaudeAIManager:
-    def __init__(self, cache_manager: FixedCacheManager):
-        self.client = anthropic.Anthropic(api_key=Config.CLAUDE_API_KEY)
+    def __init__(self, cache_manager: FixedCacheManager,
+                 scheduler: Optional[ClaudeRequestScheduler] = None,
+                 candles: Optional[CandleAggregator] = None):
+        self.client: Optional[anthropic.Anthropic] = None
+        self.async_client: Optional[anthropic.AsyncAnthropic] = None
+        
+        if Config.CLAUDE_CLIENT_MODE == "async":
+            # عميل async أصلي مع pool اتصالات مشترك - بدون حجز threads
+            self.async_client = anthropic.AsyncAnthropic(
+                api_key=Config.CLAUDE_API_KEY,
+                max_retries=0,  # إعادة المحاولة تتم في _generate_analysis
+                timeout=PerformanceConfig.CLAUDE_TIMEOUT + 5,
+                http_client=anthropic.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=PerformanceConfig.CLAUDE_MAX_CONNECTIONS,
+                        max_keepalive_connections=PerformanceConfig.CLAUDE_MAX_KEEPALIVE,
+                        keepalive_expiry=PerformanceConfig.CLAUDE_KEEPALIVE_EXPIRY
+                    )
+                )
+            )
+        else:
+            self.client = anthropic.Anthropic(api_key=Config.CLAUDE_API_KEY)
+        
         self.cache = cache_manager
+        self.scheduler = scheduler or ClaudeRequestScheduler()
+        # طلبات Claude الجارية حسب مفتاح الـ cache - للدمج بين الطلبات المتطابقة
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.chart_index = ChartDedupIndex(cache_manager.image_cache)
+        self.candles = candles
+        self.coalesced_waiters = 0
+        self.waiting_now = 0
         
     async def analyze_gold(self, 
                           prompt: str, 
                           gold_price: GoldPrice,
                           image_base64: Optional[str] = None,
                           analysis_type: AnalysisType = AnalysisType.DETAILED,
-                          user_settings: Dict[str, Any] = None) -> str:
-        """تحليل الذهب مع Claude - مُصلح"""
+                          user_settings: Dict[str, Any] = None,
+                          on_stream: Optional[Callable[[str], Awaitable[None]]] = None,
+                          user_id: int = 0,
+                          priority: AnalysisPriority = AnalysisPriority.STANDARD,
+                          image_fingerprint: Optional[int] = None) -> str:
+        """تحليل الذهب مع Claude - on_stream يستقبل النص المتراكم أثناء التوليد
         
-        # التحقق من cache للتحليل النصي
-        if not image_base64:
-            cache_key = f"{hash(prompt)}_{gold_price.price}_{analysis_type.value}"
+        image_fingerprint: بصمة dHash للشارت - بدونها لا يُخزن تحليل الصورة
+        """
+        
+        if image_base64:
+            if image_fingerprint is None:
+                return await self._generate_analysis(
+                    prompt, gold_price, image_base64, analysis_type, user_settings,
+                    on_stream=on_stream, user_id=user_id, priority=priority
+                )
+            
+            # نفس الشارت (أو نسخة معاد ضغطها) بنفس الطلب وعند نفس السعر - لا حاجة لاستدعاء vision جديد
+            price_bucket, bucket_ttl = analysis_cache_bucket(gold_price.price, analysis_type)
+            cache_key, cached_result = self.chart_index.get(image_fingerprint, prompt, analysis_type, price_bucket)
+            cache_ttl = min(self.chart_index.window, bucket_ttl)
+        else:
+            # التحقق من cache للتحليل النصي
+            price_bucket, cache_ttl = analysis_cache_bucket(gold_price.price, analysis_type)
+            cache_key = build_analysis_cache_key(prompt, analysis_type, price_bucket)
             cached_result = self.cache.get_analysis(cache_key)
-            if cached_result:
-                return cached_result + f"\n\n{emoji('zap')} *من الذاكرة المؤقتة للسرعة*"
+        
+        if cached_result:
+            return cached_result + f"\n\n{emoji('zap')} *من الذاكرة المؤقتة للسرعة*"
+        
+        # طلب مطابق قيد التنفيذ - ننتظر نتيجته بدل استدعاء Claude مرة أخرى
+        inflight = self._inflight.get(cache_key)
+        if inflight is not None:
+            self.coalesced_waiters += 1
+            self.waiting_now += 1
+            try:
+                return await asyncio.shield(inflight)
+            finally:
+                self.waiting_now -= 1
+        
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = future
+        try:
+            result = await self._generate_analysis(
+                prompt, gold_price, image_base64, analysis_type, user_settings, cache_key, cache_ttl,
+                on_stream, user_id, priority
+            )
+            future.set_result(result)
+            return result
+        finally:
+            if not future.done():
+                # أُلغي الطلب الأول - المنتظرون يحصلون على التحليل البديل
+                future.set_result(
+                    self._generate_chart_fallback_analysis(gold_price) if image_base64
+                    else self._generate_text_fallback_analysis(gold_price, analysis_type)
+                )
+            self._inflight.pop(cache_key, None)
+    
+    async def _create_message(self, **request_kwargs):
+        """استدعاء Messages API مع مهلة - الإلغاء يوقف طلب HTTP نفسه في الوضع async"""
+        if self.async_client is not None:
+            return await asyncio.wait_for(
+                self.async_client.messages.create(**request_kwargs),
+                timeout=PerformanceConfig.CLAUDE_TIMEOUT
+            )
+        
+        return await asyncio.wait_for(
+            asyncio.to_thread(self.client.messages.create, **request_kwargs),
+            timeout=PerformanceConfig.CLAUDE_TIMEOUT
+        )
+    
+    async def _stream_message(self, on_stream: Callable[[str], Awaitable[None]], **request_kwargs):
+        """استدعاء Messages API بالتدفق مع تمرير النص المتراكم أولاً بأول"""
+        async def consume():
+            accumulated = ""
+            async with self.async_client.messages.stream(**request_kwargs) as stream:
+                async for text in stream.text_stream:
+                    accumulated += text
+                    await on_stream(accumulated)
+                return await stream.get_final_message()
+        
+        return await asyncio.wait_for(consume(), timeout=PerformanceConfig.CLAUDE_STREAM_TIMEOUT)
+    
+    async def close(self):
+        """إغلاق اتصالات HTTP الخاصة بـ Claude"""
+        if self.async_client is not None:
+            await self.async_client.close()
+    
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            'inflight': len(self._inflight),
+            'coalesced_waiters': self.coalesced_waiters,
+            'waiting_now': self.waiting_now
+        }
+    
+    async def _generate_analysis(self,
+                                 prompt: str,
+                                 gold_price: GoldPrice,
+                                 image_base64: Optional[str],
+                                 analysis_type: AnalysisType,
+                                 user_settings: Optional[Dict[str, Any]],
+                                 cache_key: Optional[str] = None,
+                                 cache_ttl: Optional[float] = None,
+                                 on_stream: Optional[Callable[[str], Awaitable[None]]] = None,
+                                 user_id: int = 0,
+                                 priority: AnalysisPriority = AnalysisPriority.STANDARD) -> str:
+        """استدعاء Claude مع إعادة المحاولة والتحليلات البديلة"""
         
         # التحقق من التحليل الخاص السري
         is_nightmare_analysis = Config.NIGHTMARE_TRIGGER in prompt
@@ -936,9 +3004,12 @@ class FixedClaudeAIManager:
                     "text": user_prompt
                 })
                 
-                message = await asyncio.wait_for(
-                    asyncio.to_thread(
-                        self.client.messages.create,
+                create_message = self._create_message
+                if on_stream is not None and self.async_client is not None and Config.CLAUDE_STREAMING:
+                    create_message = partial(self._stream_message, on_stream)
+                
+                async with self.scheduler.slot(priority, user_id):
+                    message = await create_message(
                         model=Config.CLAUDE_MODEL,
                         max_tokens=Config.CLAUDE_MAX_TOKENS,
                         temperature=Config.CLAUDE_TEMPERATURE,
@@ -947,25 +3018,33 @@ class FixedClaudeAIManager:
                             "role": "user",
                             "content": content
                         }]
-                    ),
-                    timeout=PerformanceConfig.CLAUDE_TIMEOUT
-                )
+                    )
                 
                 result = message.content[0].text
                 
-                # حفظ في cache إذا لم تكن صورة
-                if not image_base64:
-                    self.cache.set_analysis(cache_key, result)
+                # حفظ في cache - الشارتات في ذاكرة الصور بمفتاح البصمة
+                if cache_key:
+                    if image_base64:
+                        self.cache.image_cache.set(cache_key, result, cache_ttl)
+                    else:
+                        self.cache.set_analysis(cache_key, result, cache_ttl)
                 
                 return result
 
+            except SchedulerRejected as e:
+                # حمل زائد - الطلبات منخفضة القيمة تُسقط أولاً بدل الانتظار الطويل
+                logger.warning(f"Claude request shed ({priority.name}): {e}")
+                if image_base64:
+                    return self._generate_chart_fallback_analysis(gold_price)
+                return AnalysisFailure(f"{emoji('warning')} الخادم مشغول حالياً بسبب ضغط الطلبات. حاول بعد قليل.")
+            
             except asyncio.TimeoutError:
                 logger.warning(f"Claude API timeout - attempt {attempt + 1}/{max_retries}")
                 if attempt == max_retries - 1:
                     if image_base64:
                         return self._generate_chart_fallback_analysis(gold_price)
                     else:
-                        return f"{emoji('warning')} انتهت مهلة التحليل. يرجى المحاولة مرة أخرى."
+                        return AnalysisFailure(f"{emoji('warning')} انتهت مهلة التحليل. يرجى المحاولة مرة أخرى.")
                 
                 await asyncio.sleep(2 * (attempt + 1))
                 
@@ -986,7 +3065,7 @@ class FixedClaudeAIManager:
                 elif "rate_limit" in error_str or "429" in error_str:
                     logger.warning(f"Claude API rate limited")
                     if attempt == max_retries - 1:
-                        return f"{emoji('warning')} تم تجاوز الحد المسموح. حاول بعد قليل."
+                        return AnalysisFailure(f"{emoji('warning')} تم تجاوز الحد المسموح. حاول بعد قليل.")
                     
                     await asyncio.sleep(5)
                     continue
@@ -996,7 +3075,7 @@ class FixedClaudeAIManager:
                     if image_base64:
                         return self._generate_chart_fallback_analysis(gold_price)
                     else:
-                        return f"{emoji('cross')} خطأ في التحليل. يرجى المحاولة مرة أخرى."
+                        return AnalysisFailure(f"{emoji('cross')} خطأ في التحليل. يرجى المحاولة مرة أخرى.")
         
         # إذا فشلت جميع المحاولات
         if image_base64:
@@ -1034,7 +3113,15 @@ class FixedClaudeAIManager:
 {emoji('chart')} التغيير 24h: {gold_price.change_24h:+.2f} ({gold_price.change_percentage:+.2f}%)
 {emoji('up_arrow')} المدى: ${gold_price.low_24h} - ${gold_price.high_24h}
 {emoji('clock')} الوقت: {gold_price.timestamp.strftime('%Y-%m-%d %H:%M:%S')}
-{emoji('signal')} المصدر: {gold_price.source}
+{emoji('signal')} المصدر: {gold_price.source}{' (آخر سعر معروف - التحديث متأخر)' if gold_price.stale else ''}
+"""
+        
+        # شموع حقيقية متعددة الأطر - نص مخزن يتغير فقط عند إغلاق شمعة
+        candle_block = self.candles.prompt_block() if self.candles is not None else ""
+        if candle_block:
+            base_prompt += f"""
+{candle_block}
+اعتمد على هذه الشموع في قراءة الأطر الزمنية بدلاً من تقديرها.
 """
         
         # تخصيص حسب نوع التحليل
@@ -1168,9 +3255,9 @@ class FixedClaudeAIManager:
             
         return context
 
-    def _generate_chart_fallback_analysis(self, gold_price: GoldPrice) -> str:
+    def _generate_chart_fallback_analysis(self, gold_price: GoldPrice) -> AnalysisFailure:
         """تحليل شارت بديل عند فشل Claude"""
-        return f"""{emoji('camera')} **تحليل الشارت - وضع الطوارئ**
+        return AnalysisFailure(f"""{emoji('camera')} **تحليل الشارت - وضع الطوارئ**
 
 {emoji('warning')} Claude API مشغول حالياً، إليك تحليل أساسي:
 
@@ -1193,9 +3280,9 @@ class FixedClaudeAIManager:
 {emoji('refresh')} **حاول مرة أخرى بعد دقائق** - Claude سيكون متاحاً
 {emoji('phone')} **للحصول على تحليل متخصص:** @Odai_xau
 
-{emoji('info')} هذا تحليل تعليمي عام وليس نصيحة استثمارية"""
+{emoji('info')} هذا تحليل تعليمي عام وليس نصيحة استثمارية""")
 
-    def _generate_text_fallback_analysis(self, gold_price: GoldPrice, analysis_type: AnalysisType) -> str:
+    def _generate_text_fallback_analysis(self, gold_price: GoldPrice, analysis_type: AnalysisType) -> AnalysisFailure:
         """تحليل نصي بديل عند فشل Claude"""
         
         # تحديد الاتجاه العام
@@ -1225,146 +3312,1495 @@ class FixedClaudeAIManager:
             target = gold_price.price + 10
             stop_loss = gold_price.price - 10
         
-        if analysis_type == AnalysisType.QUICK:
-            return f"""{emoji('zap')} **تحليل سريع - وضع الطوارئ**
+        if analysis_type == AnalysisType.QUICK:
+            return AnalysisFailure(f"""{emoji('zap')} **تحليل سريع - وضع الطوارئ**
+
+{emoji('warning')} Claude API مشغول، إليك تحليل أساسي:
+
+{emoji('target')} **التوصية:** {recommendation}
+{emoji('up_arrow')} **السعر الحالي:** ${gold_price.price}
+{emoji('chart')} **الاتجاه:** {trend}
+
+{emoji('trophy')} **الهدف:** ${target:.2f}
+{emoji('shield')} **وقف الخسارة:** ${stop_loss:.2f}
+{emoji('fire')} **مستوى الثقة:** 70%
+
+{emoji('refresh')} **حاول مرة أخرى بعد دقائق** - Claude سيكون متاحاً""")
+        
+        else:
+            return AnalysisFailure(f"""{emoji('chart')} **تحليل مفصل - وضع الطوارئ**
+
+{emoji('warning')} Claude API مشغول حالياً، إليك تحليل تقني أساسي:
+
+{emoji('gold')} **معلومات السعر:**
+• السعر: ${gold_price.price}
+• التغيير 24س: {gold_price.change_24h:+.2f} ({gold_price.change_percentage:+.2f}%)
+• المدى: ${gold_price.low_24h} - ${gold_price.high_24h}
+
+{emoji('target')} **التحليل الفني:**
+• الاتجاه العام: {trend}
+• التوصية: {recommendation}
+• الهدف المتوقع: ${target:.2f}
+• وقف الخسارة: ${stop_loss:.2f}
+
+{emoji('shield')} **إدارة المخاطر:**
+• نسبة المخاطرة المقترحة: 2% من المحفظة
+• نسبة المخاطرة/العائد: 1:2
+• مستوى الثقة: 70%
+
+{emoji('clock')} **الإطار الزمني:** 
+• قصير المدى: حذر بسبب التقلبات
+• متوسط المدى: تابع الاتجاه العام
+
+{emoji('refresh')} **حاول مرة أخرى بعد دقائق** - سيكون Claude متاحاً لتحليل أكثر دقة
+{emoji('phone')} **للحصول على تحليل متخصص:** @Odai_xau
+
+{emoji('info')} هذا تحليل تعليمي أساسي وليس نصيحة استثمارية""")
+
+# ==================== Fixed Image Processor ====================
+def chart_dhash(image) -> int:
+    """بصمة إدراكية (dHash) من 64 بت - تبقى ثابتة مع إعادة الضغط وتغيير الحجم"""
+    small = image.convert('L').resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    fingerprint = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            fingerprint = (fingerprint << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return fingerprint
+
+def process_chart_image(image_data: bytes, max_size: int, max_dimension: int,
+                        quality: int) -> Tuple[Optional[str], Optional[int], Dict[str, float]]:
+    """معالجة الشارت مع قياس زمن كل مرحلة - تعمل داخل عملية منفصلة
+    
+    ترجع (الصورة base64، البصمة الإدراكية، أزمنة المراحل)
+    """
+    timings: Dict[str, float] = {}
+    try:
+        if len(image_data) > max_size:
+            raise ValueError(f"Image too large: {len(image_data)} bytes")
+        
+        started = time.perf_counter()
+        image = Image.open(io.BytesIO(image_data))
+        
+        # JPEG: التصغير أثناء فك الترميز (1/2، 1/4، 1/8) بدل فك الصورة كاملة ثم تصغيرها
+        if image.format == 'JPEG' and max(image.size) > max_dimension:
+            ratio = max_dimension / max(image.size)
+            image.draft(image.mode, (math.ceil(image.size[0] * ratio), math.ceil(image.size[1] * ratio)))
+        
+        image.load()
+        timings['decode'] = time.perf_counter() - started
+        
+        # تحسين جودة الشارت
+        started = time.perf_counter()
+        if image.mode in ('RGBA', 'LA'):
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        timings['convert'] = time.perf_counter() - started
+        
+        # تحسين الحدة
+        started = time.perf_counter()
+        if max(image.size) > max_dimension:
+            ratio = max_dimension / max(image.size)
+            new_size = tuple(int(dim * ratio) for dim in image.size)
+            image = image.resize(new_size, Image.Resampling.LANCZOS)
+        timings['resize'] = time.perf_counter() - started
+        
+        started = time.perf_counter()
+        fingerprint = chart_dhash(image)
+        timings['hash'] = time.perf_counter() - started
+        
+        # تحسين الجودة
+        started = time.perf_counter()
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        timings['encode'] = time.perf_counter() - started
+        
+        return image_base64, fingerprint, timings
+    
+    except Exception as e:
+        logger.error(f"Image processing error: {e}")
+        return None, None, timings
+
+def select_photo_variant(photos, target_dimension: int = Config.MAX_IMAGE_DIMENSION):
+    """اختيار أصغر نسخة من الصورة يكفي حجمها للتحليل بدل تحميل الأكبر دائماً"""
+    if not photos:
+        return None
+    
+    large_enough = [photo for photo in photos if max(photo.width, photo.height) >= target_dimension]
+    if large_enough:
+        return min(large_enough, key=lambda photo: photo.width * photo.height)
+    return max(photos, key=lambda photo: photo.width * photo.height)
+
+class FixedImageProcessor:
+    @staticmethod
+    def process_image(image_data: bytes) -> Optional[str]:
+        """معالجة الصور - مُصلح"""
+        image_base64, _, _ = process_chart_image(
+            bytes(image_data), Config.MAX_IMAGE_SIZE, Config.MAX_IMAGE_DIMENSION, Config.IMAGE_QUALITY
+        )
+        return image_base64
+
+class ImagePipelineBusy(Exception):
+    """كل عمال معالجة الصور مشغولون والطابور ممتلئ"""
+
+class ChartImagePipeline:
+    """معالجة الشارتات في pool عمليات منفصل حتى لا تتوقف حلقة الأحداث"""
+    
+    STAGES = ('queue', 'decode', 'convert', 'resize', 'hash', 'encode', 'total')
+    
+    def __init__(self, workers: int = Config.IMAGE_WORKERS,
+                 max_pending: int = Config.IMAGE_MAX_PENDING,
+                 queue_timeout: float = Config.IMAGE_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.stage_totals: Dict[str, float] = {stage: 0.0 for stage in self.STAGES}
+    
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    
+    async def start(self):
+        """تشغيل العمال وتسخينهم حتى لا يدفع أول شارت تكلفة بدء العملية"""
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self.executor = self._create_executor()
+        
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), (255, 255, 255)).save(buffer, format='JPEG')
+        warmup_image = buffer.getvalue()
+        
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(
+                loop.run_in_executor(
+                    self.executor, process_chart_image, warmup_image,
+                    Config.MAX_IMAGE_SIZE, Config.MAX_IMAGE_DIMENSION, Config.IMAGE_QUALITY
+                )
+                for _ in range(self.workers)
+            ))
+            logger.info(f"Image pipeline warmed up: {self.workers} workers in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.warning(f"Image pipeline warm-up failed: {e}")
+    
+    async def process(self, image_data: bytes) -> Tuple[Optional[str], Optional[int]]:
+        """معالجة شارت في عملية منفصلة مع ضغط عكسي - ترجع (الصورة، البصمة)"""
+        if self.executor is None:
+            image_base64, fingerprint, _ = await asyncio.to_thread(
+                process_chart_image, bytes(image_data),
+                Config.MAX_IMAGE_SIZE, Config.MAX_IMAGE_DIMENSION, Config.IMAGE_QUALITY
+            )
+            return image_base64, fingerprint
+        
+        queued_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise ImagePipelineBusy()
+        
+        try:
+            queue_wait = time.perf_counter() - queued_at
+            loop = asyncio.get_running_loop()
+            try:
+                image_base64, fingerprint, timings = await loop.run_in_executor(
+                    self.executor, process_chart_image, bytes(image_data),
+                    Config.MAX_IMAGE_SIZE, Config.MAX_IMAGE_DIMENSION, Config.IMAGE_QUALITY
+                )
+            except BrokenProcessPool:
+                logger.error("Image worker crashed - restarting process pool")
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._create_executor()
+                self.failed += 1
+                return None, None
+            
+            total = time.perf_counter() - queued_at
+            timings.update({'queue': queue_wait, 'total': total})
+            
+            if image_base64 is None:
+                self.failed += 1
+                return None, None
+            
+            self.processed += 1
+            for stage in self.STAGES:
+                self.stage_totals[stage] += timings.get(stage, 0.0)
+            
+            logger.info(
+                "Processed chart image: " +
+                ", ".join(f"{stage}={timings.get(stage, 0.0) * 1000:.0f}ms" for stage in self.STAGES)
+            )
+            return image_base64, fingerprint
+        finally:
+            self._slots.release()
+    
+    async def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'avg_ms': {
+                stage: (total / self.processed * 1000) if self.processed else 0.0
+                for stage, total in self.stage_totals.items()
+            }
+        }
+
+# ==================== Shared State Backends ====================
+class InProcessStateBackend:
+    """حالة حد المعدل والأمان في ذاكرة العملية - لنسخة واحدة من البوت"""
+    
+    name = "memory"
+    
+    def __init__(self):
+        # وقت الوصول النظري (TAT) لكل مستخدم - المستخدم الخامل لا يحتاج أي حالة
+        self.arrivals: Dict[int, float] = {}
+        self.blocked_users: set = set()
+        self.failed_attempts: Dict[int, int] = defaultdict(int)
+        self.user_keys: Dict[int, str] = {}
+        self.active_sessions: Dict[int, datetime] = {}
+    
+    async def start(self):
+        pass
+    
+    async def stop(self):
+        pass
+    
+    # --- حد المعدل ---
+    def get_arrival(self, user_id: int) -> Optional[float]:
+        return self.arrivals.get(user_id)
+    
+    def record_arrival(self, user_id: int, arrival: float, increment: float):
+        self.arrivals[user_id] = arrival
+    
+    def sweep_arrivals(self, now: float) -> int:
+        """حذف المستخدمين الذين امتلأ رصيدهم - حالتهم مطابقة لمستخدم جديد"""
+        idle = [user_id for user_id, arrival in self.arrivals.items() if arrival <= now]
+        for user_id in idle:
+            del self.arrivals[user_id]
+        return len(idle)
+    
+    # --- الأمان ---
+    def is_blocked(self, user_id: int) -> bool:
+        return user_id in self.blocked_users
+    
+    def get_session_key(self, user_id: int) -> Optional[str]:
+        return self.user_keys.get(user_id)
+    
+    async def set_blocked(self, user_id: int, blocked: bool):
+        if blocked:
+            self.blocked_users.add(user_id)
+        else:
+            self.blocked_users.discard(user_id)
+    
+    async def record_failed_attempt(self, user_id: int) -> int:
+        self.failed_attempts[user_id] += 1
+        return self.failed_attempts[user_id]
+    
+    async def create_session(self, user_id: int, license_key: str):
+        self.active_sessions[user_id] = datetime.now()
+        self.user_keys[user_id] = license_key
+        self.failed_attempts[user_id] = 0
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'backend': self.name,
+            'rate_users': len(self.arrivals),
+            'blocked': len(self.blocked_users),
+            'sessions': len(self.user_keys),
+            'last_sync_age': 0.0,
+            'sync_errors': 0
+        }
+
+class PostgresStateBackend(InProcessStateBackend):
+    """حالة مشتركة بين عدة نسخ عبر PostgreSQL
+    
+    الفحوص تبقى محلية (أقل من ملي ثانية)؛ الزيادات تُرسل دفعة واحدة كل
+    SHARED_STATE_SYNC_INTERVAL وتُسحب تحديثات النسخ الأخرى في نفس الاتصال.
+    الحظر والجلسات تُكتب فوراً وتُحدث محلياً كل SHARED_STATE_CACHE_TTL.
+    """
+    
+    name = "postgres"
+    
+    def __init__(self, database_manager: UltraSimpleDatabaseManager,
+                 sync_interval: float = Config.SHARED_STATE_SYNC_INTERVAL,
+                 cache_ttl: float = Config.SHARED_STATE_CACHE_TTL):
+        super().__init__()
+        self.database = database_manager
+        self.sync_interval = sync_interval
+        self.cache_ttl = cache_ttl
+        # زيادات TAT المحلية التي لم تُرسل بعد (بالثواني)
+        self.pending: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._rate_pulled_at = 0.0
+        self._security_pulled_at: Optional[datetime] = None
+        self._next_security_pull = 0.0
+        self._next_cleanup = 0.0
+        self.last_sync = 0.0
+        self.sync_errors = 0
+    
+    async def start(self):
+        try:
+            await self._pull_security(full=True)
+        except Exception as e:
+            # نكمل بحالة محلية فارغة - المزامنة الدورية ستعيد المحاولة
+            self.sync_errors += 1
+            logger.warning(f"Initial shared state load failed: {e}")
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            # بدون cancel - مزامنة جارية تكتمل بدل أن تُقطع بعد سحب الزيادات
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.sync()
+    
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.sync_interval)
+            except asyncio.TimeoutError:
+                await self.sync()
+    
+    def record_arrival(self, user_id: int, arrival: float, increment: float):
+        self.arrivals[user_id] = arrival
+        self.pending[user_id] = self.pending.get(user_id, 0.0) + increment
+    
+    async def sync(self):
+        """إرسال الزيادات المحلية وسحب حالة النسخ الأخرى"""
+        try:
+            await self._sync_rate_limits()
+            if time.monotonic() >= self._next_security_pull:
+                await self._pull_security()
+            self.last_sync = time.monotonic()
+        except Exception as e:
+            self.sync_errors += 1
+            logger.warning(f"Shared state sync failed: {e}")
+    
+    async def _sync_rate_limits(self):
+        batch, self.pending = self.pending, {}
+        now = time.time()
+        # هامش لتفادي فقدان تحديثات متزامنة أو فرق الساعات بين النسخ
+        since = self._rate_pulled_at - self.sync_interval
+        
+        synced = False
+        try:
+            async with self.database.connection() as conn:
+                if batch:
+                    await conn.execute("""
+                        INSERT INTO rate_limit_state (user_id, arrival, updated_at)
+                        SELECT user_id, $3 + increment, $3
+                        FROM unnest($1::bigint[], $2::float8[]) AS t(user_id, increment)
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET arrival = GREATEST(rate_limit_state.arrival, $3) + (EXCLUDED.arrival - $3),
+                            updated_at = $3
+                    """, list(batch.keys()), list(batch.values()), now)
+                
+                rows = await conn.fetch("""
+                    SELECT user_id, arrival FROM rate_limit_state
+                    WHERE updated_at > $1 AND arrival > $2
+                """, since, now)
+                
+                if now >= self._next_cleanup:
+                    await conn.execute("DELETE FROM rate_limit_state WHERE arrival <= $1", now)
+                    self._next_cleanup = now + Config.RATE_LIMIT_SWEEP_INTERVAL
+            synced = True
+        finally:
+            if not synced:
+                # إرجاع الزيادات للدفعة القادمة - حتى عند الإلغاء
+                for user_id, increment in batch.items():
+                    self.pending[user_id] = self.pending.get(user_id, 0.0) + increment
+        
+        self._rate_pulled_at = now
+        for row in rows:
+            # القيمة المشتركة + ما سُجل محلياً أثناء المزامنة
+            remote = row['arrival'] + self.pending.get(row['user_id'], 0.0)
+            if remote > self.arrivals.get(row['user_id'], 0.0):
+                self.arrivals[row['user_id']] = remote
+    
+    async def _pull_security(self, full: bool = False):
+        async with self.database.connection() as conn:
+            if full or self._security_pulled_at is None:
+                rows = await conn.fetch("""
+                    SELECT user_id, blocked, failed_attempts, license_key, session_started, LOCALTIMESTAMP AS pulled_at
+                    FROM security_state WHERE blocked OR license_key IS NOT NULL OR failed_attempts > 0
+                """)
+            else:
+                rows = await conn.fetch("""
+                    SELECT user_id, blocked, failed_attempts, license_key, session_started, LOCALTIMESTAMP AS pulled_at
+                    FROM security_state WHERE updated_at > $1 - INTERVAL '5 seconds'
+                """, self._security_pulled_at)
+            pulled_at = rows[0]['pulled_at'] if rows else await conn.fetchval("SELECT LOCALTIMESTAMP")
+        
+        for row in rows:
+            self._apply_security_row(row)
+        self._security_pulled_at = pulled_at
+        self._next_security_pull = time.monotonic() + self.cache_ttl
+    
+    def _apply_security_row(self, row):
+        user_id = row['user_id']
+        if row['blocked']:
+            self.blocked_users.add(user_id)
+        else:
+            self.blocked_users.discard(user_id)
+        
+        self.failed_attempts[user_id] = row['failed_attempts'] or 0
+        if row['license_key']:
+            self.user_keys[user_id] = row['license_key']
+            if row['session_started']:
+                self.active_sessions[user_id] = row['session_started']
+    
+    async def set_blocked(self, user_id: int, blocked: bool):
+        async with self.database.connection() as conn:
+            await conn.execute("""
+                INSERT INTO security_state (user_id, blocked, updated_at) VALUES ($1, $2, NOW())
+                ON CONFLICT (user_id) DO UPDATE SET blocked = EXCLUDED.blocked, updated_at = NOW()
+            """, user_id, blocked)
+        await super().set_blocked(user_id, blocked)
+    
+    async def record_failed_attempt(self, user_id: int) -> int:
+        async with self.database.connection() as conn:
+            attempts = await conn.fetchval("""
+                INSERT INTO security_state (user_id, failed_attempts, updated_at) VALUES ($1, 1, NOW())
+                ON CONFLICT (user_id) DO UPDATE
+                SET failed_attempts = security_state.failed_attempts + 1, updated_at = NOW()
+                RETURNING failed_attempts
+            """, user_id)
+        self.failed_attempts[user_id] = attempts
+        return attempts
+    
+    async def create_session(self, user_id: int, license_key: str):
+        started = datetime.now()
+        async with self.database.connection() as conn:
+            await conn.execute("""
+                INSERT INTO security_state (user_id, license_key, session_started, failed_attempts, updated_at)
+                VALUES ($1, $2, $3, 0, NOW())
+                ON CONFLICT (user_id) DO UPDATE
+                SET license_key = EXCLUDED.license_key, session_started = EXCLUDED.session_started,
+                    failed_attempts = 0, updated_at = NOW()
+            """, user_id, license_key, started)
+        await super().create_session(user_id, license_key)
+        self.active_sessions[user_id] = started
+    
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        stats.update({
+            'pending': len(self.pending),
+            'last_sync_age': time.monotonic() - self.last_sync if self.last_sync else 0.0,
+            'sync_errors': self.sync_errors
+        })
+        return stats
+
+def create_state_backend(database_manager: UltraSimpleDatabaseManager) -> InProcessStateBackend:
+    """اختيار backend الحالة المشتركة حسب SHARED_STATE_BACKEND"""
+    if Config.SHARED_STATE_BACKEND == "postgres":
+        return PostgresStateBackend(database_manager)
+    return InProcessStateBackend()
+
+# ==================== Fixed Rate Limiter ====================
+class FixedRateLimiter:
+    """محدد معدل GCRA - قيمة واحدة لكل مستخدم نشط وفحص O(1) لكل طلب"""
+    
+    TIER_MULTIPLIERS = {"basic": 1, "premium": 2, "vip": 5}
+    
+    def __init__(self, backend: Optional[InProcessStateBackend] = None,
+                 max_requests: int = Config.RATE_LIMIT_REQUESTS,
+                 window: float = Config.RATE_LIMIT_WINDOW,
+                 sweep_interval: float = Config.RATE_LIMIT_SWEEP_INTERVAL):
+        self.backend = backend or InProcessStateBackend()
+        self.max_requests = max_requests
+        self.window = window
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+        self.evicted = 0
+        self.denied = 0
+    
+    def _limit_for(self, user: User) -> int:
+        return self.max_requests * self.TIER_MULTIPLIERS.get(user.subscription_tier, 1)
+    
+    def is_allowed(self, user_id: int, user: User) -> Tuple[bool, Optional[str]]:
+        """فحص الحد المسموح - مُصلح"""
+        # ساعة الحائط حتى تتفق النسخ المختلفة على نفس TAT
+        now = time.time()
+        if now >= self._next_sweep:
+            self.sweep(now)
+        
+        interval = self.window / self._limit_for(user)
+        arrival = max(self.backend.get_arrival(user_id) or now, now) + interval
+        
+        # يُسمح بدفعة حتى الحد الكامل خلال النافذة
+        if arrival - now > self.window:
+            self.denied += 1
+            wait_time = math.ceil(arrival - self.window - now)
+            return False, f"{emoji('warning')} تجاوزت الحد المسموح. انتظر {wait_time} ثانية."
+        
+        self.backend.record_arrival(user_id, arrival, interval)
+        return True, None
+    
+    def release(self, user_id: int, user: User):
+        """إرجاع الحصة التي حجزها is_allowed لطلب رُفض بعدها (نقاط غير كافية أو طلب مكرر)"""
+        arrival = self.backend.get_arrival(user_id)
+        if arrival is None:
+            return
+        interval = self.window / self._limit_for(user)
+        self.backend.record_arrival(user_id, arrival - interval, -interval)
+    
+    def sweep(self, now: Optional[float] = None):
+        """حذف حالة المستخدمين الخاملين"""
+        now = time.time() if now is None else now
+        self.evicted += self.backend.sweep_arrivals(now)
+        self._next_sweep = now + self.sweep_interval
+    
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            'tracked_users': len(self.backend.arrivals),
+            'denied': self.denied,
+            'evicted': self.evicted
+        }
+
+# ==================== Fixed Security Manager ====================
+class FixedSecurityManager:
+    def __init__(self, backend: Optional[InProcessStateBackend] = None):
+        self.backend = backend or InProcessStateBackend()
+    
+    def verify_license_key(self, key: str) -> bool:
+        """فحص بسيط لصيغة المفتاح"""
+        return key.startswith("GOLD-") and len(key) == 19
+    
+    def is_session_valid(self, user_id: int) -> bool:
+        """فحص صحة الجلسة"""
+        return self.backend.get_session_key(user_id) is not None
+    
+    async def create_session(self, user_id: int, license_key: str):
+        """إنشاء جلسة جديدة"""
+        await self.backend.create_session(user_id, license_key)
+    
+    async def record_failed_attempt(self, user_id: int) -> int:
+        """تسجيل محاولة تفعيل فاشلة"""
+        return await self.backend.record_failed_attempt(user_id)
+    
+    async def block_user(self, user_id: int):
+        await self.backend.set_blocked(user_id, True)
+    
+    async def unblock_user(self, user_id: int):
+        await self.backend.set_blocked(user_id, False)
+    
+    def is_blocked(self, user_id: int) -> bool:
+        """فحص الحظر"""
+        return self.backend.is_blocked(user_id)
+
+# ==================== Request Preflight ====================
+@dataclass
+class PreflightTicket:
+    """طلب مقبول ونقاطه المخصومة - تُسترد ما لم يُعلَّم التحليل كمُسلَّم"""
+    user: User
+    license_key: Optional[str] = None
+    points: int = 0
+    message: Optional[str] = None
+    delivered: bool = False
+    refunded: bool = False
+    deferred: bool = False      # التسوية انتقلت لطابور التحليلات مع المهمة
+
+class RequestPreflight:
+    """بوابة الطلبات المدفوعة: كل الفحوص في الذاكرة أولاً ثم transaction واحدة للخصم والنشاط"""
+    
+    def __init__(self, security: FixedSecurityManager, rate_limiter: FixedRateLimiter,
+                 db_manager: UltraSimpleDBManager, license_manager: UltraSimpleLicenseManager):
+        self.security = security
+        self.rate_limiter = rate_limiter
+        self.db = db_manager
+        self.license_manager = license_manager
+        
+        self.admitted = 0
+        self.rejected: Dict[str, int] = defaultdict(int)
+        self.refunds = 0
+        self.refunded_points = 0
+        self._next_purge = 0.0
+    
+    async def admit(self, telegram_user, request_type: str, points: int = 1,
+                    idempotency_key: Optional[str] = None) -> Tuple[Optional[PreflightTicket], Optional[str]]:
+        """فحص الحظر والتفعيل ثم الخصم - يرجع (التذكرة، None) أو (None، سبب الرفض)
+        
+        (None، None) يعني أن الطلب مكرر وسبق تنفيذه - يُتجاهل بصمت
+        """
+        user_id = telegram_user.id
+        if self.security.is_blocked(user_id):
+            self.rejected['blocked'] += 1
+            return None, f"{emoji('cross')} حسابك محظور. تواصل مع الدعم."
+        
+        user = await self.db.get_user(user_id)
+        if not user:
+            user = User(
+                user_id=user_id,
+                username=telegram_user.username,
+                first_name=telegram_user.first_name
+            )
+            await self.db.add_user(user)
+        
+        if user_id != Config.MASTER_USER_ID and not user.is_activated:
+            self.rejected['inactive'] += 1
+            return None, (
+                f"{emoji('key')} يتطلب تفعيل الحساب\n\n"
+                "للاستخدام، يجب تفعيل حسابك أولاً.\n"
+                "استخدم: /license مفتاح_التفعيل\n\n"
+                f"{emoji('phone')} للتواصل: @Odai_xau"
+            )
+        
+        return await self.charge(user, request_type, points, idempotency_key)
+    
+    async def charge(self, user: User, request_type: str, points: int = 1,
+                     idempotency_key: Optional[str] = None) -> Tuple[Optional[PreflightTicket], Optional[str]]:
+        """حد المعدل والنقاط من الذاكرة، ثم خصم النقاط وحفظ النشاط معاً"""
+        self._schedule_purge()
+        allowed, message = self.rate_limiter.is_allowed(user.user_id, user)
+        if not allowed:
+            # الرفض قبل أي خصم - لا نقاط تضيع بسبب حد المعدل
+            self.rejected['rate_limited'] += 1
+            return None, message
+        
+        user.last_activity = datetime.now()
+        user.total_requests += 1
+        
+        try:
+            if user.user_id == Config.MASTER_USER_ID or points <= 0:
+                if idempotency_key and not await self.db.database.claim_idempotency_key(idempotency_key, user.user_id):
+                    raise DuplicateRequest(idempotency_key)
+                await self.db.add_user(user)
+                self.admitted += 1
+                return PreflightTicket(user), None
+            
+            ok, message = await self.license_manager.check_quota(user.license_key, user.user_id, points)
+            if ok:
+                ok, message = await self.license_manager.charge(user.license_key, user, points, idempotency_key)
+        except DuplicateRequest:
+            # إعادة إرسال لنفس التحديث - لا خصم ولا تحليل ثانٍ
+            user.total_requests -= 1
+            self.rate_limiter.release(user.user_id, user)
+            self.rejected['duplicate'] += 1
+            logger.info(f"Duplicate paid request ignored: {idempotency_key}")
+            return None, None
+        
+        if not ok:
+            user.total_requests -= 1
+            self.rate_limiter.release(user.user_id, user)
+            self.rejected['quota'] += 1
+            return None, message
+        
+        self.admitted += 1
+        logger.debug(f"Preflight admitted {request_type} for {user.user_id} ({points} points)")
+        return PreflightTicket(user, user.license_key, points, message), None
+    
+    def _schedule_purge(self):
+        """حذف مفاتيح الـ idempotency القديمة مرة كل ساعة في الخلفية"""
+        now = time.monotonic()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + 3600
+        asyncio.create_task(self._purge_idempotency_keys())
+    
+    async def _purge_idempotency_keys(self):
+        try:
+            removed = await self.db.database.purge_idempotency_keys(Config.IDEMPOTENCY_TTL_HOURS)
+            if removed:
+                logger.info(f"Purged {removed} expired idempotency keys")
+        except Exception as e:
+            logger.warning(f"Idempotency key purge failed: {e}")
+    
+    async def release(self, ticket: PreflightTicket):
+        """تسوية الطلب: استرداد النقاط إذا فشل التحليل أو انتهت مهلته"""
+        if ticket.delivered or ticket.deferred or ticket.refunded or not ticket.points:
+            return
+        
+        ticket.refunded = await self.refund(ticket.user.user_id, ticket.license_key, ticket.points)
+    
+    async def refund(self, user_id: int, license_key: Optional[str], points: int) -> bool:
+        if not license_key or not points:
+            return False
+        refunded = await self.license_manager.refund(license_key, points)
+        if refunded:
+            self.refunds += 1
+            self.refunded_points += points
+            logger.info(f"Refunded {points} points to user {user_id}")
+        return refunded
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'admitted': self.admitted,
+            'rejected': dict(self.rejected),
+            'refunds': self.refunds,
+            'refunded_points': self.refunded_points
+        }
+
+# ==================== Update De-duplication ====================
+class UpdateDeduplicator:
+    """تجاهل التحديثات التي يعيد تيليجرام إرسالها عند بطء الـ webhook"""
+    
+    def __init__(self, window: float = Config.UPDATE_DEDUP_WINDOW,
+                 max_entries: int = Config.UPDATE_DEDUP_MAX_ENTRIES):
+        self.window = window
+        self.max_entries = max_entries
+        # update_id -> وقت الاستلام، بترتيب الوصول
+        self.seen: "OrderedDict[int, float]" = OrderedDict()
+        self.duplicates = 0
+    
+    def is_duplicate(self, update_id: int) -> bool:
+        now = time.monotonic()
+        while self.seen:
+            oldest_id, received_at = next(iter(self.seen.items()))
+            if now - received_at <= self.window and len(self.seen) < self.max_entries:
+                break
+            del self.seen[oldest_id]
+        
+        if update_id in self.seen:
+            self.duplicates += 1
+            return True
+        self.seen[update_id] = now
+        return False
+    
+    async def handle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """يعمل في المجموعة -1 قبل كل المعالجات"""
+        if self.is_duplicate(update.update_id):
+            logger.info(f"Duplicate update {update.update_id} dropped")
+            raise ApplicationHandlerStop
+    
+    def get_stats(self) -> Dict[str, int]:
+        return {'tracked': len(self.seen), 'duplicates': self.duplicates}
+
+# ==================== Telegram Send Scheduler ====================
+class TokenBucket:
+    """دلو رموز: rate رمز في الثانية حتى capacity"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def delay(self, now: float) -> float:
+        """الثواني المتبقية حتى يتوفر رمز واحد"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def consume(self):
+        self.tokens -= 1
+    
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+@dataclass
+class _EditTicket:
+    future: asyncio.Future
+    superseded_by: Optional['_EditTicket'] = None
+
+class TelegramSendScheduler(BaseRateLimiter):
+    """طابور الإرسال المركزي لكل طلبات البوت
+    
+    يوزع الإرسال بين دلو عام ودلو لكل محادثة، ويحترم RetryAfter، ويدمج
+    تعديلات نفس الرسالة المتتالية في تعديل واحد بآخر نص.
+    """
+    
+    PACED_ENDPOINTS = frozenset({
+        'sendMessage', 'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup',
+        'sendPhoto', 'sendDocument', 'sendMediaGroup', 'copyMessage', 'forwardMessage'
+    })
+    MERGEABLE_ENDPOINTS = frozenset({'editMessageText'})
+    SWEEP_INTERVAL = 60
+    
+    def __init__(self, global_rate: float = Config.TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = Config.TELEGRAM_CHAT_RATE,
+                 group_rate: float = Config.TELEGRAM_GROUP_RATE,
+                 chat_burst: int = Config.TELEGRAM_CHAT_BURST,
+                 max_retries: int = Config.TELEGRAM_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self._pending_edits: Dict[Tuple[Any, Any], _EditTicket] = {}
+        self._paused_until = 0.0
+        self._next_sweep = time.monotonic() + self.SWEEP_INTERVAL
+        
+        self.queued = 0
+        self.sent = 0
+        self.merged_edits = 0
+        self.retry_after_hits = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+    
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+    
+    def _sweep(self, now: float):
+        idle = [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.is_full(now)]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
+        self._next_sweep = now + self.SWEEP_INTERVAL
+    
+    async def _wait_turn(self, chat_id, ticket: Optional[_EditTicket]) -> bool:
+        """الانتظار حتى يتوفر رمز عام ورمز للمحادثة - False إذا حل محله تعديل أحدث"""
+        while True:
+            if ticket is not None and ticket.superseded_by is not None:
+                return False
+            
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep(now)
+            
+            chat_bucket = self._chat_bucket(chat_id)
+            wait = max(self._paused_until - now, self.global_bucket.delay(now), chat_bucket.delay(now))
+            if wait <= 0:
+                self.global_bucket.consume()
+                chat_bucket.consume()
+                return True
+            await asyncio.sleep(wait)
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint not in self.PACED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        
+        chat_id = data.get('chat_id')
+        ticket = None
+        edit_key = None
+        if endpoint in self.MERGEABLE_ENDPOINTS and data.get('message_id') is not None:
+            edit_key = (chat_id, data['message_id'])
+            ticket = _EditTicket(asyncio.get_running_loop().create_future())
+            previous = self._pending_edits.get(edit_key)
+            if previous is not None:
+                previous.superseded_by = ticket
+            self._pending_edits[edit_key] = ticket
+        
+        queued_at = time.monotonic()
+        self.queued += 1
+        waiting = True
+        # غلاف واحد لكل المسار: أي خروج (حتى الإلغاء أثناء الانتظار) يحسم الـ future وينظف _pending_edits
+        try:
+            if not await self._wait_turn(chat_id, ticket):
+                # تعديل أحدث لنفس الرسالة سيحمل النص الأخير - ننتظر نتيجته بدل الإرسال
+                self.merged_edits += 1
+                newest = ticket
+                while newest.superseded_by is not None:
+                    newest = newest.superseded_by
+                return await asyncio.shield(newest.future)
+            
+            self.queued -= 1
+            waiting = False
+            latency = time.monotonic() - queued_at
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = await callback(*args, **kwargs)
+                    self.sent += 1
+                    if ticket is not None:
+                        ticket.future.set_result(result)
+                    return result
+                except RetryAfter as e:
+                    self.retry_after_hits += 1
+                    if attempt >= self.max_retries:
+                        raise
+                    # تيليجرام يطلب التوقف - نوقف كل الإرسال وليس هذا الطلب فقط
+                    retry_after = float(e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after)
+                    logger.warning(f"Telegram RetryAfter {retry_after}s on {endpoint} (chat {chat_id})")
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    await self._wait_turn(chat_id, None)
+        except BaseException as e:
+            # المنتظرون المدمجون في هذا التعديل لا يبقون معلقين
+            if ticket is not None and not ticket.future.done():
+                if isinstance(e, Exception):
+                    ticket.future.set_exception(e)
+                    # منع تحذير "exception was never retrieved" عند عدم وجود منتظرين
+                    ticket.future.exception()
+                else:
+                    ticket.future.cancel()
+            raise
+        finally:
+            if waiting:
+                self.queued -= 1
+            if edit_key is not None and self._pending_edits.get(edit_key) is ticket:
+                del self._pending_edits[edit_key]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'merged_edits': self.merged_edits,
+            'retry_after': self.retry_after_hits,
+            'avg_latency': self.total_latency / self.sent if self.sent else 0.0,
+            'max_latency': self.max_latency,
+            'chats': len(self.chat_buckets)
+        }
+
+# ==================== Broadcast Engine ====================
+class BroadcastEngine:
+    """بث رسائل الإدارة لكل المستخدمين بمعدل محدود مع استئناف بعد إعادة التشغيل"""
+    
+    def __init__(self, database_manager: UltraSimpleDatabaseManager,
+                 rate: float = Config.BROADCAST_RATE,
+                 workers: int = Config.BROADCAST_WORKERS,
+                 page_size: int = Config.BROADCAST_PAGE_SIZE,
+                 lease: int = Config.BROADCAST_LEASE,
+                 checkpoint_interval: float = Config.BROADCAST_CHECKPOINT_INTERVAL):
+        self.database = database_manager
+        self.rate = rate
+        self.workers = workers
+        self.page_size = page_size
+        self.lease = lease
+        self.checkpoint_interval = min(checkpoint_interval, lease / 3)
+        # معرف هذه النسخة في عمود owner - نسختان لا تستأنفان نفس البث
+        self.owner = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.bot = None
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._claim_task: Optional[asyncio.Task] = None
+        # عدادات حية لكل بث جارٍ: sent/failed/blocked + وقت البدء
+        self.progress: Dict[int, Dict[str, Any]] = {}
+    
+    async def start(self, bot):
+        """استئناف البث غير المكتمل الذي لا تملكه نسخة حية"""
+        self.bot = bot
+        await self._claim()
+        self._claim_task = asyncio.create_task(self._claim_loop())
+    
+    async def _claim(self):
+        try:
+            claimed = await self.database.claim_broadcasts(self.owner, self.lease)
+        except Exception as e:
+            logger.error(f"Error claiming pending broadcasts: {e}")
+            return
+        
+        for broadcast in claimed:
+            if broadcast['id'] in self._tasks:
+                continue
+            logger.info(f"Resuming broadcast #{broadcast['id']} after user {broadcast['last_user_id']}")
+            self._launch(broadcast)
+    
+    async def _claim_loop(self):
+        """التقاط البث المتروك من نسخة توقفت فجأة بعد انتهاء حجزها"""
+        while True:
+            await asyncio.sleep(self.lease / 2)
+            await self._claim()
+    
+    async def create(self, message: str, created_by: int) -> Dict[str, Any]:
+        broadcast = await self.database.create_broadcast(message, created_by, self.owner, self.lease)
+        self._launch(broadcast)
+        return broadcast
+    
+    def _launch(self, broadcast: Dict[str, Any]):
+        self.progress[broadcast['id']] = {
+            'sent': broadcast['sent'],
+            'failed': broadcast['failed'],
+            'blocked': broadcast['blocked'],
+            'total': broadcast['total'],
+            'resumed_from': broadcast['sent'] + broadcast['failed'] + broadcast['blocked'],
+            'started': time.monotonic(),
+            'cursor': broadcast['last_user_id'],
+            'lost': False
+        }
+        self._tasks[broadcast['id']] = asyncio.create_task(self._run(broadcast))
+    
+    async def _run(self, broadcast: Dict[str, Any]):
+        broadcast_id = broadcast['id']
+        progress = self.progress[broadcast_id]
+        status = 'done'
+        # الحفظ وتجديد الحجز على مؤقت - توقف RetryAfter الطويل لا يُسقط الحجز وسط الصفحة
+        checkpoints = asyncio.create_task(self._checkpoint_loop(broadcast_id, progress))
+        
+        try:
+            while not progress['lost']:
+                recipients = await self.database.get_broadcast_recipients(progress['cursor'], self.page_size)
+                if not recipients:
+                    break
+                
+                queue: asyncio.Queue = asyncio.Queue()
+                for user_id in recipients:
+                    queue.put_nowait(user_id)
+                page = {'recipients': recipients, 'done': set(), 'next': 0}
+                await asyncio.gather(*(
+                    self._worker(queue, broadcast['message'], progress, page)
+                    for _ in range(min(self.workers, len(recipients)))
+                ))
+        except asyncio.CancelledError:
+            # إيقاف البوت - يبقى 'running' ويُحفظ المؤشر الحالي ليُستأنف من بعده
+            checkpoints.cancel()
+            await asyncio.gather(checkpoints, return_exceptions=True)
+            if not progress['lost']:
+                try:
+                    await self.database.save_broadcast_progress(
+                        broadcast_id, progress['cursor'], progress['sent'], progress['failed'], progress['blocked'],
+                        self.owner, self.lease
+                    )
+                except Exception as e:
+                    logger.error(f"Error saving progress of stopped broadcast #{broadcast_id}: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast #{broadcast_id} stopped: {e}")
+            status = 'failed'
+        finally:
+            self._tasks.pop(broadcast_id, None)
+            checkpoints.cancel()
+            await asyncio.gather(checkpoints, return_exceptions=True)
+        
+        if progress['lost']:
+            # انتهى الحجز واستأنفته نسخة أخرى - نتوقف بدل الإرسال المكرر
+            logger.warning(f"Broadcast #{broadcast_id} lease lost, stopping")
+            self.progress.pop(broadcast_id, None)
+            return
+        
+        try:
+            await self.database.save_broadcast_progress(
+                broadcast_id, progress['cursor'], progress['sent'], progress['failed'], progress['blocked'],
+                self.owner, self.lease, status
+            )
+        except Exception as e:
+            logger.error(f"Error saving final state of broadcast #{broadcast_id}: {e}")
+        await self._notify_finished(broadcast, status)
+    
+    async def _checkpoint_loop(self, broadcast_id: int, progress: Dict[str, Any]):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                owned = await self.database.save_broadcast_progress(
+                    broadcast_id, progress['cursor'], progress['sent'], progress['failed'], progress['blocked'],
+                    self.owner, self.lease
+                )
+            except Exception as e:
+                logger.warning(f"Error saving progress of broadcast #{broadcast_id}: {e}")
+                continue
+            if not owned:
+                progress['lost'] = True
+                return
+    
+    async def _worker(self, queue: asyncio.Queue, message: str,
+                      progress: Dict[str, Any], page: Dict[str, Any]):
+        while not queue.empty() and not progress['lost']:
+            user_id = queue.get_nowait()
+            
+            wait = self.bucket.delay(time.monotonic())
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.bucket.delay(time.monotonic())
+            self.bucket.consume()
+            
+            try:
+                await self.bot.send_message(chat_id=user_id, text=message)
+                progress['sent'] += 1
+            except Forbidden:
+                # المستخدم حظر البوت أو حذف حسابه
+                progress['blocked'] += 1
+            except Exception as e:
+                logger.debug(f"Broadcast send to {user_id} failed: {e}")
+                progress['failed'] += 1
+            
+            # المؤشر = أعلى مستلم اكتمل كل من قبله - الاستئناف يعيد الإرسال لعدد العمال على الأكثر
+            recipients = page['recipients']
+            page['done'].add(user_id)
+            while page['next'] < len(recipients) and recipients[page['next']] in page['done']:
+                progress['cursor'] = recipients[page['next']]
+                page['next'] += 1
+    
+    async def _notify_finished(self, broadcast: Dict[str, Any], status: str):
+        stats = self.get_progress(broadcast['id'])
+        self.progress.pop(broadcast['id'], None)
+        try:
+            await self.bot.send_message(
+                chat_id=broadcast['created_by'],
+                text=f"{emoji('check') if status == 'done' else emoji('warning')} انتهى البث #{broadcast['id']}\n\n"
+                     f"• وصل: {stats['sent']}\n"
+                     f"• فشل: {stats['failed']}\n"
+                     f"• حظروا البوت: {stats['blocked']}\n"
+                     f"• السرعة: {stats['throughput']:.1f} رسالة/ث"
+            )
+        except Exception as e:
+            logger.warning(f"Broadcast completion notice failed: {e}")
+    
+    def get_progress(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        progress = self.progress.get(broadcast_id)
+        if progress is None:
+            return None
+        
+        processed = progress['sent'] + progress['failed'] + progress['blocked']
+        elapsed = time.monotonic() - progress['started']
+        throughput = (processed - progress['resumed_from']) / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, progress['total'] - processed)
+        return {
+            'sent': progress['sent'],
+            'failed': progress['failed'],
+            'blocked': progress['blocked'],
+            'processed': processed,
+            'total': progress['total'],
+            'throughput': throughput,
+            'eta': remaining / throughput if throughput > 0 else None
+        }
+    
+    async def stop(self):
+        """إيقاف البث الجاري - التقدم محفوظ حتى آخر صفحة والحجز يُفك لنسخة أخرى"""
+        tasks = list(self._tasks.values())
+        if self._claim_task:
+            tasks.append(self._claim_task)
+            self._claim_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        try:
+            await self.database.release_broadcasts(self.owner)
+        except Exception as e:
+            logger.error(f"Error releasing broadcasts: {e}")
+
+# ==================== Analysis Job Queue ====================
+class AnalysisJobRejected(Exception):
+    """فشل نهائي لا تفيد معه إعادة المحاولة (مثل صورة غير قابلة للمعالجة)"""
+    pass
+
+class AnalysisJobQueue:
+    """طابور تحليلات محفوظ في PostgreSQL - المعالج يرد فوراً والعمال يولدون التحليل ويسلمونه"""
+    
+    def __init__(self, database_manager: UltraSimpleDatabaseManager, preflight: RequestPreflight,
+                 workers: int = Config.ANALYSIS_WORKERS,
+                 max_attempts: int = Config.ANALYSIS_JOB_MAX_ATTEMPTS,
+                 retry_delay: float = Config.ANALYSIS_JOB_RETRY_DELAY,
+                 lease: int = Config.ANALYSIS_JOB_LEASE,
+                 poll_interval: float = Config.ANALYSIS_JOB_POLL_INTERVAL):
+        self.database = database_manager
+        self.preflight = preflight
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.bot = None
+        self.bot_data: Dict[str, Any] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        # المهام المحجوزة في هذه النسخة - تُعاد للطابور فوراً عند الإيقاف
+        self.in_flight: Dict[int, float] = {}
+        
+        self.enqueued = 0
+        self.completed = 0
+        self.retried = 0
+        self.dead = 0
+        self.recovered = 0
+        self.total_run_time = 0.0
+    
+    async def start(self, application: Application):
+        """استعادة المهام العالقة من تشغيل سابق ثم تشغيل العمال"""
+        self.bot = application.bot
+        self.bot_data = application.bot_data
+        await self._recover()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._recovery_loop()))
+    
+    async def enqueue(self, **job) -> int:
+        """حفظ المهمة وإيقاظ العمال - المعالج لا ينتظر التحليل"""
+        job_id = await self.database.enqueue_analysis_job(job)
+        self.enqueued += 1
+        self._wakeup.set()
+        return job_id
+    
+    async def _recover(self):
+        try:
+            recovered = await self.database.recover_analysis_jobs(self.lease, list(self.in_flight))
+        except Exception as e:
+            logger.error(f"Error recovering analysis jobs: {e}")
+            return
+        if recovered:
+            self.recovered += recovered
+            logger.info(f"Recovered {recovered} stalled analysis jobs")
+            self._wakeup.set()
+    
+    async def _recovery_loop(self):
+        while True:
+            await asyncio.sleep(max(self.lease / 3, self.poll_interval))
+            await self._recover()
+    
+    async def _worker(self):
+        while True:
+            # المسح قبل الحجز - أي مهمة تُضاف بعده توقظ العامل من جديد
+            self._wakeup.clear()
+            try:
+                job = await self.database.claim_analysis_job()
+            except Exception as e:
+                logger.error(f"Error claiming analysis job: {e}")
+                job = None
+            
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            self.in_flight[job['id']] = time.monotonic()
+            heartbeat = asyncio.create_task(self._heartbeat(job['id']))
+            try:
+                await self._process(job)
+            except Exception as e:
+                logger.error(f"Error settling analysis job #{job['id']}: {e}")
+            finally:
+                heartbeat.cancel()
+                self.in_flight.pop(job['id'], None)
+    
+    async def _heartbeat(self, job_id: int):
+        """تجديد الـ lease كل ثلث مدته طالما المهمة تُنفذ - التحليل الطويل لا يُستعاد كمهمة عالقة"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if not await self.database.touch_analysis_job(job_id):
+                    logger.warning(f"Analysis job #{job_id} lease lost while running")
+                    return
+            except Exception as e:
+                logger.error(f"Error renewing lease for analysis job #{job_id}: {e}")
+    
+    async def _process(self, job: Dict[str, Any]):
+        started = time.monotonic()
+        editor = StreamingMessageEditor(self._job_message(job))
+        
+        if job['attempts'] > self.max_attempts:
+            # استُعيدت بعد توقف البوت أثناء تنفيذها أكثر من مرة
+            await self._dead_letter(job, editor, None, "attempts exhausted by restarts")
+            return
+        
+        try:
+            result = await self._execute(job, editor)
+        except AnalysisJobRejected as e:
+            await self._dead_letter(job, editor, str(e), str(e))
+            return
+        except Exception as e:
+            logger.error(f"Analysis job #{job['id']} attempt {job['attempts']} failed: {e}")
+            result = AnalysisFailure(f"{emoji('cross')} حدث خطأ أثناء التحليل.")
+            error = str(e) or type(e).__name__
+        else:
+            error = str(result) if isinstance(result, AnalysisFailure) else None
+        
+        if error is None:
+            # الحالة حُسمت في _execute فور التسليم
+            self.completed += 1
+            self.total_run_time += time.monotonic() - started
+            return
+        
+        if job['attempts'] < self.max_attempts:
+            delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+            if not await self.database.retry_analysis_job(job['id'], delay, error[:500]):
+                # حجزها عامل آخر بعد انتهاء الـ lease - هو المسؤول عنها الآن
+                logger.warning(f"Analysis job #{job['id']} retry skipped: lease lost")
+                return
+            self.retried += 1
+            await self._notify(
+                job, editor,
+                f"{emoji('clock')} ضغط مؤقت على خدمة التحليل\n"
+                f"{emoji('refresh')} إعادة المحاولة تلقائياً خلال {delay:.0f} ثانية ({job['attempts']}/{self.max_attempts})..."
+            )
+        else:
+            await self._dead_letter(job, editor, result, error)
+    
+    async def _execute(self, job: Dict[str, Any], editor: "StreamingMessageEditor") -> str:
+        """توليد التحليل وتسليمه - يرجع AnalysisFailure بدون تسليم إذا فشل التوليد"""
+        analysis_type = AnalysisType(job['analysis_type'])
+        db = self.bot_data['db']
+        user = await db.get_user(job['user_id'])
+        
+        image_base64 = fingerprint = image_data = None
+        if job['image_file_id']:
+            image_base64, fingerprint, image_data = await self._load_chart(job['image_file_id'])
+        
+        price = await self.bot_data['gold_price_manager'].get_gold_price()
+        if not price:
+            return AnalysisFailure(f"{emoji('cross')} لا يمكن الحصول على السعر حالياً.")
+        
+        result = await self.bot_data['claude_manager'].analyze_gold(
+            prompt=job['prompt'],
+            gold_price=price,
+            image_base64=image_base64,
+            analysis_type=analysis_type,
+            user_settings=user.settings if user else {},
+            on_stream=editor.update,
+            user_id=job['user_id'],
+            priority=AnalysisPriority(job['priority']),
+            image_fingerprint=fingerprint
+        )
+        if isinstance(result, AnalysisFailure):
+            return result
+        
+        await editor.finalize(self._render(job, analysis_type, result), reply_markup=self._reply_markup(job))
+        
+        # التحليل وصل للمستخدم - تُعلَّم المهمة منتهية قبل أي تسجيل فلا تُعاد ولا تُسترد نقاطها
+        await self._mark_done(job)
+        
+        try:
+            analysis = Analysis(
+                id=f"{job['user_id']}_{datetime.now().timestamp()}",
+                user_id=job['user_id'],
+                timestamp=datetime.now(),
+                analysis_type=job['label'] or analysis_type.value,
+                prompt=job['prompt'],
+                result=result[:500],
+                gold_price=price.price,
+                image_data=image_data[:1000] if image_data else None
+            )
+            await db.add_analysis(analysis)
+            
+            # تحليلات الأزرار لا تدخل في عداد تحليلات المستخدم
+            if user is not None and job['source'] != 'callback':
+                user.total_analyses += 1
+                await db.add_user(user)
+        except Exception as e:
+            logger.error(f"Error recording delivered analysis job #{job['id']}: {e}")
+        return result
+    
+    async def _mark_done(self, job: Dict[str, Any]):
+        try:
+            if not await self.database.finish_analysis_job(job['id'], 'done'):
+                logger.warning(f"Analysis job #{job['id']} finished after its lease was lost")
+        except Exception as e:
+            # نادر: القاعدة غير متاحة - لا نحوّلها لفشل يعيد التحليل أو يسترد النقاط فوراً
+            logger.error(f"Error marking analysis job #{job['id']} done: {e}")
+    
+    async def _load_chart(self, file_id: str) -> Tuple[str, Optional[int], bytearray]:
+        photo_file = await self.bot.get_file(file_id)
+        image_data = await photo_file.download_as_bytearray()
+        
+        # ImagePipelineBusy مؤقت - يُعاد كمحاولة عادية
+        image_base64, fingerprint = await self.bot_data['image_pipeline'].process(image_data)
+        if not image_base64:
+            raise AnalysisJobRejected(f"{emoji('cross')} لا يمكن معالجة الصورة. تأكد من وضوح الشارت.")
+        return image_base64, fingerprint, image_data
+    
+    @staticmethod
+    def _render(job: Dict[str, Any], analysis_type: AnalysisType, result: str) -> str:
+        if job['source'] == 'photo':
+            return f"""{emoji('camera')} **تحليل الشارت المتقدم - Fixed & Enhanced**
 
-{emoji('warning')} Claude API مشغول، إليك تحليل أساسي:
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-{emoji('target')} **التوصية:** {recommendation}
-{emoji('up_arrow')} **السعر الحالي:** ${gold_price.price}
-{emoji('chart')} **الاتجاه:** {trend}
+{result}
 
-{emoji('trophy')} **الهدف:** ${target:.2f}
-{emoji('shield')} **وقف الخسارة:** ${stop_loss:.2f}
-{emoji('fire')} **مستوى الثقة:** 70%
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+{emoji('diamond')} **تم بواسطة Gold Nightmare Academy**
+{emoji('camera')} **تحليل الشارت المُصلح والمُحسن**
+{emoji('brain')} **ذكاء اصطناعي محسن لقراءة الشارت**
+{emoji('target')} **نقاط دخول وخروج بدقة السنت الواحد**
+{emoji('zap')} **أداء مُصلح - استجابة سريعة**
+{emoji('key')} **40 مفتاح ثابت - لا يُحذف أبداً**
 
-{emoji('refresh')} **حاول مرة أخرى بعد دقائق** - Claude سيكون متاحاً"""
+{emoji('warning')} **تنبيه:** هذا تحليل تعليمي وليس نصيحة استثمارية"""
         
-        else:
-            return f"""{emoji('chart')} **تحليل مفصل - وضع الطوارئ**
-
-{emoji('warning')} Claude API مشغول حالياً، إليك تحليل تقني أساسي:
-
-{emoji('gold')} **معلومات السعر:**
-• السعر: ${gold_price.price}
-• التغيير 24س: {gold_price.change_24h:+.2f} ({gold_price.change_percentage:+.2f}%)
-• المدى: ${gold_price.low_24h} - ${gold_price.high_24h}
-
-{emoji('target')} **التحليل الفني:**
-• الاتجاه العام: {trend}
-• التوصية: {recommendation}
-• الهدف المتوقع: ${target:.2f}
-• وقف الخسارة: ${stop_loss:.2f}
-
-{emoji('shield')} **إدارة المخاطر:**
-• نسبة المخاطرة المقترحة: 2% من المحفظة
-• نسبة المخاطرة/العائد: 1:2
-• مستوى الثقة: 70%
-
-{emoji('clock')} **الإطار الزمني:** 
-• قصير المدى: حذر بسبب التقلبات
-• متوسط المدى: تابع الاتجاه العام
-
-{emoji('refresh')} **حاول مرة أخرى بعد دقائق** - سيكون Claude متاحاً لتحليل أكثر دقة
-{emoji('phone')} **للحصول على تحليل متخصص:** @Odai_xau
+        if job['source'] == 'callback' and analysis_type == AnalysisType.NIGHTMARE:
+            # توقيع خاص للتحليل الشامل المتقدم
+            return f"""{result}
 
-{emoji('info')} هذا تحليل تعليمي أساسي وليس نصيحة استثمارية"""
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+🔥 **تم بواسطة Gold Nightmare Academy** 🔥
+💎 **التحليل الشامل المتقدم - Premium (5 نقاط)**
+⚡ **تحليل متقدم بالذكاء الاصطناعي Claude المحسن**
+🎯 **دقة التحليل: 95%+ - نقاط بالسنت الواحد**
+📸 **تحليل الشارت المتقدم متاح - أرسل صورة!**
+🛡️ **40 مفتاح ثابت فقط - لا يُحذف أبداً**
+🔑 **النظام مُصلح - اتصال مباشر فقط**
+💰 **تكلفة هذا التحليل: 5 نقاط (يستحق كل نقطة)**
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-# ==================== Fixed Image Processor ====================
-class FixedImageProcessor:
+⚠️ **تنبيه هام:** هذا تحليل تعليمي متقدم وليس نصيحة استثمارية
+💡 **استخدم إدارة المخاطر دائماً ولا تستثمر أكثر مما تستطيع خسارته**"""
+        
+        return result
+    
     @staticmethod
-    def process_image(image_data: bytes) -> Optional[str]:
-        """معالجة الصور - مُصلح"""
-        try:
-            if len(image_data) > Config.MAX_IMAGE_SIZE:
-                raise ValueError(f"Image too large: {len(image_data)} bytes")
-            
-            image = Image.open(io.BytesIO(image_data))
-            
-            # تحسين جودة الشارت
-            if image.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', image.size, (255, 255, 255))
-                if image.mode == 'RGBA':
-                    background.paste(image, mask=image.split()[-1])
-                else:
-                    background.paste(image, mask=image.split()[-1])
-                image = background
-            elif image.mode not in ('RGB', 'L'):
-                image = image.convert('RGB')
-            
-            # تحسين الحدة
-            if max(image.size) > Config.MAX_IMAGE_DIMENSION:
-                ratio = Config.MAX_IMAGE_DIMENSION / max(image.size)
-                new_size = tuple(int(dim * ratio) for dim in image.size)
-                image = image.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # تحسين الجودة
-            buffer = io.BytesIO()
-            image.save(buffer, format='JPEG', quality=Config.IMAGE_QUALITY, optimize=True)
-            
-            image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            
-            logger.info(f"Processed chart image: {image.size}, {len(buffer.getvalue())} bytes")
-            return image_base64
-            
-        except Exception as e:
-            logger.error(f"Image processing error: {e}")
+    def _reply_markup(job: Dict[str, Any]) -> Optional[InlineKeyboardMarkup]:
+        if job['source'] != 'callback':
             return None
-
-# ==================== Fixed Rate Limiter ====================
-class FixedRateLimiter:
-    def __init__(self):
-        self.requests: Dict[int, List[datetime]] = defaultdict(list)
+        return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع للقائمة", callback_data="back_main")]])
     
-    def is_allowed(self, user_id: int, user: User) -> Tuple[bool, Optional[str]]:
-        """فحص الحد المسموح - مُصلح"""
-        now = datetime.now()
-        
-        # تنظيف الطلبات القديمة
-        cutoff_time = now - timedelta(seconds=Config.RATE_LIMIT_WINDOW)
-        self.requests[user_id] = [
-            req_time for req_time in self.requests[user_id]
-            if req_time > cutoff_time
-        ]
-        
-        max_requests = Config.RATE_LIMIT_REQUESTS
-        if user.subscription_tier == "premium":
-            max_requests *= 2
-        elif user.subscription_tier == "vip":
-            max_requests *= 5
-        
-        if len(self.requests[user_id]) >= max_requests:
-            wait_time = Config.RATE_LIMIT_WINDOW - (now - self.requests[user_id][0]).seconds
-            return False, f"{emoji('warning')} تجاوزت الحد المسموح. انتظر {wait_time} ثانية."
-        
-        self.requests[user_id].append(now)
-        return True, None
-
-# ==================== Fixed Security Manager ====================
-class FixedSecurityManager:
-    def __init__(self):
-        self.active_sessions: Dict[int, datetime] = {}
-        self.failed_attempts: Dict[int, int] = defaultdict(int)
-        self.blocked_users: set = set()
-        self.user_keys: Dict[int, str] = {}
+    def _job_message(self, job: Dict[str, Any]) -> Message:
+        """إعادة بناء رسالة المعالجة من المعرفات المحفوظة - تعمل بعد إعادة التشغيل أيضاً"""
+        chat = Chat(id=job['chat_id'], type=ChatType.PRIVATE if job['chat_id'] > 0 else ChatType.SUPERGROUP)
+        chat.set_bot(self.bot)
+        message = Message(message_id=job['message_id'], date=datetime.now(timezone.utc), chat=chat)
+        message.set_bot(self.bot)
+        return message
     
-    def verify_license_key(self, key: str) -> bool:
-        """فحص بسيط لصيغة المفتاح"""
-        return key.startswith("GOLD-") and len(key) == 19
+    async def _notify(self, job: Dict[str, Any], editor: "StreamingMessageEditor", text: str):
+        try:
+            await editor.finalize(text, reply_markup=self._reply_markup(job))
+        except Exception as e:
+            logger.warning(f"Analysis job #{job['id']} notice failed: {e}")
     
-    def is_session_valid(self, user_id: int) -> bool:
-        """فحص صحة الجلسة"""
-        return user_id in self.user_keys
+    async def _dead_letter(self, job: Dict[str, Any], editor: "StreamingMessageEditor",
+                           failure: Optional[str], error: str):
+        """إيقاف المهمة نهائياً واسترداد نقاطها - تبقى في الجدول بحالة 'dead' للمراجعة"""
+        # الحالة أولاً: توقف البوت هنا لا يؤدي لاسترداد مزدوج
+        if not await self.database.finish_analysis_job(job['id'], 'dead', error[:500]):
+            logger.warning(f"Analysis job #{job['id']} dead-letter skipped: lease lost")
+            return
+        self.dead += 1
+        logger.warning(f"Analysis job #{job['id']} dead-lettered after {job['attempts']} attempts: {error}")
+        
+        refunded = await self.preflight.refund(job['user_id'], job['license_key'], job['points'])
+        text = failure or f"{emoji('cross')} تعذر إكمال التحليل بعد عدة محاولات."
+        if refunded:
+            text += f"\n\n{emoji('check')} تم استرداد {job['points']} نقطة إلى مفتاحك."
+        await self._notify(job, editor, text)
     
-    def create_session(self, user_id: int, license_key: str):
-        """إنشاء جلسة جديدة"""
-        self.active_sessions[user_id] = datetime.now()
-        self.user_keys[user_id] = license_key
-        self.failed_attempts[user_id] = 0
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'enqueued': self.enqueued,
+            'running': len(self.in_flight),
+            'completed': self.completed,
+            'retried': self.retried,
+            'dead': self.dead,
+            'recovered': self.recovered,
+            'avg_run_time': self.total_run_time / self.completed if self.completed else 0.0
+        }
     
-    def is_blocked(self, user_id: int) -> bool:
-        """فحص الحظر"""
-        return user_id in self.blocked_users
+    async def stop(self):
+        """إيقاف العمال وإرجاع المهام الجارية للطابور بدل انتظار انتهاء الـ lease"""
+        interrupted = list(self.in_flight)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        
+        try:
+            requeued = await self.database.requeue_analysis_jobs(interrupted)
+            if requeued:
+                logger.info(f"Requeued {requeued} interrupted analysis jobs")
+        except Exception as e:
+            logger.error(f"Error requeueing interrupted analysis jobs: {e}")
 
 # ==================== Fixed Utilities ====================
 def clean_markdown_text(text: str) -> str:
@@ -1382,6 +4818,32 @@ def clean_markdown_text(text: str) -> str:
     
     return text
 
+def split_message_parts(text: str, max_length: int = 4000) -> List[str]:
+    """تقسيم النص إلى أجزاء لا تتجاوز حد تيليجرام مع احترام الأسطر"""
+    parts = []
+    current_part = ""
+    
+    for line in text.split('\n'):
+        # السطر الأطول من الحد يُقسم قسراً
+        while len(line) > max_length:
+            if current_part:
+                parts.append(current_part)
+                current_part = ""
+            parts.append(line[:max_length])
+            line = line[max_length:]
+        
+        if len(current_part) + len(line) + 1 > max_length:
+            if current_part:
+                parts.append(current_part)
+            current_part = line
+        else:
+            current_part += '\n' + line if current_part else line
+    
+    if current_part:
+        parts.append(current_part)
+    
+    return parts
+
 async def send_long_message_fixed(update: Update, text: str, parse_mode: str = None, reply_markup=None):
     """إرسال رسائل طويلة - مُصلح"""
     max_length = 4000
@@ -1403,21 +4865,7 @@ async def send_long_message_fixed(update: Update, text: str, parse_mode: str = N
         return
     
     # تقسيم الرسالة
-    parts = []
-    current_part = ""
-    
-    for line in text.split('\n'):
-        if len(current_part) + len(line) + 1 > max_length:
-            if current_part:
-                parts.append(current_part)
-                current_part = line
-            else:
-                parts.append(line[:max_length])
-        else:
-            current_part += '\n' + line if current_part else line
-    
-    if current_part:
-        parts.append(current_part)
+    parts = split_message_parts(text, max_length)
     
     # إرسال الأجزاء
     for i, part in enumerate(parts):
@@ -1430,9 +4878,74 @@ async def send_long_message_fixed(update: Update, text: str, parse_mode: str = N
             )
         except Exception as e:
             logger.error(f"Error sending part {i+1}: {e}")
+
+class StreamingMessageEditor:
+    """عرض التحليل أثناء توليده بتعديل رسالة المعالجة تدريجياً"""
+    
+    def __init__(self, message, interval: float = Config.STREAM_EDIT_INTERVAL, max_length: int = 4000):
+        self.messages = [message]
+        self.rendered: List[Optional[str]] = [None]
+        self.interval = interval
+        self.max_length = max_length
+        self.text = ""
+        self.started = False
+        self._last_edit = 0.0
+        self._pending: Optional[asyncio.Task] = None
+    
+    async def update(self, text: str):
+        """استقبال النص المتراكم - التعديل الفعلي بمعدل محدود ولا يوقف التدفق"""
+        self.text = text
+        self.started = True
+        
+        if self._pending is not None and not self._pending.done():
+            return
+        
+        now = time.monotonic()
+        if now - self._last_edit >= self.interval:
+            self._last_edit = now
+            self._pending = asyncio.create_task(self._sync(self.text + " ▌"))
+    
+    async def finalize(self, text: str, reply_markup=None):
+        """عرض النص النهائي كاملاً مع تقسيمه على عدة رسائل عند الحاجة"""
+        if self._pending is not None:
+            try:
+                await self._pending
+            except Exception:
+                pass
+        self.text = text
+        await self._sync(text, reply_markup)
+    
+    async def _sync(self, text: str, reply_markup=None):
+        parts = split_message_parts(text, self.max_length)
+        if not parts:
+            return
+        
+        for i, part in enumerate(parts):
+            markup = reply_markup if i == len(parts) - 1 else None
+            try:
+                if i < len(self.messages):
+                    if self.rendered[i] != part or markup is not None:
+                        await self.messages[i].edit_text(part, reply_markup=markup)
+                        self.rendered[i] = part
+                else:
+                    # تجاوز حد 4000 حرف - متابعة العرض في رسالة جديدة
+                    new_message = await self.messages[0].chat.send_message(part, reply_markup=markup)
+                    self.messages.append(new_message)
+                    self.rendered.append(part)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    logger.warning(f"Streaming edit error: {e}")
+            except Exception as e:
+                logger.warning(f"Streaming edit error: {e}")
         
-        if i < len(parts) - 1:
-            await asyncio.sleep(0.3)
+        # النص النهائي قد يكون أقصر من المعروض أثناء التدفق
+        for extra in self.messages[len(parts):]:
+            try:
+                await extra.delete()
+            except Exception:
+                pass
+        del self.messages[len(parts):]
+        del self.rendered[len(parts):]
 
 def create_main_keyboard(user: User) -> InlineKeyboardMarkup:
     """إنشاء لوحة المفاتيح الرئيسية - مُصلح"""
@@ -1483,53 +4996,27 @@ def create_main_keyboard(user: User) -> InlineKeyboardMarkup:
 
 # ==================== Fixed Decorators ====================
 def require_activation_fixed(analysis_type="general"):
-    """Decorator مُصلح لفحص التفعيل واستخدام المفتاح"""
+    """Decorator مُصلح لفحص التفعيل واستخدام المفتاح - عبر مرحلة preflight واحدة"""
     def decorator(func):
         @wraps(func)
         async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-            user_id = update.effective_user.id
-            
-            if context.bot_data['security'].is_blocked(user_id):
-                await update.message.reply_text(f"{emoji('cross')} حسابك محظور. تواصل مع الدعم.")
-                return
-            
-            user = await context.bot_data['db'].get_user(user_id)
-            if not user:
-                user = User(
-                    user_id=user_id,
-                    username=update.effective_user.username,
-                    first_name=update.effective_user.first_name
-                )
-                await context.bot_data['db'].add_user(user)
-            
-            if user_id != Config.MASTER_USER_ID and not user.is_activated:
-                await update.message.reply_text(
-                    f"{emoji('key')} يتطلب تفعيل الحساب\n\n"
-                    "للاستخدام، يجب تفعيل حسابك أولاً.\n"
-                    "استخدم: /license مفتاح_التفعيل\n\n"
-                    f"{emoji('phone')} للتواصل: @Odai_xau"
-                )
-                return
-            
-            # فحص واستخدام المفتاح
-            if user_id != Config.MASTER_USER_ID:
-                license_manager = context.bot_data['license_manager']
-                success, message = await license_manager.use_key(
-                    user.license_key, 
-                    user_id, 
-                    user.username,
-                    analysis_type
-                )
-                if not success:
+            preflight = context.bot_data['preflight']
+            ticket, message = await preflight.admit(
+                update.effective_user, analysis_type,
+                idempotency_key=f"msg:{update.effective_chat.id}:{update.message.message_id}"
+            )
+            if ticket is None:
+                if message:
                     await update.message.reply_text(message)
-                    return
-            
-            # تحديث بيانات المستخدم
-            user.last_activity = datetime.now()
-            await context.bot_data['db'].add_user(user)
-            context.user_data['user'] = user
+                return
             
-            return await func(update, context, *args, **kwargs)
+            context.user_data['user'] = ticket.user
+            context.user_data['preflight'] = ticket
+            try:
+                return await func(update, context, *args, **kwargs)
+            finally:
+                # استرداد النقاط إذا لم يُسلَّم تحليل حقيقي (خطأ، مهلة، إلغاء)
+                await asyncio.shield(preflight.release(ticket))
         return wrapper
     return decorator
 
@@ -1674,6 +5161,7 @@ async def license_command_fixed(update: Update, context: ContextTypes.DEFAULT_TY
         is_valid, message = await license_manager.validate_key(license_key, user_id)
         
         if not is_valid:
+            await context.bot_data['security'].record_failed_attempt(user_id)
             await processing_msg.edit_text(f"{emoji('cross')} فشل التفعيل\n\n{message}")
             return
         
@@ -1689,9 +5177,9 @@ async def license_command_fixed(update: Update, context: ContextTypes.DEFAULT_TY
         user.is_activated = True
         user.activation_date = datetime.now()
         
-        await context.bot_data['db'].add_user(user)
+        await context.bot_data['db'].add_user(user, immediate=True)
         
-        context.bot_data['security'].create_session(user_id, license_key)
+        await context.bot_data['security'].create_session(user_id, license_key)
         
         key_info = await license_manager.get_key_info(license_key)
         
@@ -1831,6 +5319,33 @@ async def stats_command_fixed(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         stats = await db_manager.get_stats()
         keys_stats = await license_manager.get_all_keys_stats()
+        pool_status = context.bot_data['database'].get_pool_status()
+        write_stats = db_manager.write_behind.get_stats() if db_manager.write_behind else {'pending': 0, 'coalesced_writes': 0}
+        cache_stats = context.bot_data['cache'].analysis_cache.get_stats()
+        claude_stats = context.bot_data['claude_manager'].get_stats()
+        scheduler_stats = context.bot_data['claude_manager'].scheduler.get_stats()
+        image_stats = context.bot_data['image_pipeline'].get_stats()
+        chart_stats = context.bot_data['claude_manager'].chart_index.get_stats()
+        rate_stats = context.bot_data['rate_limiter'].get_stats()
+        state_stats = context.bot_data['state_backend'].get_stats()
+        send_stats = context.bot.rate_limiter.get_stats()
+        preflight_stats = context.bot_data['preflight'].get_stats()
+        dedup_stats = context.bot_data['deduplicator'].get_stats()
+        job_stats = context.bot_data['analysis_jobs'].get_stats()
+        price_stats = context.bot_data['gold_price_manager'].get_stats()
+        tick_stats = context.bot_data['tick_store'].get_stats()
+        candle_stats = context.bot_data['candles'].get_stats()
+        candle_counts = "، ".join(f"{name} {count}" for name, count in candle_stats['bars'].items())
+        price_age = f"{price_stats['age']:.0f}ث" if price_stats['age'] is not None else "لا يوجد"
+        source_lines = "\n".join(
+            f"  - {name}: {source['state']}، {source['avg_ms']:.0f}ms، فوز {source['wins']}، فشل {source['failures']}، بيانات مرفوضة {source['bad_data']}"
+            for name, source in price_stats['sources'].items()
+        ) or "  - لا توجد مصادر مفعلة"
+        job_counts = await context.bot_data['database'].get_analysis_job_counts()
+        route_lines = "\n".join(
+            f"  - {route['route']}: {route['count']} طلب، p50 {route['p50'] * 1000:.0f}ms، p95 {route['p95'] * 1000:.0f}ms، أخطاء {route['errors']}"
+            for route in callback_router.get_stats()
+        ) or "  - لا توجد بيانات بعد"
         
         stats_text = f"""{emoji('chart')} **إحصائيات البوت - Fixed & Enhanced**
 
@@ -1852,6 +5367,25 @@ async def stats_command_fixed(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 {emoji('zap')} **النظام:**
 • قاعدة البيانات: PostgreSQL Fixed
+• وضع الاتصال: {pool_status['mode']} ({pool_status['size']}/{pool_status['max_size']}، خامل {pool_status['idle']})
+• حفظ المستخدمين المؤجل: {write_stats['pending']} معلّق، {write_stats['coalesced_writes']} كتابة مدمجة
+• ذاكرة التحليلات: {cache_stats['entries']} عنصر، {cache_stats['bytes'] // 1024} KB، نجاح {cache_stats['hit_rate']:.1f}%، إخراج {cache_stats['evictions']}
+• طلبات Claude المدمجة: {claude_stats['coalesced_waiters']} (جارية {claude_stats['inflight']})
+• طابور Claude: {scheduler_stats['active']} نشط، {scheduler_stats['queued']} منتظر، متوسط الانتظار {scheduler_stats['avg_wait']:.1f}ث، مُسقط {scheduler_stats['shed'] + scheduler_stats['expired']}
+• معالجة الشارتات: {image_stats['processed']} صورة، متوسط {image_stats['avg_ms']['total']:.0f}ms، مرفوض {image_stats['rejected']}
+• حد المعدل: {rate_stats['tracked_users']} مستخدم نشط، مرفوض {rate_stats['denied']}
+• الطلبات المدفوعة: {preflight_stats['admitted']} مقبول، {sum(preflight_stats['rejected'].values())} مرفوض، {preflight_stats['refunds']} استرداد ({preflight_stats['refunded_points']} نقطة)
+• التحديثات المكررة: {dedup_stats['duplicates']} تحديث مُسقط، {preflight_stats['rejected'].get('duplicate', 0)} طلب مدفوع مكرر
+• سعر الذهب: عمر {price_age} ({price_stats['source']})، {price_stats['fetches']} جلب، {price_stats['errors']} خطأ، التحديث التالي بعد {price_stats['next_refresh']:.0f}ث، قديم مُقدَّم {price_stats['stale_served']}، تحوط {price_stats['hedges']}، بيانات مرفوضة {price_stats['bad_data']}
+{source_lines}
+• سجل الأسعار: {tick_stats['size']}/{tick_stats['capacity']} tick، يغطي {tick_stats['span_hours']:.1f} ساعة{'' if tick_stats['persistent'] else ' (في الذاكرة فقط)'}
+• الشموع: {candle_counts}، إعادة بناء {candle_stats['rebuilds']} (انقطاعات {candle_stats['gaps']})
+• طابور التحليلات: {job_counts.get('queued', 0)} منتظر، {job_stats['running']} قيد التنفيذ، {job_stats['completed']} مكتمل (متوسط {job_stats['avg_run_time']:.1f}ث)، {job_stats['retried']} إعادة، {job_counts.get('dead', 0)} متوقف نهائياً
+• طابور الإرسال: {send_stats['queued']} منتظر، متوسط الانتظار {send_stats['avg_latency'] * 1000:.0f}ms (أقصى {send_stats['max_latency']:.1f}ث)، تعديلات مدمجة {send_stats['merged_edits']}، RetryAfter {send_stats['retry_after']}
+• الحالة المشتركة: {state_stats['backend']}، محظور {state_stats['blocked']}، آخر مزامنة قبل {state_stats['last_sync_age']:.1f}ث، أخطاء {state_stats['sync_errors']}
+• الشارتات المكررة: {chart_stats['entries']} بصمة، نجاح {chart_stats['hit_rate']:.1f}% ({chart_stats['exact_hits']} مطابق، {chart_stats['near_hits']} متقارب)
+• أزرار callback الأكثر استخداماً:
+{route_lines}
 • المفاتيح: 40 ثابت - لا تُحذف أبداً
 • الحفظ: دائم ومضمون
 • الأداء: مُصلح ومحسن
@@ -1865,18 +5399,102 @@ async def stats_command_fixed(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Stats error: {e}")
         await stats_msg.edit_text(f"{emoji('cross')} خطأ في الإحصائيات")
 
+@admin_only
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """بث رسالة لكل المستخدمين: /broadcast النص"""
+    message = update.message.text.partition(' ')[2].strip()
+    if not message:
+        await update.message.reply_text(
+            f"{emoji('info')} الاستخدام: /broadcast نص الرسالة\n"
+            "لمتابعة التقدم: /broadcaststatus"
+        )
+        return
+    
+    try:
+        broadcast = await context.bot_data['broadcast'].create(message, update.effective_user.id)
+    except Exception as e:
+        logger.error(f"Broadcast create error: {e}")
+        await update.message.reply_text(f"{emoji('cross')} تعذر بدء البث")
+        return
+    
+    await update.message.reply_text(
+        f"{emoji('check')} بدأ البث #{broadcast['id']} إلى {broadcast['total']} مستخدم\n"
+        f"{emoji('clock')} الوقت المتوقع: {broadcast['total'] / Config.BROADCAST_RATE / 60:.1f} دقيقة"
+    )
+
+@admin_only
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """حالة آخر عمليات البث"""
+    engine = context.bot_data['broadcast']
+    try:
+        broadcasts = await context.bot_data['database'].get_broadcasts()
+    except Exception as e:
+        logger.error(f"Broadcast status error: {e}")
+        await update.message.reply_text(f"{emoji('cross')} خطأ في جلب حالة البث")
+        return
+    
+    if not broadcasts:
+        await update.message.reply_text(f"{emoji('info')} لا توجد عمليات بث")
+        return
+    
+    lines = [f"{emoji('chart')} **آخر عمليات البث:**"]
+    for broadcast in broadcasts:
+        live = engine.get_progress(broadcast['id'])
+        if live:
+            eta = f"، متبقي {live['eta'] / 60:.1f} د" if live['eta'] is not None else ""
+            lines.append(
+                f"\n#{broadcast['id']} - جارٍ {live['processed']}/{live['total']}\n"
+                f"• وصل {live['sent']}، فشل {live['failed']}، حظروا البوت {live['blocked']}\n"
+                f"• {live['throughput']:.1f} رسالة/ث{eta}"
+            )
+        else:
+            lines.append(
+                f"\n#{broadcast['id']} - {broadcast['status']} ({broadcast['started_at'].strftime('%Y-%m-%d %H:%M')})\n"
+                f"• وصل {broadcast['sent']}، فشل {broadcast['failed']}، حظروا البوت {broadcast['blocked']} من {broadcast['total']}"
+            )
+    
+    await update.message.reply_text("\n".join(lines))
+
+async def _set_user_blocked(update: Update, context: ContextTypes.DEFAULT_TYPE, blocked: bool):
+    command = "/block" if blocked else "/unblock"
+    arg = update.message.text.partition(' ')[2].strip()
+    if not arg.isdigit():
+        await update.message.reply_text(f"{emoji('info')} الاستخدام: {command} رقم_المستخدم")
+        return
+    
+    user_id = int(arg)
+    security = context.bot_data['security']
+    try:
+        if blocked:
+            await security.block_user(user_id)
+        else:
+            await security.unblock_user(user_id)
+    except Exception as e:
+        logger.error(f"{command} error for {user_id}: {e}")
+        await update.message.reply_text(f"{emoji('cross')} تعذر تحديث حالة الحظر")
+        return
+    
+    if blocked:
+        await update.message.reply_text(f"{emoji('check')} تم حظر المستخدم {user_id}")
+    else:
+        await update.message.reply_text(f"{emoji('check')} تم رفع الحظر عن المستخدم {user_id}")
+
+@admin_only
+async def block_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """حظر مستخدم من البوت: /block رقم_المستخدم"""
+    await _set_user_blocked(update, context, True)
+
+@admin_only
+async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """رفع الحظر عن مستخدم: /unblock رقم_المستخدم"""
+    await _set_user_blocked(update, context, False)
+
 # ==================== Fixed Message Handlers ====================
 @require_activation_fixed("text_analysis")
 async def handle_text_message_fixed(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالجة الرسائل النصية - مُصلحة"""
+    """معالجة الرسائل النصية - تُضاف لطابور التحليلات ويُرد فوراً"""
     user = context.user_data['user']
     
-    # فحص الحد المسموح
-    allowed, message = context.bot_data['rate_limiter'].is_allowed(user.user_id, user)
-    if not allowed:
-        await update.message.reply_text(message)
-        return
-    
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
     
     # فحص التحليل السري
@@ -1894,12 +5512,6 @@ async def handle_text_message_fixed(update: Update, context: ContextTypes.DEFAUL
         processing_msg = await update.message.reply_text(f"{emoji('brain')} جاري التحليل الاحترافي...")
     
     try:
-        # الحصول على السعر
-        price = await context.bot_data['gold_price_manager'].get_gold_price()
-        if not price:
-            await processing_msg.edit_text(f"{emoji('cross')} لا يمكن الحصول على السعر حالياً.")
-            return
-        
         # تحديد نوع التحليل من الكلمات المفتاحية
         text_lower = update.message.text.lower()
         analysis_type = AnalysisType.DETAILED
@@ -1919,49 +5531,30 @@ async def handle_text_message_fixed(update: Update, context: ContextTypes.DEFAUL
         elif any(word in text_lower for word in ['خبر', 'أخبار', 'news']):
             analysis_type = AnalysisType.NEWS
         
-        result = await context.bot_data['claude_manager'].analyze_gold(
-            prompt=update.message.text,
-            gold_price=price,
-            analysis_type=analysis_type,
-            user_settings=user.settings
-        )
-        
-        await processing_msg.delete()
-        
-        await send_long_message_fixed(update, result)
-        
-        # حفظ التحليل
-        analysis = Analysis(
-            id=f"{user.user_id}_{datetime.now().timestamp()}",
+        # التوليد والتسليم في عمال الطابور - الـ webhook يرجع فوراً
+        ticket = context.user_data['preflight']
+        await context.bot_data['analysis_jobs'].enqueue(
             user_id=user.user_id,
-            timestamp=datetime.now(),
+            chat_id=update.effective_chat.id,
+            message_id=processing_msg.message_id,
+            source='text',
             analysis_type=analysis_type.value,
             prompt=update.message.text,
-            result=result[:500],
-            gold_price=price.price
+            license_key=ticket.license_key,
+            points=ticket.points,
+            priority=int(analysis_priority(user.user_id, analysis_type))
         )
-        await context.bot_data['db'].add_analysis(analysis)
-        
-        # تحديث إحصائيات المستخدم
-        user.total_requests += 1
-        user.total_analyses += 1
-        await context.bot_data['db'].add_user(user)
+        ticket.deferred = True
         
     except Exception as e:
-        logger.error(f"Error in text analysis: {e}")
+        logger.error(f"Error queueing text analysis: {e}")
         await processing_msg.edit_text(f"{emoji('cross')} حدث خطأ أثناء التحليل.")
 
 @require_activation_fixed("image_analysis")
 async def handle_photo_message_fixed(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالجة الصور - مُصلحة مع تحليل الشارت المتقدم"""
+    """معالجة الصور - تحليل الشارت المتقدم عبر طابور التحليلات"""
     user = context.user_data['user']
     
-    # فحص الحد المسموح
-    allowed, message = context.bot_data['rate_limiter'].is_allowed(user.user_id, user)
-    if not allowed:
-        await update.message.reply_text(message)
-        return
-    
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.UPLOAD_PHOTO)
     
     # فحص إذا كان التحليل السري في التعليق
@@ -1978,27 +5571,14 @@ async def handle_photo_message_fixed(update: Update, context: ContextTypes.DEFAU
         processing_msg = await update.message.reply_text(
             f"{emoji('camera')} **تحليل الشارت المتقدم - مُصلح**\n\n"
             f"{emoji('brain')} جاري تحليل الشارت بالذكاء الاصطناعي...\n"
-            f"{emoji('magnifier')} استخراج النماذج الفنية والمستويات...\n"
-            f"{emoji('target')} تحديد نقاط الدخول والخروج بدقة السنت...\n\n"
-            f"{emoji('clock')} تحليل محسن وأسرع..."
-        )
-    
-    try:
-        photo = update.message.photo[-1]
-        photo_file = await photo.get_file()
-        image_data = await photo_file.download_as_bytearray()
-        
-        # معالجة الصورة
-        image_base64 = FixedImageProcessor.process_image(image_data)
-        if not image_base64:
-            await processing_msg.edit_text(f"{emoji('cross')} لا يمكن معالجة الصورة. تأكد من وضوح الشارت.")
-            return
-        
-        # الحصول على السعر
-        price = await context.bot_data['gold_price_manager'].get_gold_price()
-        if not price:
-            await processing_msg.edit_text(f"{emoji('cross')} لا يمكن الحصول على السعر حالياً.")
-            return
+            f"{emoji('magnifier')} استخراج النماذج الفنية والمستويات...\n"
+            f"{emoji('target')} تحديد نقاط الدخول والخروج بدقة السنت...\n\n"
+            f"{emoji('clock')} تحليل محسن وأسرع..."
+        )
+    
+    try:
+        # التحميل والمعالجة في العامل - نحفظ معرف الملف فقط
+        photo = select_photo_variant(update.message.photo)
         
         # تحضير prompt خاص لتحليل الشارت
         if not caption:
@@ -2009,95 +5589,184 @@ async def handle_photo_message_fixed(update: Update, context: ContextTypes.DEFAU
         if Config.NIGHTMARE_TRIGGER in caption:
             analysis_type = AnalysisType.NIGHTMARE
         
-        # التحليل المتقدم للشارت
-        result = await context.bot_data['claude_manager'].analyze_gold(
-            prompt=caption,
-            gold_price=price,
-            image_base64=image_base64,
-            analysis_type=analysis_type,
-            user_settings=user.settings
-        )
-        
-        await processing_msg.delete()
-        
-        # إضافة هيدر خاص لتحليل الشارت
-        chart_header = f"""{emoji('camera')} **تحليل الشارت المتقدم - Fixed & Enhanced**
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-{result}
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-{emoji('diamond')} **تم بواسطة Gold Nightmare Academy**
-{emoji('camera')} **تحليل الشارت المُصلح والمُحسن**
-{emoji('brain')} **ذكاء اصطناعي محسن لقراءة الشارت**
-{emoji('target')} **نقاط دخول وخروج بدقة السنت الواحد**
-{emoji('zap')} **أداء مُصلح - استجابة سريعة**
-{emoji('key')} **40 مفتاح ثابت - لا يُحذف أبداً**
-
-{emoji('warning')} **تنبيه:** هذا تحليل تعليمي وليس نصيحة استثمارية"""
-        
-        await send_long_message_fixed(update, chart_header)
-        
-        # حفظ التحليل مع الصورة
-        analysis = Analysis(
-            id=f"{user.user_id}_{datetime.now().timestamp()}",
+        ticket = context.user_data['preflight']
+        await context.bot_data['analysis_jobs'].enqueue(
             user_id=user.user_id,
-            timestamp=datetime.now(),
-            analysis_type="chart_image_fixed",
+            chat_id=update.effective_chat.id,
+            message_id=processing_msg.message_id,
+            source='photo',
+            analysis_type=analysis_type.value,
+            label="chart_image_fixed",
             prompt=caption,
-            result=result[:500],
-            gold_price=price.price,
-            image_data=image_data[:1000]
+            image_file_id=photo.file_id,
+            license_key=ticket.license_key,
+            points=ticket.points,
+            priority=int(analysis_priority(user.user_id, analysis_type))
         )
-        await context.bot_data['db'].add_analysis(analysis)
-        
-        # تحديث إحصائيات المستخدم
-        user.total_requests += 1
-        user.total_analyses += 1
-        await context.bot_data['db'].add_user(user)
+        ticket.deferred = True
         
     except Exception as e:
-        logger.error(f"Error in photo analysis: {e}")
+        logger.error(f"Error queueing photo analysis: {e}")
         await processing_msg.edit_text(f"{emoji('cross')} حدث خطأ أثناء تحليل الشارت.")
 
-# ==================== Fixed Callback Query Handler ====================
-async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالجة الأزرار - مُصلحة"""
-    query = update.callback_query
-    await query.answer()
+# ==================== Callback Router ====================
+@dataclass
+class CallbackRequest:
+    """سياق الزر الممرر لمعالج المسار"""
+    query: Any
+    data: str
+    user_id: int
+    user: Optional[User] = None
+    ticket: Optional[PreflightTicket] = None
+
+@dataclass
+class CallbackRoute:
+    """مسار زر مع سياسته: ما يحتاجه من تحقق وخصم وحفظ"""
+    handler: Callable[[Update, ContextTypes.DEFAULT_TYPE, CallbackRequest], Awaitable[None]]
+    needs_user: bool = True
+    requires_license: bool = True
+    admin_only: bool = False
+    points: int = 0
+    persist: bool = False
+
+class RouteMetrics:
+    """زمن الاستجابة (histogram) والأخطاء لكل مسار"""
     
-    data = query.data
-    user_id = query.from_user.id
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
     
-    # فحص الحظر
-    if context.bot_data['security'].is_blocked(user_id):
-        await query.edit_message_text(f"{emoji('cross')} حسابك محظور.")
-        return
+    __slots__ = ('count', 'errors', 'total', 'max', 'buckets')
     
-    # الحصول على بيانات المستخدم
-    user = await context.bot_data['db'].get_user(user_id)
-    if not user:
-        user = User(
-            user_id=user_id,
-            username=query.from_user.username,
-            first_name=query.from_user.first_name
-        )
-        await context.bot_data['db'].add_user(user)
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
     
-    # الأوامر المسموحة بدون تفعيل
-    allowed_without_license = [
-        "price_now", "how_to_get_license", "back_main", 
-        "demo_analysis", "chart_analysis_info"
-    ]
+    def observe(self, elapsed: float, failed: bool):
+        self.count += 1
+        self.errors += failed
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        for index, bound in enumerate(self.BUCKETS):
+            if elapsed <= bound:
+                self.buckets[index] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+    
+    def percentile(self, fraction: float) -> float:
+        """الحد الأعلى للدلو الذي يحتوي النسبة المطلوبة"""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else self.max
+        return self.max
+
+class CallbackRouter:
+    """توجيه أزرار الـ callback عبر جدول بدل سلسلة if/elif"""
+    
+    def __init__(self):
+        self.routes: Dict[str, CallbackRoute] = {}
+        self.prefix_routes: List[Tuple[str, CallbackRoute]] = []
+        self.metrics: Dict[str, RouteMetrics] = defaultdict(RouteMetrics)
+        self.unrouted = 0
+    
+    def add(self, data: str, handler, prefix: bool = False, **policy):
+        route = CallbackRoute(handler, **policy)
+        if prefix:
+            self.prefix_routes.append((data, route))
+        else:
+            self.routes[data] = route
     
-    # فحص التفعيل للأوامر المحمية
-    if (user_id != Config.MASTER_USER_ID and 
-        (not user.license_key or not user.is_activated) and 
-        data not in allowed_without_license):
+    def route(self, data: str, prefix: bool = False, **policy):
+        """Decorator لتسجيل معالج مسار"""
+        def decorator(handler):
+            self.add(data, handler, prefix, **policy)
+            return handler
+        return decorator
+    
+    def resolve(self, data: str) -> Tuple[Optional[str], Optional[CallbackRoute]]:
+        route = self.routes.get(data)
+        if route is not None:
+            return data, route
+        for prefix, route in self.prefix_routes:
+            if data.startswith(prefix):
+                return f"{prefix}*", route
+        return None, None
+    
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
         
-        await query.edit_message_text(
-            f"""{emoji('key')} يتطلب مفتاح تفعيل
+        data = query.data or ""
+        name, route = self.resolve(data)
+        if route is None:
+            self.unrouted += 1
+            logger.debug(f"Unrouted callback: {data}")
+            return
+        
+        request = CallbackRequest(query=query, data=data, user_id=query.from_user.id)
+        is_master = request.user_id == Config.MASTER_USER_ID
+        if route.admin_only and not is_master:
+            return
+        
+        started = time.perf_counter()
+        failed = False
+        try:
+            if await self._apply_policy(route, request, context, is_master):
+                try:
+                    await route.handler(update, context, request)
+                finally:
+                    if request.ticket is not None:
+                        await asyncio.shield(context.bot_data['preflight'].release(request.ticket))
+                
+                if route.persist and request.user is not None:
+                    request.user.last_activity = datetime.now()
+                    await context.bot_data['db'].add_user(request.user)
+                    context.user_data['user'] = request.user
+        except Exception as e:
+            failed = True
+            logger.error(f"Error in callback route {name}: {e}")
+            try:
+                await query.edit_message_text(
+                    f"{emoji('cross')} حدث خطأ مؤقت - النظام مُصلح",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton(f"{emoji('back')} رجوع للقائمة", callback_data="back_main")]
+                    ])
+                )
+            except Exception:
+                pass
+        finally:
+            self.metrics[name].observe(time.perf_counter() - started, failed)
+    
+    async def _apply_policy(self, route: CallbackRoute, request: CallbackRequest,
+                            context: ContextTypes.DEFAULT_TYPE, is_master: bool) -> bool:
+        """فحص الحظر والمستخدم والتفعيل والخصم حسب سياسة المسار - False يوقف المعالجة"""
+        query = request.query
+        
+        if context.bot_data['security'].is_blocked(request.user_id):
+            await query.edit_message_text(f"{emoji('cross')} حسابك محظور.")
+            return False
+        
+        if route.needs_user or route.requires_license or route.points or route.persist:
+            user = await context.bot_data['db'].get_user(request.user_id)
+            if not user:
+                user = User(
+                    user_id=request.user_id,
+                    username=query.from_user.username,
+                    first_name=query.from_user.first_name
+                )
+                await context.bot_data['db'].add_user(user)
+            request.user = user
+        
+        if route.requires_license and not is_master and (not request.user.license_key or not request.user.is_activated):
+            await query.edit_message_text(
+                f"""{emoji('key')} يتطلب مفتاح تفعيل
 
 لاستخدام هذه الميزة، يجب إدخال مفتاح تفعيل من الـ 40 الثابتة.
 استخدم: /license مفتاح_التفعيل
@@ -2113,69 +5782,75 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 {emoji('admin')} Odai - @Odai_xau
 
 {emoji('fire')} 40 مفتاح ثابت فقط - محدود ودائم!""",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{emoji('key')} كيف أحصل على مفتاح؟", callback_data="how_to_get_license")],
-                [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
-            ])
-        )
-        return
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton(f"{emoji('key')} كيف أحصل على مفتاح؟", callback_data="how_to_get_license")],
+                    [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
+                ])
+            )
+            return False
+        
+        # حد المعدل والخصم مرة واحدة فقط حسب تكلفة المسار - تُسترد إذا فشل التحليل
+        if route.points:
+            if not is_master:
+                await query.edit_message_text(f"{emoji('clock')} جاري التحقق من المفتاح...")
+            ticket, message = await context.bot_data['preflight'].charge(
+                request.user, f"callback_{request.data}", route.points,
+                idempotency_key=f"cb:{query.id}"
+            )
+            if ticket is None:
+                if message:
+                    await query.edit_message_text(message)
+                return False
+            request.ticket = ticket
+        
+        return True
     
-    # فحص استخدام المفتاح للعمليات المتقدمة
-    advanced_operations = [
-        "analysis_quick", "analysis_scalping", "analysis_detailed",
-        "analysis_forecast", "analysis_news", "analysis_swing", 
-        "analysis_reversal", "nightmare_analysis"
-    ]
+    def get_stats(self, limit: int = 5) -> List[Dict[str, Any]]:
+        """أكثر المسارات استخداماً مع p50/p95 التقريبية"""
+        ranked = sorted(self.metrics.items(), key=lambda item: item[1].count, reverse=True)[:limit]
+        return [{
+            'route': name,
+            'count': metrics.count,
+            'errors': metrics.errors,
+            'avg': metrics.total / metrics.count if metrics.count else 0.0,
+            'p50': metrics.percentile(0.5),
+            'p95': metrics.percentile(0.95)
+        } for name, metrics in ranked]
+
+callback_router = CallbackRouter()
+
+# ==================== Fixed Callback Query Handler ====================
+async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالجة الأزرار - مُصلحة"""
+    await callback_router.dispatch(update, context)
+
+@callback_router.route("price_now", needs_user=False, requires_license=False)
+async def callback_price_now(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """سعر الذهب المباشر"""
+    query = request.query
+    await query.edit_message_text(f"{emoji('clock')} جاري جلب السعر...")
     
-    if user_id != Config.MASTER_USER_ID and data in advanced_operations and user.license_key:
-        license_manager = context.bot_data['license_manager']
+    try:
+        price = await context.bot_data['gold_price_manager'].get_gold_price()
+        if not price:
+            await query.edit_message_text(f"{emoji('cross')} لا يمكن الحصول على السعر حالياً.")
+            return
         
-        if data == "nightmare_analysis":
-            await query.edit_message_text(f"{emoji('clock')} جاري التحقق من المفتاح للتحليل الشامل...")
+        # تحديد اتجاه السعر
+        if price.change_24h > 0:
+            trend_emoji = emoji('up_arrow')
+            trend_color = emoji('green_circle')
+            trend_text = "صاعد"
+        elif price.change_24h < 0:
+            trend_emoji = emoji('down_arrow')
+            trend_color = emoji('red_circle')
+            trend_text = "هابط"
         else:
-            await query.edit_message_text(f"{emoji('clock')} جاري التحقق من المفتاح...")
+            trend_emoji = emoji('right_arrow')
+            trend_color = emoji('yellow_circle')
+            trend_text = "مستقر"
         
-        try:
-            success, use_message = await license_manager.use_key(
-                user.license_key, 
-                user_id,
-                user.username,
-                f"callback_{data}"
-            )
-            
-            if not success:
-                await query.edit_message_text(use_message)
-                return
-        except Exception as e:
-            logger.error(f"Error using key: {e}")
-            await query.edit_message_text(f"{emoji('cross')} خطأ في استخدام المفتاح")
-            return
-    
-    try:
-        if data == "price_now":
-            await query.edit_message_text(f"{emoji('clock')} جاري جلب السعر...")
-            
-            try:
-                price = await context.bot_data['gold_price_manager'].get_gold_price()
-                if not price:
-                    await query.edit_message_text(f"{emoji('cross')} لا يمكن الحصول على السعر حالياً.")
-                    return
-                
-                # تحديد اتجاه السعر
-                if price.change_24h > 0:
-                    trend_emoji = emoji('up_arrow')
-                    trend_color = emoji('green_circle')
-                    trend_text = "صاعد"
-                elif price.change_24h < 0:
-                    trend_emoji = emoji('down_arrow')
-                    trend_color = emoji('red_circle')
-                    trend_text = "هابط"
-                else:
-                    trend_emoji = emoji('right_arrow')
-                    trend_color = emoji('yellow_circle')
-                    trend_text = "مستقر"
-                
-                price_message = f"""╔══════════════════════════════════════╗
+        price_message = f"""╔══════════════════════════════════════╗
 ║       {emoji('gold')} **سعر الذهب المباشر** {emoji('gold')}       ║
 ║        {emoji('zap')} Fixed & Enhanced System       ║
 ╚══════════════════════════════════════╝
@@ -2186,37 +5861,40 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 
 {emoji('top')} **أعلى سعر:** ${price.high_24h:.2f}
 {emoji('bottom')} **أدنى سعر:** ${price.low_24h:.2f}
-{emoji('clock')} **التحديث:** {price.timestamp.strftime('%H:%M:%S')}
+{emoji('clock')} **التحديث:** {price.timestamp.strftime('%H:%M:%S')}{f" {emoji('warning')} متأخر - المصدر لا يستجيب حالياً" if price.stale else ''}
 {emoji('signal')} **المصدر:** {price.source}
 
 {emoji('camera')} **تحليل الشارت:** أرسل صورة شارت لتحليل مُصلح ومتقدم
 {emoji('info')} **للحصول على تحليل دقيق بالسنت استخدم الأزرار أدناه**"""
-                
-                price_keyboard = [
-                    [
-                        InlineKeyboardButton(f"{emoji('refresh')} تحديث السعر", callback_data="price_now"),
-                        InlineKeyboardButton(f"{emoji('zap')} تحليل سريع", callback_data="analysis_quick")
-                    ],
-                    [
-                        InlineKeyboardButton(f"{emoji('chart')} تحليل شامل", callback_data="analysis_detailed"),
-                        InlineKeyboardButton(f"{emoji('camera')} معلومات الشارت", callback_data="chart_analysis_info")
-                    ],
-                    [
-                        InlineKeyboardButton(f"{emoji('back')} رجوع للقائمة", callback_data="back_main")
-                    ]
-                ]
-                
-                await query.edit_message_text(
-                    price_message,
-                    reply_markup=InlineKeyboardMarkup(price_keyboard)
-                )
-                
-            except Exception as e:
-                logger.error(f"Error in price display: {e}")
-                await query.edit_message_text(f"{emoji('cross')} خطأ في جلب بيانات السعر")
         
-        elif data == "how_to_get_license":
-            help_text = f"""{emoji('key')} كيفية الحصول على مفتاح التفعيل
+        price_keyboard = [
+            [
+                InlineKeyboardButton(f"{emoji('refresh')} تحديث السعر", callback_data="price_now"),
+                InlineKeyboardButton(f"{emoji('zap')} تحليل سريع", callback_data="analysis_quick")
+            ],
+            [
+                InlineKeyboardButton(f"{emoji('chart')} تحليل شامل", callback_data="analysis_detailed"),
+                InlineKeyboardButton(f"{emoji('camera')} معلومات الشارت", callback_data="chart_analysis_info")
+            ],
+            [
+                InlineKeyboardButton(f"{emoji('back')} رجوع للقائمة", callback_data="back_main")
+            ]
+        ]
+        
+        await query.edit_message_text(
+            price_message,
+            reply_markup=InlineKeyboardMarkup(price_keyboard)
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in price display: {e}")
+        await query.edit_message_text(f"{emoji('cross')} خطأ في جلب بيانات السعر")
+
+@callback_router.route("how_to_get_license", needs_user=False, requires_license=False)
+async def callback_how_to_get_license(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """طريقة الحصول على مفتاح"""
+    query = request.query
+    help_text = f"""{emoji('key')} كيفية الحصول على مفتاح التفعيل
 
 {emoji('diamond')} Gold Nightmare Bot يقدم تحليلات الذهب الأكثر دقة في العالم!
 {emoji('zap')} **إصدار مُصلح ومحسن - 40 مفتاح ثابت فقط**
@@ -2251,41 +5929,44 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 
 {emoji('star')} انضم لمجتمع النخبة الآن!"""
 
-            keyboard = [
-                [InlineKeyboardButton(f"{emoji('phone')} تواصل مع Odai", url="https://t.me/Odai_xau")],
-                [InlineKeyboardButton(f"{emoji('up_arrow')} قناة التوصيات", url="https://t.me/odai_xauusdt")],
-                [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
-            ]
-            
-            await query.edit_message_text(
-                help_text,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+    keyboard = [
+        [InlineKeyboardButton(f"{emoji('phone')} تواصل مع Odai", url="https://t.me/Odai_xau")],
+        [InlineKeyboardButton(f"{emoji('up_arrow')} قناة التوصيات", url="https://t.me/odai_xauusdt")],
+        [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
+    ]
+    
+    await query.edit_message_text(
+        help_text,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-        elif data == "key_info":
-            if not user or not user.license_key:
-                await query.edit_message_text(
-                    f"""{emoji('cross')} لا يوجد مفتاح مفعل
+@callback_router.route("key_info")
+async def callback_key_info(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """معلومات مفتاح المستخدم"""
+    query, user = request.query, request.user
+    if not user or not user.license_key:
+        await query.edit_message_text(
+            f"""{emoji('cross')} لا يوجد مفتاح مفعل
 
 للحصول على مفتاح تفعيل ثابت تواصل مع المطور""",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"{emoji('phone')} تواصل مع Odai", url="https://t.me/Odai_xau")],
-                        [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
-                    ])
-                )
-                return
-            
-            await query.edit_message_text(f"{emoji('clock')} جاري تحديث معلومات المفتاح...")
-            
-            try:
-                key_info = await context.bot_data['license_manager'].get_key_info(user.license_key)
-                if not key_info:
-                    await query.edit_message_text(f"{emoji('cross')} لا يمكن جلب معلومات المفتاح")
-                    return
-                
-                usage_percentage = (key_info['used_total'] / key_info['total_limit']) * 100
-                
-                key_info_message = f"""╔══════════════════════════════════════╗
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{emoji('phone')} تواصل مع Odai", url="https://t.me/Odai_xau")],
+                [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
+            ])
+        )
+        return
+    
+    await query.edit_message_text(f"{emoji('clock')} جاري تحديث معلومات المفتاح...")
+    
+    try:
+        key_info = await context.bot_data['license_manager'].get_key_info(user.license_key)
+        if not key_info:
+            await query.edit_message_text(f"{emoji('cross')} لا يمكن جلب معلومات المفتاح")
+            return
+        
+        usage_percentage = (key_info['used_total'] / key_info['total_limit']) * 100
+        
+        key_info_message = f"""╔══════════════════════════════════════╗
 ║        {emoji('key')} معلومات المفتاح الثابت {emoji('key')}        ║
 ║          {emoji('zap')} Fixed & Enhanced System         ║
 ╚══════════════════════════════════════╝
@@ -2314,22 +5995,25 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 
 {emoji('diamond')} Gold Nightmare Academy - عضوية ثابتة ودائمة
 {emoji('rocket')} أنت جزء من الـ 40 المختارين!"""
-                
-                await query.edit_message_text(
-                    key_info_message,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"{emoji('refresh')} تحديث المعلومات", callback_data="key_info")],
-                        [InlineKeyboardButton(f"{emoji('camera')} معلومات الشارت", callback_data="chart_analysis_info")],
-                        [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
-                    ])
-                )
-                
-            except Exception as e:
-                logger.error(f"Error in key info: {e}")
-                await query.edit_message_text(f"{emoji('cross')} خطأ في جلب معلومات المفتاح")
+        
+        await query.edit_message_text(
+            key_info_message,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{emoji('refresh')} تحديث المعلومات", callback_data="key_info")],
+                [InlineKeyboardButton(f"{emoji('camera')} معلومات الشارت", callback_data="chart_analysis_info")],
+                [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
+            ])
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in key info: {e}")
+        await query.edit_message_text(f"{emoji('cross')} خطأ في جلب معلومات المفتاح")
 
-        elif data == "chart_analysis_info":
-            chart_info = f"""{emoji('camera')} **تحليل الشارت المُصلح والمُحسن**
+@callback_router.route("chart_analysis_info", needs_user=False, requires_license=False)
+async def callback_chart_analysis_info(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """شرح تحليل الشارت"""
+    query = request.query
+    chart_info = f"""{emoji('camera')} **تحليل الشارت المُصلح والمُحسن**
 
 {emoji('fire')} **الميزة الثورية - مُصلحة تماماً!**
 
@@ -2365,36 +6049,40 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 
 {emoji('zap')} **النظام مُصلح ومحسن - استجابة فورية!**"""
 
-            await query.edit_message_text(
-                chart_info,
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"{emoji('camera')} جرب تحليل شارت", callback_data="demo_chart_analysis")],
-                    [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
-                ])
-            )
-                        
-        elif data == "back_main":
-            main_message = f"""{emoji('trophy')} Gold Nightmare Bot - Fixed & Enhanced
+    await query.edit_message_text(
+        chart_info,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{emoji('camera')} جرب تحليل شارت", callback_data="demo_chart_analysis")],
+            [InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")]
+        ])
+    )
+
+@callback_router.route("back_main", requires_license=False)
+async def callback_back_main(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """القائمة الرئيسية"""
+    query, user = request.query, request.user
+    main_message = f"""{emoji('trophy')} Gold Nightmare Bot - Fixed & Enhanced
 
 {emoji('zap')} 40 مفتاح ثابت - لا يُحذف أبداً!
 {emoji('camera')} تحليل الشارت المُصلح والمُحسن!
 {emoji('target')} نقاط دخول وخروج بدقة السنت الواحد!
 
 اختر الخدمة المطلوبة:"""
-            
-            await query.edit_message_text(
-                main_message,
-                reply_markup=create_main_keyboard(user)
-            )
-        
-        elif data.startswith("analysis_") or data == "nightmare_analysis" or data == "confirm_nightmare":
-            # معالجة أنواع التحليل المختلفة
-            if data == "nightmare_analysis":
-                # عرض تحذير التحليل الشامل المتقدم
-                key_info = await context.bot_data['license_manager'].get_key_info(user.license_key) if user.license_key else None
-                remaining_points = key_info['remaining_total'] if key_info else 0
-                
-                warning_message = f"""⚠️ **تحذير: التحليل الشامل المتقدم**
+    
+    await query.edit_message_text(
+        main_message,
+        reply_markup=create_main_keyboard(user)
+    )
+
+@callback_router.route("nightmare_analysis")
+async def callback_nightmare_warning(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """تحذير تكلفة التحليل الشامل قبل التأكيد - بدون خصم"""
+    query, user = request.query, request.user
+    # عرض تحذير التحليل الشامل المتقدم
+    key_info = await context.bot_data['license_manager'].get_key_info(user.license_key) if user.license_key else None
+    remaining_points = key_info['remaining_total'] if key_info else 0
+    
+    warning_message = f"""⚠️ **تحذير: التحليل الشامل المتقدم**
 
 🔥 هذا التحليل الأقوى والأشمل في البوت!
 
@@ -2402,225 +6090,170 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 📊 **النقاط المتبقية لديك:** {remaining_points}
 📊 **النقاط بعد التحليل:** {remaining_points - 5} (إذا تابعت)
 
-🎯 **ما ستحصل عليه مقابل 5 نقاط:**
-• تحليل شامل لجميع الأطر الزمنية (M5, M15, H1, H4, D1)
-• نقاط دخول وخروج بدقة السنت الواحد
-• مستويات دعم ومقاومة متعددة مع قوة كل مستوى  
-• سيناريوهات متعددة مع احتماليات دقيقة
-• استراتيجيات سكالبينج وسوينج
-• تحليل نقاط الانعكاس المحتملة
-• مناطق العرض والطلب المؤسسية
-• توقعات قصيرة ومتوسطة المدى
-• إدارة مخاطر تفصيلية
-• تنسيق احترافي بجداول منظمة
-
-⏰ **وقت التحليل:** 30-60 ثانية (تحليل معمق)
-
-هل تريد المتابعة وخصم 5 نقاط للحصول على التحليل الأقوى؟"""
-
-                if remaining_points < 5:
-                    warning_message += f"""
-
-❌ **تحذير:** نقاط غير كافية!
-تحتاج 5 نقاط ولديك {remaining_points} فقط.
-
-للحصول على مفتاح جديد تواصل مع: @Odai_xau"""
-                    
-                    await query.edit_message_text(
-                        warning_message,
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("📞 تواصل مع Odai", url="https://t.me/Odai_xau")],
-                            [InlineKeyboardButton("🔙 رجوع للقائمة", callback_data="back_main")]
-                        ])
-                    )
-                    return
-                else:
-                    await query.edit_message_text(
-                        warning_message,
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔥 نعم، أريد التحليل الشامل (5 نقاط)", callback_data="confirm_nightmare")],
-                            [InlineKeyboardButton("🔙 لا، رجوع للقائمة", callback_data="back_main")]
-                        ])
-                    )
-                    return
-                    
-            elif data == "confirm_nightmare":
-                # تنفيذ التحليل الشامل بعد التأكيد
-                analysis_type = AnalysisType.NIGHTMARE
-                type_name = "🔥 التحليل الشامل المتقدم (5 نقاط)"
-                points_to_deduct = 5
-            else:
-                analysis_type_map = {
-                    "analysis_quick": (AnalysisType.QUICK, "⚡ تحليل سريع", 1),
-                    "analysis_scalping": (AnalysisType.SCALPING, "🎯 سكالبينج", 1),
-                    "analysis_detailed": (AnalysisType.DETAILED, "📊 تحليل مفصل", 1),
-                    "analysis_swing": (AnalysisType.SWING, "📈 سوينج", 1),
-                    "analysis_forecast": (AnalysisType.FORECAST, "🔮 توقعات", 1),
-                    "analysis_reversal": (AnalysisType.REVERSAL, "🔄 مناطق انعكاس", 1),
-                    "analysis_news": (AnalysisType.NEWS, "📰 تحليل الأخبار", 1)
-                }
-                
-                if data in analysis_type_map:
-                    analysis_type, type_name, points_to_deduct = analysis_type_map[data]
-                else:
-                    return
-            
-            # فحص واستخدام المفتاح مع النقاط المحددة
-            if user_id != Config.MASTER_USER_ID and user.license_key:
-                license_manager = context.bot_data['license_manager']
-                
-                processing_msg = await query.edit_message_text(
-                    f"⏰ جاري التحقق من المفتاح لـ {type_name}..."
-                )
-                
-                try:
-                    success, use_message = await license_manager.use_key(
-                        user.license_key, 
-                        user_id,
-                        user.username,
-                        f"callback_{data}",
-                        points_to_deduct=points_to_deduct
-                    )
-                    
-                    if not success:
-                        await processing_msg.edit_text(use_message)
-                        return
-                        
-                    # عرض رسالة نجح الخصم
-                    await processing_msg.edit_text(f"✅ {use_message}\n\n🧠 جاري إعداد {type_name}...")
-                    
-                except Exception as e:
-                    logger.error(f"Error using key: {e}")
-                    await processing_msg.edit_text("❌ خطأ في استخدام المفتاح")
-                    return
-            else:
-                processing_msg = await query.edit_message_text(
-                    f"🧠 جاري إعداد {type_name}...\n\n⏰ استجابة سريعة ومحسنة..."
-                )
-            
-            try:
-                price = await context.bot_data['gold_price_manager'].get_gold_price()
-                if not price:
-                    await processing_msg.edit_text("❌ لا يمكن الحصول على السعر حالياً.")
-                    return
-                
-                # إنشاء prompt مناسب لنوع التحليل
-                if analysis_type == AnalysisType.QUICK:
-                    prompt = "تحليل سريع للذهب الآن مع توصية واضحة ونقاط دقيقة بالسنت"
-                elif analysis_type == AnalysisType.SCALPING:
-                    prompt = "تحليل سكالبينج للذهب للـ 15 دقيقة القادمة مع نقاط دخول وخروج دقيقة بالسنت الواحد"
-                elif analysis_type == AnalysisType.SWING:
-                    prompt = "تحليل سوينج للذهب للأيام والأسابيع القادمة مع نقاط دقيقة بالسنت"
-                elif analysis_type == AnalysisType.FORECAST:
-                    prompt = "توقعات الذهب لليوم والأسبوع القادم مع احتماليات ونقاط دقيقة"
-                elif analysis_type == AnalysisType.REVERSAL:
-                    prompt = "تحليل نقاط الانعكاس المحتملة للذهب مع مستويات الدعم والمقاومة بدقة السنت"
-                elif analysis_type == AnalysisType.NEWS:
-                    prompt = "تحليل تأثير الأخبار الحالية على الذهب مع نقاط التداول"
-                elif analysis_type == AnalysisType.NIGHTMARE:
-                    prompt = f"""أريد التحليل الشامل المتقدم للذهب - التحليل الأكثر تقدماً وتفصيلاً مع:
-
-                    1. تحليل شامل لجميع الأطر الزمنية (M5, M15, H1, H4, D1) مع نسب ثقة دقيقة
-                    2. مستويات دعم ومقاومة متعددة مع قوة كل مستوى بدقة السنت
-                    3. نقاط دخول وخروج بالسنت الواحد مع أسباب كل نقطة
-                    4. سيناريوهات متعددة (صاعد، هابط، عرضي) مع احتماليات
-                    5. استراتيجيات سكالبينج وسوينج بنقاط دقيقة
-                    6. تحليل نقاط الانعكاس المحتملة
-                    7. مناطق العرض والطلب المؤسسية
-                    8. توقعات قصيرة ومتوسطة المدى
-                    9. إدارة مخاطر تفصيلية
-                    10. جداول منظمة وتنسيق احترافي
-
-                    {Config.NIGHTMARE_TRIGGER}
-                    
-                    اجعله التحليل الأقوى والأشمل على الإطلاق بدقة السنت الواحد!"""
-                else:
-                    prompt = "تحليل شامل ومفصل للذهب مع جداول منظمة ونقاط دقيقة بالسنت"
-                
-                result = await context.bot_data['claude_manager'].analyze_gold(
-                    prompt=prompt,
-                    gold_price=price,
-                    analysis_type=analysis_type,
-                    user_settings=user.settings
-                )
-                
-                # إضافة توقيع خاص للتحليل الشامل المتقدم
-                if analysis_type == AnalysisType.NIGHTMARE:
-                    enhanced_result = f"""{result}
+🎯 **ما ستحصل عليه مقابل 5 نقاط:**
+• تحليل شامل لجميع الأطر الزمنية (M5, M15, H1, H4, D1)
+• نقاط دخول وخروج بدقة السنت الواحد
+• مستويات دعم ومقاومة متعددة مع قوة كل مستوى  
+• سيناريوهات متعددة مع احتماليات دقيقة
+• استراتيجيات سكالبينج وسوينج
+• تحليل نقاط الانعكاس المحتملة
+• مناطق العرض والطلب المؤسسية
+• توقعات قصيرة ومتوسطة المدى
+• إدارة مخاطر تفصيلية
+• تنسيق احترافي بجداول منظمة
 
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-🔥 **تم بواسطة Gold Nightmare Academy** 🔥
-💎 **التحليل الشامل المتقدم - Premium (5 نقاط)**
-⚡ **تحليل متقدم بالذكاء الاصطناعي Claude المحسن**
-🎯 **دقة التحليل: 95%+ - نقاط بالسنت الواحد**
-📸 **تحليل الشارت المتقدم متاح - أرسل صورة!**
-🛡️ **40 مفتاح ثابت فقط - لا يُحذف أبداً**
-🔑 **النظام مُصلح - اتصال مباشر فقط**
-💰 **تكلفة هذا التحليل: 5 نقاط (يستحق كل نقطة)**
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+⏰ **وقت التحليل:** 30-60 ثانية (تحليل معمق)
 
-⚠️ **تنبيه هام:** هذا تحليل تعليمي متقدم وليس نصيحة استثمارية
-💡 **استخدم إدارة المخاطر دائماً ولا تستثمر أكثر مما تستطيع خسارته**"""
-                    result = enhanced_result
-                
-                await processing_msg.edit_text(result)
-                
-                # حفظ التحليل
-                analysis = Analysis(
-                    id=f"{user.user_id}_{datetime.now().timestamp()}",
-                    user_id=user.user_id,
-                    timestamp=datetime.now(),
-                    analysis_type=data,
-                    prompt=prompt,
-                    result=result[:500],
-                    gold_price=price.price
-                )
-                await context.bot_data['db'].add_analysis(analysis)
-                
-                # إضافة زر رجوع
-                keyboard = [[InlineKeyboardButton("🔙 رجوع للقائمة", callback_data="back_main")]]
-                await query.edit_message_reply_markup(
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+هل تريد المتابعة وخصم 5 نقاط للحصول على التحليل الأقوى؟"""
+
+    if remaining_points < 5:
+        warning_message += f"""
+
+❌ **تحذير:** نقاط غير كافية!
+تحتاج 5 نقاط ولديك {remaining_points} فقط.
+
+للحصول على مفتاح جديد تواصل مع: @Odai_xau"""
+        
+        await query.edit_message_text(
+            warning_message,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📞 تواصل مع Odai", url="https://t.me/Odai_xau")],
+                [InlineKeyboardButton("🔙 رجوع للقائمة", callback_data="back_main")]
+            ])
+        )
+        return
+    else:
+        await query.edit_message_text(
+            warning_message,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔥 نعم، أريد التحليل الشامل (5 نقاط)", callback_data="confirm_nightmare")],
+                [InlineKeyboardButton("🔙 لا، رجوع للقائمة", callback_data="back_main")]
+            ])
+        )
+        return
+
+# أزرار التحليل: (النوع، الاسم، النقاط)
+CALLBACK_ANALYSIS_TYPES = {
+    "analysis_quick": (AnalysisType.QUICK, "⚡ تحليل سريع", 1),
+    "analysis_scalping": (AnalysisType.SCALPING, "🎯 سكالبينج", 1),
+    "analysis_detailed": (AnalysisType.DETAILED, "📊 تحليل مفصل", 1),
+    "analysis_swing": (AnalysisType.SWING, "📈 سوينج", 1),
+    "analysis_forecast": (AnalysisType.FORECAST, "🔮 توقعات", 1),
+    "analysis_reversal": (AnalysisType.REVERSAL, "🔄 مناطق انعكاس", 1),
+    "analysis_news": (AnalysisType.NEWS, "📰 تحليل الأخبار", 1),
+    "confirm_nightmare": (AnalysisType.NIGHTMARE, "🔥 التحليل الشامل المتقدم (5 نقاط)", 5)
+}
+
+async def callback_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """إضافة التحليل للطابور بعد خصم النقاط - العامل يعدل نفس الرسالة بالنتيجة"""
+    query, user, data = request.query, request.user, request.data
+    analysis_type, type_name, _ = CALLBACK_ANALYSIS_TYPES[data]
+    
+    # النقاط خُصمت في الموجه حسب سياسة المسار
+    if request.ticket and request.ticket.message:
+        processing_msg = await query.edit_message_text(f"✅ {request.ticket.message}\n\n🧠 جاري إعداد {type_name}...")
+    else:
+        processing_msg = await query.edit_message_text(
+            f"🧠 جاري إعداد {type_name}...\n\n⏰ استجابة سريعة ومحسنة..."
+        )
+    
+    try:
+        # إنشاء prompt مناسب لنوع التحليل
+        if analysis_type == AnalysisType.QUICK:
+            prompt = "تحليل سريع للذهب الآن مع توصية واضحة ونقاط دقيقة بالسنت"
+        elif analysis_type == AnalysisType.SCALPING:
+            prompt = "تحليل سكالبينج للذهب للـ 15 دقيقة القادمة مع نقاط دخول وخروج دقيقة بالسنت الواحد"
+        elif analysis_type == AnalysisType.SWING:
+            prompt = "تحليل سوينج للذهب للأيام والأسابيع القادمة مع نقاط دقيقة بالسنت"
+        elif analysis_type == AnalysisType.FORECAST:
+            prompt = "توقعات الذهب لليوم والأسبوع القادم مع احتماليات ونقاط دقيقة"
+        elif analysis_type == AnalysisType.REVERSAL:
+            prompt = "تحليل نقاط الانعكاس المحتملة للذهب مع مستويات الدعم والمقاومة بدقة السنت"
+        elif analysis_type == AnalysisType.NEWS:
+            prompt = "تحليل تأثير الأخبار الحالية على الذهب مع نقاط التداول"
+        elif analysis_type == AnalysisType.NIGHTMARE:
+            prompt = f"""أريد التحليل الشامل المتقدم للذهب - التحليل الأكثر تقدماً وتفصيلاً مع:
+
+            1. تحليل شامل لجميع الأطر الزمنية (M5, M15, H1, H4, D1) مع نسب ثقة دقيقة
+            2. مستويات دعم ومقاومة متعددة مع قوة كل مستوى بدقة السنت
+            3. نقاط دخول وخروج بالسنت الواحد مع أسباب كل نقطة
+            4. سيناريوهات متعددة (صاعد، هابط، عرضي) مع احتماليات
+            5. استراتيجيات سكالبينج وسوينج بنقاط دقيقة
+            6. تحليل نقاط الانعكاس المحتملة
+            7. مناطق العرض والطلب المؤسسية
+            8. توقعات قصيرة ومتوسطة المدى
+            9. إدارة مخاطر تفصيلية
+            10. جداول منظمة وتنسيق احترافي
+
+            {Config.NIGHTMARE_TRIGGER}
             
-            except Exception as e:
-                logger.error(f"Analysis error: {e}")
-                await processing_msg.edit_text(f"❌ حدث خطأ في {type_name}")
+            اجعله التحليل الأقوى والأشمل على الإطلاق بدقة السنت الواحد!"""
+        else:
+            prompt = "تحليل شامل ومفصل للذهب مع جداول منظمة ونقاط دقيقة بالسنت"
         
+        ticket = request.ticket
+        await context.bot_data['analysis_jobs'].enqueue(
+            user_id=user.user_id,
+            chat_id=processing_msg.chat_id,
+            message_id=processing_msg.message_id,
+            source='callback',
+            analysis_type=analysis_type.value,
+            label=data,
+            prompt=prompt,
+            license_key=ticket.license_key if ticket else None,
+            points=ticket.points if ticket else 0,
+            priority=int(analysis_priority(user.user_id, analysis_type))
+        )
+        if ticket is not None:
+            ticket.deferred = True
+    
+    except Exception as e:
+        logger.error(f"Analysis queueing error: {e}")
+        await processing_msg.edit_text(f"❌ حدث خطأ في {type_name}")
+
+for _callback_data, (_, _, _points) in CALLBACK_ANALYSIS_TYPES.items():
+    # النشاط يُحفظ مع الخصم في preflight - لا حاجة لـ persist
+    callback_router.add(_callback_data, callback_analysis, points=_points)
+
+@callback_router.route("admin_panel", admin_only=True, needs_user=False, requires_license=False)
+async def callback_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """لوحة الإدارة"""
+    query = request.query
+    await query.edit_message_text(
+        f"{emoji('admin')} لوحة الإدارة - Fixed & Enhanced\n\n"
+        f"{emoji('zap')} 40 مفتاح ثابت - محفوظ دائماً\n"
+        f"{emoji('shield')} النظام مُصلح ومحسن\n"
+        f"{emoji('camera')} تحليل الشارت المُحسن\n\n"
+        "اختر العملية المطلوبة:",
+        reply_markup=InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(f"{emoji('chart')} إحصائيات", callback_data="admin_stats"),
+                InlineKeyboardButton(f"{emoji('key')} عرض المفاتيح", callback_data="admin_show_keys")
+            ],
+            [
+                InlineKeyboardButton(f"{emoji('prohibited')} المفاتيح المتاحة", callback_data="admin_unused_keys"),
+                InlineKeyboardButton(f"{emoji('backup')} نسخة احتياطية", callback_data="admin_backup")
+            ],
+            [
+                InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")
+            ]
+        ])
+    )
+
+@callback_router.route("admin_stats", admin_only=True, needs_user=False, requires_license=False)
+async def callback_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """إحصائيات الإدارة"""
+    query = request.query
+    await query.edit_message_text(f"{emoji('clock')} جاري جمع الإحصائيات...")
+    
+    try:
+        db_manager = context.bot_data['db']
+        license_manager = context.bot_data['license_manager']
         
-        elif data == "admin_panel" and user_id == Config.MASTER_USER_ID:
-            await query.edit_message_text(
-                f"{emoji('admin')} لوحة الإدارة - Fixed & Enhanced\n\n"
-                f"{emoji('zap')} 40 مفتاح ثابت - محفوظ دائماً\n"
-                f"{emoji('shield')} النظام مُصلح ومحسن\n"
-                f"{emoji('camera')} تحليل الشارت المُحسن\n\n"
-                "اختر العملية المطلوبة:",
-                reply_markup=InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton(f"{emoji('chart')} إحصائيات", callback_data="admin_stats"),
-                        InlineKeyboardButton(f"{emoji('key')} عرض المفاتيح", callback_data="admin_show_keys")
-                    ],
-                    [
-                        InlineKeyboardButton(f"{emoji('prohibited')} المفاتيح المتاحة", callback_data="admin_unused_keys"),
-                        InlineKeyboardButton(f"{emoji('backup')} نسخة احتياطية", callback_data="admin_backup")
-                    ],
-                    [
-                        InlineKeyboardButton(f"{emoji('back')} رجوع", callback_data="back_main")
-                    ]
-                ])
-            )
+        stats = await db_manager.get_stats()
+        keys_stats = await license_manager.get_all_keys_stats()
         
-        elif data == "admin_stats" and user_id == Config.MASTER_USER_ID:
-            await query.edit_message_text(f"{emoji('clock')} جاري جمع الإحصائيات...")
-            
-            try:
-                db_manager = context.bot_data['db']
-                license_manager = context.bot_data['license_manager']
-                
-                stats = await db_manager.get_stats()
-                keys_stats = await license_manager.get_all_keys_stats()
-                
-                stats_message = f"""{emoji('chart')} **إحصائيات شاملة - Fixed & Enhanced**
+        stats_message = f"""{emoji('chart')} **إحصائيات شاملة - Fixed & Enhanced**
 
 {emoji('users')} **المستخدمين:**
 • إجمالي المستخدمين: {stats['total_users']}
@@ -2646,112 +6279,118 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 • تحليل الشارت: {emoji('check') if Config.CHART_ANALYSIS_ENABLED else emoji('cross')}
 
 {emoji('clock')} آخر تحديث: {datetime.now().strftime('%H:%M:%S')}"""
-                
-                await query.edit_message_text(
-                    stats_message,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"{emoji('refresh')} تحديث", callback_data="admin_stats")],
-                        [InlineKeyboardButton(f"{emoji('back')} رجوع للإدارة", callback_data="admin_panel")]
-                    ])
-                )
-                
-            except Exception as e:
-                logger.error(f"Error in admin stats: {e}")
-                await query.edit_message_text(f"{emoji('cross')} خطأ في جلب الإحصائيات")
-
-        elif data == "admin_show_keys" and user_id == Config.MASTER_USER_ID:
-            # إصلاح عرض المفاتيح مباشرة في callback
-            await query.edit_message_text(f"جاري تحميل المفاتيح الثابتة...")
+        
+        await query.edit_message_text(
+            stats_message,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{emoji('refresh')} تحديث", callback_data="admin_stats")],
+                [InlineKeyboardButton(f"{emoji('back')} رجوع للإدارة", callback_data="admin_panel")]
+            ])
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in admin stats: {e}")
+        await query.edit_message_text(f"{emoji('cross')} خطأ في جلب الإحصائيات")
+
+@callback_router.route("admin_show_keys", admin_only=True, needs_user=False, requires_license=False)
+async def callback_admin_show_keys(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """عرض المفاتيح للمشرف"""
+    query = request.query
+    # إصلاح عرض المفاتيح مباشرة في callback
+    await query.edit_message_text(f"جاري تحميل المفاتيح الثابتة...")
+    
+    try:
+        license_manager = context.bot_data['license_manager']
+        await license_manager.load_keys_from_db()
+        
+        if not license_manager.license_keys:
+            await query.edit_message_text(f"لا توجد مفاتيح",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton(f"رجوع", callback_data="admin_panel")]
+                ])
+            )
+            return
+        
+        message = f"المفاتيح الثابتة الـ 40 - Ultra Simple:\n\n"
+        
+        # إحصائيات عامة
+        stats = await license_manager.get_all_keys_stats()
+        message += f"الإحصائيات:\n"
+        message += f"• إجمالي المفاتيح: {stats['total_keys']}\n"
+        message += f"• المفاتيح المستخدمة: {stats['used_keys']}\n"
+        message += f"• المفاتيح المتاحة: {stats['unused_keys']}\n"
+        message += f"• المفاتيح المنتهية: {stats['expired_keys']}\n"
+        message += f"محفوظة باتصال مباشر - مُصلح\n\n"
+        
+        # عرض أول 10 مفاتيح
+        count = 0
+        for key, key_data in license_manager.license_keys.items():
+            if count >= 10:
+                break
+            count += 1
             
-            try:
-                license_manager = context.bot_data['license_manager']
-                await license_manager.load_keys_from_db()
-                
-                if not license_manager.license_keys:
-                    await query.edit_message_text(f"لا توجد مفاتيح",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton(f"رجوع", callback_data="admin_panel")]
-                        ])
-                    )
-                    return
-                
-                message = f"المفاتيح الثابتة الـ 40 - Ultra Simple:\n\n"
-                
-                # إحصائيات عامة
-                stats = await license_manager.get_all_keys_stats()
-                message += f"الإحصائيات:\n"
-                message += f"• إجمالي المفاتيح: {stats['total_keys']}\n"
-                message += f"• المفاتيح المستخدمة: {stats['used_keys']}\n"
-                message += f"• المفاتيح المتاحة: {stats['unused_keys']}\n"
-                message += f"• المفاتيح المنتهية: {stats['expired_keys']}\n"
-                message += f"محفوظة باتصال مباشر - مُصلح\n\n"
-                
-                # عرض أول 10 مفاتيح
-                count = 0
-                for key, key_data in license_manager.license_keys.items():
-                    if count >= 10:
-                        break
-                    count += 1
-                    
-                    status = "نشط" if key_data["active"] else "معطل"
-                    user_info = f"({key_data['username']})" if key_data['username'] else "(غير مستخدم)"
-                    usage = f"{key_data['used']}/{key_data['limit']}"
-                    
-                    message += f"{count:2d}. {key[:15]}...\n"
-                    message += f"   {status} | {user_info}\n"
-                    message += f"   الاستخدام: {usage}\n\n"
-                
-                if len(license_manager.license_keys) > 10:
-                    message += f"... و {len(license_manager.license_keys) - 10} مفاتيح أخرى\n\n"
-                
-                message += f"جميع المفاتيح ثابتة ومحفوظة بالاتصال المباشر"
-                
-                await query.edit_message_text(
-                    message,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"رجوع للإدارة", callback_data="admin_panel")]
-                    ])
-                )
+            status = "نشط" if key_data["active"] else "معطل"
+            user_info = f"({key_data['username']})" if key_data['username'] else "(غير مستخدم)"
+            usage = f"{key_data['used']}/{key_data['limit']}"
             
-            except Exception as e:
-                logger.error(f"Admin show keys error: {e}")
-                await query.edit_message_text(f"خطأ في تحميل المفاتيح: {str(e)}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"رجوع", callback_data="admin_panel")]
-                    ])
-                )
+            message += f"{count:2d}. {key[:15]}...\n"
+            message += f"   {status} | {user_info}\n"
+            message += f"   الاستخدام: {usage}\n\n"
+        
+        if len(license_manager.license_keys) > 10:
+            message += f"... و {len(license_manager.license_keys) - 10} مفاتيح أخرى\n\n"
+        
+        message += f"جميع المفاتيح ثابتة ومحفوظة بالاتصال المباشر"
+        
+        await query.edit_message_text(
+            message,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"رجوع للإدارة", callback_data="admin_panel")]
+            ])
+        )
+    
+    except Exception as e:
+        logger.error(f"Admin show keys error: {e}")
+        await query.edit_message_text(f"خطأ في تحميل المفاتيح: {str(e)}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"رجوع", callback_data="admin_panel")]
+            ])
+        )
 
-        elif data == "admin_unused_keys" and user_id == Config.MASTER_USER_ID:
-            # إصلاح عرض المفاتيح المتاحة مباشرة في callback
-            await query.edit_message_text(f"جاري تحميل المفاتيح المتاحة...")
-            
-            try:
-                license_manager = context.bot_data['license_manager']
-                await license_manager.load_keys_from_db()
-                
-                unused_keys = [key for key, key_data in license_manager.license_keys.items() 
-                               if not key_data["user_id"] and key_data["active"]]
-                
-                if not unused_keys:
-                    await query.edit_message_text(f"لا توجد مفاتيح متاحة من الـ 40",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton(f"رجوع", callback_data="admin_panel")]
-                        ])
-                    )
-                    return
-                
-                message = f"المفاتيح المتاحة ({len(unused_keys)} من 40):\n"
-                message += f"محفوظة بالاتصال المباشر - مُصلح\n\n"
-                
-                for i, key in enumerate(unused_keys[:15], 1):  # أول 15 فقط
-                    key_data = license_manager.license_keys[key]
-                    message += f"{i:2d}. {key}\n"
-                    message += f"    الحد: {key_data['limit']} أسئلة + شارت\n\n"
-                
-                if len(unused_keys) > 15:
-                    message += f"... و {len(unused_keys) - 15} مفاتيح أخرى\n\n"
-                
-                message += f"""تعليمات إعطاء المفاتيح:
+@callback_router.route("admin_unused_keys", admin_only=True, needs_user=False, requires_license=False)
+async def callback_admin_unused_keys(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """المفاتيح المتاحة للمشرف"""
+    query = request.query
+    # إصلاح عرض المفاتيح المتاحة مباشرة في callback
+    await query.edit_message_text(f"جاري تحميل المفاتيح المتاحة...")
+    
+    try:
+        license_manager = context.bot_data['license_manager']
+        await license_manager.load_keys_from_db()
+        
+        unused_keys = [key for key, key_data in license_manager.license_keys.items() 
+                       if not key_data["user_id"] and key_data["active"]]
+        
+        if not unused_keys:
+            await query.edit_message_text(f"لا توجد مفاتيح متاحة من الـ 40",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton(f"رجوع", callback_data="admin_panel")]
+                ])
+            )
+            return
+        
+        message = f"المفاتيح المتاحة ({len(unused_keys)} من 40):\n"
+        message += f"محفوظة بالاتصال المباشر - مُصلح\n\n"
+        
+        for i, key in enumerate(unused_keys[:15], 1):  # أول 15 فقط
+            key_data = license_manager.license_keys[key]
+            message += f"{i:2d}. {key}\n"
+            message += f"    الحد: {key_data['limit']} أسئلة + شارت\n\n"
+        
+        if len(unused_keys) > 15:
+            message += f"... و {len(unused_keys) - 15} مفاتيح أخرى\n\n"
+        
+        message += f"""تعليمات إعطاء المفاتيح:
 انسخ مفتاح وأرسله للمستخدم مع التعليمات:
 
 ```
@@ -2767,62 +6406,65 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 • تحليل الشارت المتقدم مدعوم
 • بياناتك محفوظة بالاتصال المباشر
 ```"""
-                
-                await query.edit_message_text(
-                    message,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"رجوع للإدارة", callback_data="admin_panel")]
-                    ])
-                )
-            
-            except Exception as e:
-                logger.error(f"Unused keys error: {e}")
-                await query.edit_message_text(f"خطأ في تحميل المفاتيح المتاحة: {str(e)}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"رجوع", callback_data="admin_panel")]
-                    ])
-                )
+        
+        await query.edit_message_text(
+            message,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"رجوع للإدارة", callback_data="admin_panel")]
+            ])
+        )
+    
+    except Exception as e:
+        logger.error(f"Unused keys error: {e}")
+        await query.edit_message_text(f"خطأ في تحميل المفاتيح المتاحة: {str(e)}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"رجوع", callback_data="admin_panel")]
+            ])
+        )
 
-        elif data == "admin_backup" and user_id == Config.MASTER_USER_ID:
-            await query.edit_message_text(f"{emoji('backup')} جاري إنشاء النسخة الاحتياطية...")
-            
-            try:
-                db_manager = context.bot_data['db']
-                license_manager = context.bot_data['license_manager']
-                
-                await license_manager.load_keys_from_db()
-                stats = await db_manager.get_stats()
-                keys_stats = await license_manager.get_all_keys_stats()
-                
-                # إنشاء النسخة الاحتياطية
-                backup_data = {
-                    'timestamp': datetime.now().isoformat(),
-                    'version': '7.0 Fixed & Enhanced',
-                    'system': 'Fixed 40 Static Keys',
-                    'features': {
-                        'static_keys': True,
-                        'permanent_storage': True,
-                        'chart_analysis_fixed': Config.CHART_ANALYSIS_ENABLED,
-                        'performance_optimized': True
-                    },
-                    'stats': stats,
-                    'keys_stats': keys_stats,
-                    'license_keys': {k: {
-                        'key': k,
-                        'limit': v["limit"],
-                        'used': v["used"],
-                        'active': v["active"],
-                        'user_id': v["user_id"],
-                        'username': v["username"]
-                    } for k, v in license_manager.license_keys.items()}
-                }
-                
-                backup_filename = f"backup_fixed_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-                async with aiofiles.open(backup_filename, 'w', encoding='utf-8') as f:
-                    await f.write(json.dumps(backup_data, ensure_ascii=False, indent=2))
-                
-                await query.edit_message_text(
-                    f"""{emoji('check')} تم إنشاء النسخة الاحتياطية المُصلحة
+@callback_router.route("admin_backup", admin_only=True, needs_user=False, requires_license=False)
+async def callback_admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE, request: CallbackRequest):
+    """نسخة احتياطية"""
+    query = request.query
+    await query.edit_message_text(f"{emoji('backup')} جاري إنشاء النسخة الاحتياطية...")
+    
+    try:
+        db_manager = context.bot_data['db']
+        license_manager = context.bot_data['license_manager']
+        
+        await license_manager.load_keys_from_db()
+        stats = await db_manager.get_stats()
+        keys_stats = await license_manager.get_all_keys_stats()
+        
+        # إنشاء النسخة الاحتياطية
+        backup_data = {
+            'timestamp': datetime.now().isoformat(),
+            'version': '7.0 Fixed & Enhanced',
+            'system': 'Fixed 40 Static Keys',
+            'features': {
+                'static_keys': True,
+                'permanent_storage': True,
+                'chart_analysis_fixed': Config.CHART_ANALYSIS_ENABLED,
+                'performance_optimized': True
+            },
+            'stats': stats,
+            'keys_stats': keys_stats,
+            'license_keys': {k: {
+                'key': k,
+                'limit': v["limit"],
+                'used': v["used"],
+                'active': v["active"],
+                'user_id': v["user_id"],
+                'username': v["username"]
+            } for k, v in license_manager.license_keys.items()}
+        }
+        
+        backup_filename = f"backup_fixed_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        async with aiofiles.open(backup_filename, 'w', encoding='utf-8') as f:
+            await f.write(json.dumps(backup_data, ensure_ascii=False, indent=2))
+        
+        await query.edit_message_text(
+            f"""{emoji('check')} تم إنشاء النسخة الاحتياطية المُصلحة
 
 {emoji('folder')} الملف: {backup_filename}
 {emoji('key')} المفاتيح الثابتة: {len(license_manager.license_keys)}
@@ -2837,28 +6479,15 @@ async def handle_callback_query_fixed(update: Update, context: ContextTypes.DEFA
 • إحصائيات شاملة
 
 {emoji('zap')} النظام مُصلح - البيانات آمنة ودائمة!""",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"{emoji('back')} رجوع للإدارة", callback_data="admin_panel")]
-                    ])
-                )
-                
-            except Exception as e:
-                logger.error(f"Backup error: {e}")
-                await query.edit_message_text(f"{emoji('cross')} خطأ في إنشاء النسخة الاحتياطية")
-
-        # تحديث بيانات المستخدم
-        user.last_activity = datetime.now()
-        await context.bot_data['db'].add_user(user)
-        context.user_data['user'] = user
-    
-    except Exception as e:
-        logger.error(f"Error in callback query handler: {e}")
-        await query.edit_message_text(
-            f"{emoji('cross')} حدث خطأ مؤقت - النظام مُصلح",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"{emoji('back')} رجوع للقائمة", callback_data="back_main")]
+                [InlineKeyboardButton(f"{emoji('back')} رجوع للإدارة", callback_data="admin_panel")]
             ])
         )
+        
+    except Exception as e:
+        logger.error(f"Backup error: {e}")
+        await query.edit_message_text(f"{emoji('cross')} خطأ في إنشاء النسخة الاحتياطية")
+
 
 # ==================== Fixed Error Handler ====================
 async def error_handler_fixed(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -2890,6 +6519,41 @@ async def error_handler_fixed(update: object, context: ContextTypes.DEFAULT_TYPE
     except:
         pass
 
+# ==================== Fixed Lifecycle Hooks ====================
+async def post_init_fixed(application: Application) -> None:
+    """تشغيل المهام الخلفية بعد تهيئة البوت"""
+    await application.bot_data['cache'].start()
+    await application.bot_data['tick_store'].start()
+    await application.bot_data['candles'].start()
+    await application.bot_data['gold_price_manager'].start()
+    await application.bot_data['image_pipeline'].start()
+    await application.bot_data['state_backend'].start()
+    await application.bot_data['broadcast'].start(application.bot)
+    await application.bot_data['analysis_jobs'].start(application)
+    
+    db_manager = application.bot_data['db']
+    if db_manager.write_behind is not None:
+        await db_manager.write_behind.start()
+
+async def post_shutdown_fixed(application: Application) -> None:
+    """إغلاق الموارد عند إيقاف البوت"""
+    # أولاً: إرجاع التحليلات الجارية للطابور قبل إغلاق Claude وقاعدة البيانات
+    await application.bot_data['analysis_jobs'].stop()
+    
+    db_manager = application.bot_data['db']
+    if db_manager.write_behind is not None:
+        await db_manager.write_behind.stop()
+    
+    await application.bot_data['broadcast'].stop()
+    await application.bot_data['state_backend'].stop()
+    await application.bot_data['cache'].stop()
+    await application.bot_data['image_pipeline'].close()
+    await application.bot_data['claude_manager'].close()
+    await application.bot_data['gold_price_manager'].close()
+    await application.bot_data['candles'].close()
+    await application.bot_data['tick_store'].close()
+    await application.bot_data['database'].close()
+
 # ==================== Fixed Main Function ====================
 def main():
     """الدالة الرئيسية - Ultra Simple & Fixed"""
@@ -2912,17 +6576,34 @@ def main():
     
     # إنشاء التطبيق
     global application
-    application = Application.builder().token(Config.TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(Config.TELEGRAM_BOT_TOKEN)
+        .rate_limiter(TelegramSendScheduler())
+        .post_init(post_init_fixed)
+        .post_shutdown(post_shutdown_fixed)
+        .build()
+    )
     
-    # إنشاء المكونات البسيطة الجديدة - بدون pools
+    # إنشاء المكونات
     cache_manager = FixedCacheManager()
     database_manager = UltraSimpleDatabaseManager()  # النظام الجديد البسيط
-    db_manager = UltraSimpleDBManager(database_manager)
+    write_behind = UserWriteBehindQueue(database_manager) if Config.USER_WRITE_BEHIND else None
+    db_manager = UltraSimpleDBManager(database_manager, write_behind)
     license_manager = UltraSimpleLicenseManager(database_manager)  # النظام الجديد البسيط
-    gold_price_manager = FixedGoldPriceManager(cache_manager)
-    claude_manager = FixedClaudeAIManager(cache_manager)
-    rate_limiter = FixedRateLimiter()
-    security_manager = FixedSecurityManager()
+    tick_store = PriceTickStore()
+    candles = CandleAggregator(tick_store)
+    gold_price_manager = FixedGoldPriceManager(cache_manager, tick_store=tick_store, candles=candles)
+    claude_scheduler = ClaudeRequestScheduler()
+    claude_manager = FixedClaudeAIManager(cache_manager, claude_scheduler, candles)
+    state_backend = create_state_backend(database_manager)
+    rate_limiter = FixedRateLimiter(state_backend)
+    security_manager = FixedSecurityManager(state_backend)
+    preflight = RequestPreflight(security_manager, rate_limiter, db_manager, license_manager)
+    update_deduplicator = UpdateDeduplicator()
+    image_pipeline = ChartImagePipeline()
+    broadcast_engine = BroadcastEngine(database_manager)
+    analysis_jobs = AnalysisJobQueue(database_manager, preflight)
     
     # تحميل البيانات بالنظام البسيط الجديد
     async def initialize_ultra_simple_data():
@@ -2946,19 +6627,32 @@ def main():
         'db': db_manager,
         'license_manager': license_manager,
         'gold_price_manager': gold_price_manager,
+        'tick_store': tick_store,
+        'candles': candles,
         'claude_manager': claude_manager,
         'rate_limiter': rate_limiter,
         'security': security_manager,
         'cache': cache_manager,
-        'database': database_manager
+        'database': database_manager,
+        'image_pipeline': image_pipeline,
+        'state_backend': state_backend,
+        'broadcast': broadcast_engine,
+        'preflight': preflight,
+        'deduplicator': update_deduplicator,
+        'analysis_jobs': analysis_jobs
     })
     
-    # إضافة المعالجات
+    # إضافة المعالجات - إسقاط التحديثات المكررة قبل أي معالج
+    application.add_handler(TypeHandler(Update, update_deduplicator.handle), group=-1)
     application.add_handler(CommandHandler("start", start_command_fixed))
     application.add_handler(CommandHandler("license", license_command_fixed))
     application.add_handler(CommandHandler("keys", show_fixed_keys_command))
     application.add_handler(CommandHandler("unusedkeys", unused_fixed_keys_command))
     application.add_handler(CommandHandler("stats", stats_command_fixed))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("broadcaststatus", broadcast_status_command))
+    application.add_handler(CommandHandler("block", block_command))
+    application.add_handler(CommandHandler("unblock", unblock_command))
     
     # معالجات الرسائل
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message_fixed))
@@ -2974,7 +6668,7 @@ def main():
     print(f"📊 تم تحميل {len(license_manager.license_keys)} مفتاح ثابت")
     print(f"👥 تم تحميل {len(db_manager.users)} مستخدم")
     print("🔑 40 مفتاح ثابت - لا يُحذف أبداً!")
-    print("🛡️ النظام بسيط ومُصلح - بدون connection pools")
+    print(f"🛡️ وضع قاعدة البيانات: {database_manager.mode}")
     print("="*50)
     print("🌐 البوت يعمل على Render مع Ultra Simple System...")
     
@@ -2997,11 +6691,10 @@ def main():
     
     print(f"🔗 Ultra Simple Webhook URL: {webhook_url}/webhook")
     print(f"🚀 استمع على المنفذ: {port}")
-    print(f"🛡️ PostgreSQL Database: اتصال مباشر - بدون pool")
+    print(f"🛡️ PostgreSQL Database: {database_manager.mode} (max {Config.DB_POOL_MAX_SIZE})")
     print(f"📸 Chart Analysis: {'Fixed & Ready' if Config.CHART_ANALYSIS_ENABLED else 'Disabled'}")
     print(f"⚡ Performance: Ultra Simple & Direct")
     print(f"🔑 License Keys: 40 Static & Permanent")
-    print("🎯 لا توجد connection pools - اتصال مباشر فقط")
     
     try:
         application.run_webhook(
@@ -3015,19 +6708,38 @@ def main():
         print(f"❌ خطأ في تشغيل Ultra Simple Webhook: {e}")
         logger.error(f"Ultra Simple webhook error: {e}")
 
+def _banner_points(points: List[str]) -> str:
+    return "\n".join(f"║{f'  • {point}'.ljust(70)}║" for point in points)
+
 if __name__ == "__main__":
+    # البانر يتبع وضع قاعدة البيانات المُعد - الوضع الفعلي يُطبع بعد الاتصال
+    if Config.DATABASE_MODE == "pool":
+        db_title = f"Connection Pool - max {Config.DB_POOL_MAX_SIZE} connections"
+        db_fix = ["connection pool مع إعادة استخدام الاتصالات", "فحص الاتصال قبل الاستخدام",
+                  "رجوع تلقائي للاتصال المباشر عند فشل الـ pool"]
+        db_perf = [f"pool حتى {Config.DB_POOL_MAX_SIZE} اتصال", "لا إنشاء اتصال جديد لكل عملية",
+                   "إغلاق الاتصالات الخاملة تلقائياً"]
+        db_pg = ["اتصالات مُعاد استخدامها من الـ pool", "transaction واحدة لكل طلب مدفوع",
+                 "إغلاق الـ pool عند الإيقاف"]
+    else:
+        db_title = "No Connection Pools - Direct Only"
+        db_fix = ["بدون connection pool (DATABASE_MODE=direct)", "اتصال مباشر لكل عملية",
+                  "إغلاق فوري للاتصالات"]
+        db_perf = ["لا توجد connection pools", "اتصال مباشر فقط", "إغلاق فوري للاتصالات"]
+        db_pg = ["لا توجد pools معقدة", "اتصال منفصل لكل عملية", "إغلاق تلقائي للاتصالات"]
+    db_title = db_title.center(70)
+    db_fix, db_perf, db_pg = _banner_points(db_fix), _banner_points(db_perf), _banner_points(db_pg)
+    
     print(f"""
 ╔══════════════════════════════════════════════════════════════════════╗
 ║              🚀 Gold Nightmare Bot - ULTRA SIMPLE & FIXED 🚀          ║
-║                   No Connection Pools - Direct Only                  ║
+║{db_title}║
 ║                    Version 7.1 Ultra Simple Fixed                    ║
 ║                    🔥 مشكلة اتصال قاعدة البيانات مُصلحة 🔥          ║
 ╠══════════════════════════════════════════════════════════════════════╣
 ║                                                                      ║
 ║  ✅ **الحل النهائي لمشكلة قاعدة البيانات:**                           ║
-║  • إزالة connection pools تماماً                                    ║
-║  • اتصال مباشر لكل عملية                                            ║
-║  • إغلاق فوري للاتصالات                                             ║
+{db_fix}
 ║  • retry logic للاتصالات الفاشلة                                    ║
 ║  • معالجة أخطاء مبسطة وواضحة                                       ║
 ║  • لا توجد timeouts معقدة                                           ║
@@ -3045,17 +6757,13 @@ if __name__ == "__main__":
 ║  • معالجة صور محسنة                                                 ║
 ║                                                                      ║
 ║  ⚡ **Ultra Simple Performance:**                                     ║
-║  • لا توجد connection pools                                          ║
-║  • اتصال مباشر فقط                                                  ║
-║  • إغلاق فوري للاتصالات                                             ║
+{db_perf}
 ║  • معالجة أخطاء بسيطة                                               ║
 ║  • retry mechanism                                                   ║
 ║                                                                      ║
 ║  💾 **PostgreSQL - Ultra Simple:**                                   ║
 ║  • جميع العمليات مباشرة                                             ║
-║  • لا توجد pools معقدة                                              ║
-║  • اتصال منفصل لكل عملية                                            ║
-║  • إغلاق تلقائي للاتصالات                                           ║
+{db_pg}
 ║  • المفاتيح محفوظة بأمان                                            ║
 ║                                                                      ║
 ║  🎯 **جميع الميزات تعمل:**                                            ║